@@ -28,12 +28,24 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import ast
+import codecs
+import ctypes
+import marshal
+import os
+import re
+import signal
+import subprocess
 import sys
+import textwrap
+import time
 import traceback
+import zlib
 import math
 import keyword as pythonkeyword
-import __builtin__
-from threading import Lock
+import linecache
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from threading import Event, Lock, Thread, local
 
 __author__ = "Michael Kessler"
 __author_email__ = "mike@toadgrass.com"
@@ -53,6 +65,43 @@ try:
 except ImportError:
     from PyQt4 import QtCore, QtGui
 
+try:
+    import __builtin__
+except ImportError:
+    import builtins as __builtin__
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+try:
+    from reprlib import Repr
+except ImportError:
+    from repr import Repr
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from . import kernel as _kernel
+from . import history as _history
+from .completion import SymbolIndex, expression_before
+from .spill import SpillFile
+from . import display as _display
+from . import ansi as _ansi
+from . import tasks as _tasks
+from .search import INDEX_LINES, ScrollbackIndex
+from .pool import FairPool
+from . import profiling
+from .cells import CodeCache, cell_at, source_key, split_cells
+
 # From http://blog.client9.com/2008/10/04/escaping-html-in-python.html
 # This is really really ugly.
 def html_escape(text):
@@ -63,82 +112,1318 @@ def html_escape(text):
     text = text.replace("<", '&lt;')
     return text
 
+# Buffered output is delivered at most every OUTPUT_FLUSH_INTERVAL
+# milliseconds, or as soon as OUTPUT_BUFFER_SIZE characters are waiting.
+OUTPUT_FLUSH_INTERVAL = 30
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+# Writing threads and the OutputRedirect capturing each, see _StreamRouter.
+# Only ever changed by setting or deleting a key, which is atomic, so lookups
+# need no lock.
+_captures = {}
+
+class _StreamRouter(object):
+    """Stands in for sys.stdout or sys.stderr once capturing is installed.
+
+    Writes from a thread inside an OutputRedirect go to that redirect, all
+    other writes go straight through to the original stream.
+    """
+
+    def __init__(self, original):
+        self.original = original
+
+    def write(self, text):
+        redirect = _captures.get(get_ident())
+        if redirect is None:
+            return self.original.write(text)
+        redirect.write(text, self.original)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        redirect = _captures.get(get_ident())
+        if redirect is not None:
+            redirect.flush()
+        self.original.flush()
+
+    def __getattr__(self, name):
+        # encoding, fileno, isatty and friends come from the original.
+        return getattr(self.original, name)
+
+def install_capture():
+    """Wraps sys.stdout and sys.stderr in routers, unless they already are.
+
+    Called whenever an OutputRedirect is entered, so a stream replaced by the
+    host in the meantime is wrapped again.
+    """
+    if not isinstance(sys.stdout, _StreamRouter):
+        sys.stdout = _StreamRouter(sys.stdout)
+    if not isinstance(sys.stderr, _StreamRouter):
+        sys.stderr = _StreamRouter(sys.stderr)
+
 class OutputRedirect(QtCore.QObject):
+    """Collects the stdout and stderr of threads running inside it.
+
+    Entering it captures the calling thread's output until it is exited,
+    other threads are unaffected.  Writers only ever append to a deque, the
+    text is collected and emitted through output by the thread the redirect
+    lives in, so a writer never waits on the GUI.
+    """
 
     output = QtCore.Signal(str)
+    _flushRequested = QtCore.Signal()
+    _drainRequested = QtCore.Signal()
 
-    def __init__(self, tee=True, parent=None):
+    def __init__(self, tee=True, parent=None, flushInterval=OUTPUT_FLUSH_INTERVAL, maxBufferSize=OUTPUT_BUFFER_SIZE):
         super(OutputRedirect, self).__init__(parent)
-        self._handle = None
         self._tee = tee
+        self._ownerThread = get_ident()
+
+        self._buffer = deque()
+        # Updated without a lock, so only a hint for when to drain early.
+        self._size = 0
+        self._pending = False
+        self._maxBufferSize = maxBufferSize
+        self._local = local()
+        self._flushes = 0
+        # The capture each thread inside the redirect replaced.
+        self._replaced = {}
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(flushInterval)
+        self._timer.timeout.connect(self._drain)
+        # Queued when emitted from another thread, so the timer is started and
+        # the buffer drained from the thread the redirect lives in.
+        self._flushRequested.connect(self._timer.start)
+        self._drainRequested.connect(self._drain)
 
     def __enter__(self):
-        self._handle = sys.stdout
-        sys.stdout = self
+        install_capture()
+        ident = get_ident()
+        self._replaced[ident] = _captures.get(ident)
+        _captures[ident] = self
         return self
 
     def __exit__(self, type, value, traceback):
-        sys.stdout = self._handle
-        
+        ident = get_ident()
+        try:
+            self.flush()
+        finally:
+            # Restored whatever happens, or the thread would keep writing
+            # here after the redirect's console is gone.
+            previous = self._replaced.pop(ident, None)
+            if previous is None:
+                _captures.pop(ident, None)
+            else:
+                _captures[ident] = previous
+
+    def tee(self):
+        return self._tee
+
+    def setTee(self, tee):
+        """Sets whether captured writes are also passed on to the original stream."""
+        self._tee = tee
 
-    def write(self, msg):
-        self.output.emit(msg)
-        if self._tee:
-            self._handle.write(msg)
-        
+    def flushInterval(self):
+        return self._timer.interval()
+
+    def setFlushInterval(self, msec):
+        self._timer.setInterval(msec)
+
+    def maxBufferSize(self):
+        return self._maxBufferSize
+
+    def setMaxBufferSize(self, size):
+        self._maxBufferSize = size
+
+    def counters(self):
+        """Returns the characters the calling thread wrote, and the flushes made so far."""
+        return getattr(self._local, 'written', 0), self._flushes
+
+    def write(self, msg, stream=None):
+        """Queues msg for output, and writes it to stream too if teeing."""
+        self._buffer.append(msg)
+        self._local.written = getattr(self._local, 'written', 0) + len(msg)
+        self._size += len(msg)
+        if self._size >= self._maxBufferSize:
+            self._size = 0
+            self._drainRequested.emit()
+        elif not self._pending:
+            self._pending = True
+            self._flushRequested.emit()
+        if self._tee and stream is not None:
+            stream.write(msg)
+
+    def flush(self):
+        """Emits everything written so far, or has it emitted soon if called from another thread."""
+        if get_ident() == self._ownerThread:
+            self._drain()
+        else:
+            self._drainRequested.emit()
+
+    def _drain(self):
+        self._pending = False
+        self._size = 0
+        chunks = []
+        size = 0
+        try:
+            while True:
+                msg = self._buffer.popleft()
+                # Writes are joined up to maxBufferSize characters, so only a
+                # single huge write makes a chunk bigger than that.
+                if chunks and size + len(msg) > self._maxBufferSize:
+                    self._flushes += 1
+                    self.output.emit(''.join(chunks))
+                    chunks = []
+                    size = 0
+                chunks.append(msg)
+                size += len(msg)
+        except IndexError:
+            pass
+        if chunks:
+            self._flushes += 1
+            self.output.emit(''.join(chunks))
+
+# How many tracebacks QtTermWidget keeps for the browser, and how many of the
+# newest keep their frames alive so locals can still be inspected.
+TRACEBACK_STORE_SIZE = 100
+TRACEBACK_FRAMES_KEPT = 10
+
+# Limits on what the traceback browser shows for a frame's locals.
+LOCALS_LIMIT = 200
+_localsRepr = Repr()
+_localsRepr.maxstring = 120
+_localsRepr.maxother = 120
+
+INTERACTIVE_FILENAME = '<interactive interpreter>'
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# How many execution records an entry widget keeps.
+EXECUTION_HISTORY_SIZE = 1000
+
+# How many profiling results QtTermWidget keeps, and how many rows of one are
+# shown inline in the results widget.
+PROFILE_STORE_SIZE = 20
+PROFILE_INLINE_ROWS = 10
+
+# Expression results kept for expanding to their full repr.
+DISPLAY_STORE_SIZE = 20
+
+# Milliseconds between steps of a console's event loop while it has tasks.
+TASK_STEP_MS = 10
+# Characters of a task's source %tasks shows.
+TASK_LABEL_CHARS = 60
+
+class StoredTraceback(object):
+    """A traceback kept for the browser.
+
+    Holds either a live traceback object or frames already extracted (as
+    (filename, lineno, name, line) tuples, like traceback.extract_tb), and
+    only formats them when asked.
+    """
+
+    def __init__(self, tb, excType=None, excValue=None, summary=None):
+        if isinstance(tb, list):
+            self._tb = None
+            self._frames = tb
+        else:
+            self._tb = tb
+            self._frames = None
+        self._excType = excType
+        self._excValue = excValue
+        self._summary = summary
+        self._source = None
+        self._sourceLines = None
+
+    def setSource(self, source, firstLine=0):
+        """Sets the interactive source the frames refer to."""
+        self._source = (source, firstLine) if source is not None else None
+        self._sourceLines = None
+
+    def summary(self):
+        """Returns the exception line, eg "ZeroDivisionError: division by zero"."""
+        if self._summary is None and self._excType is not None:
+            self._summary = traceback.format_exception_only(self._excType, self._excValue)[-1].strip()
+        return self._summary or "Error"
+
+    def hasLocals(self):
+        return self._tb is not None
+
+    def release(self):
+        """Drops the frame objects, keeping only what is needed to display them."""
+        self.frames()
+        self._tb = None
+
+    def _line(self, filename, lineno):
+        if filename != INTERACTIVE_FILENAME:
+            return linecache.getline(filename, lineno).strip()
+        if self._source is None:
+            return ''
+        if self._sourceLines is None:
+            source, firstLine = self._source
+            self._sourceLines = source.split('\n')
+            self._firstLine = firstLine
+        index = lineno - 1 - self._firstLine
+        if 0 <= index < len(self._sourceLines):
+            return self._sourceLines[index].strip()
+        return ''
+
+    def frames(self):
+        if self._frames is None:
+            self._frames = []
+            tb = self._tb
+            while tb is not None:
+                code = tb.tb_frame.f_code
+                self._frames.append((code.co_filename, tb.tb_lineno, code.co_name, None))
+                tb = tb.tb_next
+        frames = []
+        for filename, lineno, name, line in self._frames:
+            if not line:
+                line = self._line(filename, lineno)
+            frames.append((filename, lineno, name, line))
+        return frames
+
+    def locals(self, index):
+        """Returns (name, repr) pairs for the locals of frame index, with bounded reprs."""
+        tb = self._tb
+        for i in range(index):
+            if tb is None:
+                break
+            tb = tb.tb_next
+        if tb is None:
+            return []
+
+        values = []
+        for name, value in sorted(tb.tb_frame.f_locals.items())[:LOCALS_LIMIT]:
+            if name.startswith('__'):
+                continue
+            try:
+                text = _localsRepr.repr(value)
+            except Exception as e:
+                text = "<repr failed: {error}>".format(error=e)
+            values.append((name, text))
+        return values
+
+class QtTermExecutor(QtCore.QObject):
+    """Runs compiled code with its output sent through an OutputRedirect.
+
+    When threaded, code runs on a worker thread so the GUI stays responsive and
+    a run can be interrupted.  Given a pool.FairPool, it runs on the pool's
+    threads instead, taking turns with the pool's other executors.
+    Submissions made while busy are queued, or refused if queueing is turned
+    off.
+    """
+
+    busyChanged = QtCore.Signal(bool)
+    # Wall clock seconds a run took, emitted just before finished.
+    elapsed = QtCore.Signal(float)
+    # A dict of what was measured during a run, emitted just before finished.
+    # 'wallTime' and 'cpuTime' are seconds, 'outputChars' and 'flushes' count
+    # what went through the redirect, 'peakMemory' and 'netMemory' are bytes
+    # allocated, or None unless memory tracing is on.
+    measured = QtCore.Signal(object)
+    # Whatever a runner returned, emitted just before finished.
+    result = QtCore.Signal(object)
+    # A StoredTraceback for a failed run, or None.
+    finished = QtCore.Signal(object)
+    _done = QtCore.Signal(object)
+
+    def __init__(self, redirect, threaded=True, parent=None, pool=None):
+        super(QtTermExecutor, self).__init__(parent)
+        self._redirect = redirect
+        self._threaded = threaded or pool is not None
+        self._pool = pool
+        self._shutDown = False
+        self._queueing = True
+        self._outstanding = 0
+        self._traceMemory = False
+        self._startedTracing = False
+
+        self._lock = Lock()
+        self._jobs = queue.Queue()
+        self._worker = None
+        self._runningThread = None
+
+        self._done.connect(self._jobDone)
+
+    def isThreaded(self):
+        return self._threaded
+
+    def pool(self):
+        return self._pool
+
+    def isBusy(self):
+        return self._outstanding > 0
+
+    def queueing(self):
+        return self._queueing
+
+    def setQueueing(self, queueing):
+        self._queueing = queueing
+
+    def pending(self):
+        """Returns the number of submissions waiting behind the running one."""
+        return max(self._outstanding - 1, 0)
+
+    def traceMemory(self):
+        return self._traceMemory
+
+    def setTraceMemory(self, enabled):
+        """Measures memory allocated by each run with tracemalloc.
+
+        Tracing slows everything down, so it is off by default.  Returns False
+        if tracemalloc isn't available.
+        """
+        if tracemalloc is None:
+            return False
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracing = True
+        elif not enabled and self._startedTracing:
+            tracemalloc.stop()
+            self._startedTracing = False
+        self._traceMemory = enabled
+        return True
+
+    def submit(self, code, globals_, locals_, runner=None):
+        """Runs code, returns False if it was refused because a run is in progress.
+
+        If given, runner(code, globals_, locals_) is called to run the code
+        instead of exec, and anything it returns is emitted through result.
+        """
+        if self._shutDown or (self.isBusy() and not self._queueing):
+            return False
+
+        self._outstanding += 1
+        if self._outstanding == 1:
+            self.busyChanged.emit(True)
+
+        if not self._threaded:
+            self._done.emit(self._run(code, globals_, locals_, runner))
+            return True
+
+        if self._pool is not None:
+            self._pool.submit(self, lambda: self._runJob(code, globals_, locals_, runner))
+            return True
+
+        if self._worker is None:
+            self._worker = Thread(target=self._work, name='QtTermExecutor')
+            self._worker.daemon = True
+            self._worker.start()
+        self._jobs.put((code, globals_, locals_, runner))
+        return True
+
+    def interrupt(self):
+        """Raises KeyboardInterrupt in the running code.
+
+        The exception is delivered the next time the worker executes python
+        bytecode, so a blocking call has to return first.
+        """
+        with self._lock:
+            if self._runningThread is None:
+                return False
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_long(self._runningThread), ctypes.py_object(KeyboardInterrupt))
+            return True
+
+    def clearQueue(self):
+        """Drops submissions that haven't started yet."""
+        if self._pool is not None:
+            for i in range(self._pool.cancel(self)):
+                self._done.emit((None, {}, None))
+            return
+        while True:
+            try:
+                self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            self._done.emit((None, {}, None))
+
+    def _setRunning(self, ident):
+        with self._lock:
+            self._runningThread = ident
+
+    def _leaveUserCode(self):
+        """Stops interrupts reaching the calling thread once its run's code is done."""
+        while True:
+            try:
+                with self._lock:
+                    self._runningThread = None
+                    # No interrupt can be sent from here on, but one sent just
+                    # before would go off later, in the redirect's or the
+                    # pool's code.  It came too late, drop it.
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(get_ident()), None)
+                return
+            except KeyboardInterrupt:
+                # It went off before it could be dropped.
+                continue
+
+    def _run(self, code, globals_, locals_, runner):
+        tb = None
+        value = None
+        traceMemory = self._traceMemory and tracemalloc.is_tracing()
+        resetPeak = traceMemory and hasattr(tracemalloc, 'reset_peak')
+        if traceMemory:
+            memory = tracemalloc.get_traced_memory()[0]
+            if resetPeak:
+                tracemalloc.reset_peak()
+        written, flushes = self._redirect.counters()
+        cpu = _kernel.thread_cpu_time()
+        start = time.time()
+        try:
+            with self._redirect:
+                try:
+                    if self._threaded:
+                        self._setRunning(get_ident())
+                    if runner is None:
+                        exec(code, globals_, locals_)
+                    else:
+                        value = runner(code, globals_, locals_)
+                finally:
+                    if self._threaded:
+                        self._leaveUserCode()
+        except BaseException:
+            type_, value_, traceback_ = sys.exc_info()
+            # Skip this frame, it's the exec above.
+            traceback_ = traceback_.tb_next
+            # Runners add frames of their own before reaching the user's code.
+            while runner is not None and traceback_ is not None and \
+                    os.path.dirname(traceback_.tb_frame.f_code.co_filename) == _PACKAGE_DIR:
+                traceback_ = traceback_.tb_next
+            tb = StoredTraceback(traceback_, type_, value_)
+
+        measurement = {
+            'wallTime': time.time() - start,
+            'cpuTime': _kernel.thread_cpu_time() - cpu,
+            'peakMemory': None,
+            'netMemory': None,
+        }
+        measurement['outputChars'] = self._redirect.counters()[0] - written
+        # The count so far, _jobDone turns it into the run's flushes.
+        measurement['flushes'] = flushes
+        if traceMemory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            measurement['netMemory'] = current - memory
+            # Without reset_peak the peak could predate this run.
+            if resetPeak:
+                measurement['peakMemory'] = peak - memory
+        return tb, measurement, value
+
+    def shutdown(self):
+        """Drops queued submissions and lets the worker exit after the running one.
+
+        Nothing can be submitted afterwards.
+        """
+        self.clearQueue()
+        self._shutDown = True
+        if self._worker is not None:
+            self._jobs.put(None)
+
+    def _work(self):
+        while True:
+            try:
+                job = self._jobs.get()
+            except KeyboardInterrupt:
+                # An interrupt that landed just as the previous run finished.
+                continue
+            if job is None or not self._runJob(*job):
+                return
+
+    def _runJob(self, code, globals_, locals_, runner):
+        """Runs a submission on a worker.  Returns False if the executor is gone."""
+        result = (None, {}, None)
+        try:
+            result = self._run(code, globals_, locals_, runner)
+        finally:
+            try:
+                self._done.emit(result)
+            except RuntimeError:
+                # The executor was deleted along with its widget.
+                return False
+        return True
+
+    def _jobDone(self, result):
+        tb, measurement, value = result
+        self._outstanding -= 1
+        if 'flushes' in measurement:
+            # Leaving the redirect queued its last drain ahead of _done, so
+            # by now every flush of the run has been counted.
+            measurement['flushes'] = self._redirect.counters()[1] - measurement['flushes']
+        self.elapsed.emit(measurement.get('wallTime', 0.0))
+        self.measured.emit(measurement)
+        if value is not None:
+            self.result.emit(value)
+        self.finished.emit(tb)
+        if self._outstanding == 0:
+            self.busyChanged.emit(False)
+
+# Seconds QtTermKernel.shutdown waits for the child to exit before killing
+# it, a child busy running code never reads the request.
+KERNEL_SHUTDOWN_TIMEOUT = 2.0
+
+class QtTermKernel(QtCore.QObject):
+    """Runs code in a child interpreter, see qtterm.kernel.
+
+    Offers the same interface as QtTermExecutor, so either can drive an entry
+    widget.  The namespaces passed to submit are ignored, the child keeps its
+    own.  Output arrives through the redirect, and statsChanged reports the
+    child's memory and cpu use after every run.  An executable given in place
+    of sys.executable must be the same python version, see qtterm.kernel.
+    """
+
+    busyChanged = QtCore.Signal(bool)
+    elapsed = QtCore.Signal(float)
+    measured = QtCore.Signal(object)
+    result = QtCore.Signal(object)
+    finished = QtCore.Signal(object)
+    statsChanged = QtCore.Signal(object)
+    terminated = QtCore.Signal(int)
+    _message = QtCore.Signal(object)
+
+    def __init__(self, redirect, executable=None, parent=None):
+        super(QtTermKernel, self).__init__(parent)
+        self._redirect = redirect
+        # Hosts embedding python often have a sys.executable that isn't a
+        # python interpreter, so allow it to be given.
+        self._executable = executable or sys.executable
+        self._queueing = True
+        self._outstanding = 0
+        self._nextId = 0
+        self._process = None
+        self._stats = {}
+
+        self._message.connect(self._handleMessage)
+
+    def isBusy(self):
+        return self._outstanding > 0
+
+    def queueing(self):
+        return self._queueing
+
+    def setQueueing(self, queueing):
+        self._queueing = queueing
+
+    def pending(self):
+        return max(self._outstanding - 1, 0)
+
+    def isRunning(self):
+        return self._process is not None and self._process.poll() is None
+
+    def pid(self):
+        if self._process is None:
+            return None
+        return self._process.pid
+
+    def stats(self):
+        """Returns the child's last reported 'memory' in bytes and 'cpu' seconds."""
+        return dict(self._stats)
+
+    def start(self):
+        if self.isRunning():
+            return
+        script = os.path.splitext(_kernel.__file__)[0] + '.py'
+        options = {}
+        if hasattr(os, 'setpgrp'):
+            # Keep Ctrl+C in the host's terminal away from the kernel.
+            options['preexec_fn'] = os.setpgrp
+        self._process = subprocess.Popen(
+            [self._executable, '-u', script, _kernel.magic_hex()],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            **options
+        )
+        reader = Thread(target=self._read, args=(self._process,), name='QtTermKernel')
+        reader.daemon = True
+        reader.start()
+
+    def submit(self, code, globals_, locals_, runner=None):
+        # Runners are local callables, they can't be sent to the child.
+        if runner is not None:
+            return False
+        if self.isBusy() and not self._queueing:
+            return False
+        if not self.isRunning():
+            self.start()
+
+        self._nextId += 1
+        try:
+            _kernel.send_message(self._process.stdin, {
+                'op': 'execute',
+                'id': self._nextId,
+                'code': marshal.dumps(code),
+            })
+        except (IOError, OSError):
+            # The child died since isRunning() looked, the reader thread
+            # reports its exit code.
+            self._redirect.write("The kernel died before the code could be sent, it wasn't run\n")
+            return False
+        self._outstanding += 1
+        if self._outstanding == 1:
+            self.busyChanged.emit(True)
+        return True
+
+    def interrupt(self):
+        if not self.isBusy() or not self.isRunning():
+            return False
+        if os.name == 'nt':
+            # There is no way to deliver a KeyboardInterrupt to a windows
+            # child, restarting is the only option there.
+            return False
+        os.kill(self._process.pid, signal.SIGINT)
+        return True
+
+    def kill(self):
+        if self._process is None:
+            return
+        if self.isRunning():
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+        # Anything still queued died with the process.
+        if self._outstanding:
+            self._outstanding = 0
+            self.busyChanged.emit(False)
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def shutdown(self, timeout=KERNEL_SHUTDOWN_TIMEOUT):
+        """Asks the child to exit, killing it if it hasn't within timeout seconds."""
+        if self.isRunning():
+            try:
+                _kernel.send_message(self._process.stdin, {'op': 'shutdown'})
+            except (IOError, OSError):
+                # Already gone.
+                pass
+            # Polled, wait() takes no timeout on python 2.
+            end = time.time() + timeout
+            while self._process.poll() is None and time.time() < end:
+                time.sleep(0.01)
+        self.kill()
+
+    def _read(self, process):
+        try:
+            while True:
+                message = _kernel.recv_message(process.stdout)
+                if message is None:
+                    break
+                if message['op'] in ('stdout', 'stderr'):
+                    self._redirect.write(message['data'])
+                else:
+                    self._message.emit(message)
+            self._message.emit({'op': 'exit', 'process': process, 'code': process.wait()})
+        except RuntimeError:
+            # The kernel object was deleted along with its widget.
+            pass
+
+    def _handleMessage(self, message):
+        if message['op'] == 'done':
+            # The run's output was written from the reader thread first, make
+            # sure it reaches the results before any traceback does.
+            self._redirect.flush()
+            self._outstanding -= 1
+            self._stats = message['stats']
+            self.statsChanged.emit(self.stats())
+            self.elapsed.emit(message['elapsed'])
+            # Allocations in the child aren't traced.
+            self.measured.emit({
+                'wallTime': message['elapsed'],
+                'cpuTime': message['cpu'],
+                'peakMemory': None,
+                'netMemory': None,
+                'outputChars': message['outputChars'],
+                'flushes': message['flushes'],
+            })
+            tb = message['traceback']
+            if tb is not None:
+                tb = StoredTraceback(tb, summary=message['error'])
+            self.finished.emit(tb)
+            if self._outstanding == 0:
+                self.busyChanged.emit(False)
+
+        elif message['op'] == 'exit':
+            self._redirect.write("Kernel exited with code {code}\n".format(code=message['code']))
+            self._redirect.flush()
+            self.terminated.emit(message['code'])
+            if message['process'] is self._process:
+                self._process = None
+                if self._outstanding:
+                    self._outstanding = 0
+                    self.busyChanged.emit(False)
+
+# Block states carried from one block to the next by the highlighter.  Only
+# strings can span lines: triple quoted strings, and single quoted strings
+# continued with a trailing backslash.
+STATE_NORMAL = 0
+STATE_TRIPLE_SINGLE = 1
+STATE_TRIPLE_DOUBLE = 2
+STATE_SINGLE = 3
+STATE_DOUBLE = 4
+
+# Set on blocks in large documents whose formatting has been deferred.
+STATE_PENDING = 0x100
+
+# Documents with more blocks than this only highlight around the viewport and
+# finish the rest in idle time.
+LARGE_DOCUMENT_THRESHOLD = 20000
+
+# Time budget in milliseconds, and blocks per step, of each idle highlight pass.
+IDLE_SLICE_MS = 8
+IDLE_SLICE_BLOCKS = 200
+# Milliseconds between idle highlight passes, so they take about a third of
+# the GUI thread rather than all of it while a large document is pending.
+IDLE_INTERVAL_MS = 16
+
+LINE_NUMBER_CACHE_SIZE = 4096
+
+_STRING_STATES = {
+    "'''": STATE_TRIPLE_SINGLE,
+    '"""': STATE_TRIPLE_DOUBLE,
+    "'": STATE_SINGLE,
+    '"': STATE_DOUBLE,
+}
+_STATE_DELIMITERS = dict((v, k) for k, v in _STRING_STATES.items())
+
+# One scan over the block finds every token start; strings are then consumed
+# with the matching closing expression so quotes inside them are skipped.
+_TOKEN_RE = re.compile(r"""
+    (?P<comment>\#.*)
+  | (?P<string>(?:(?<!\w)[rRuUbB]{1,2})?(?:'''|\"\"\"|'|\"))
+  | (?P<number>(?<![\w.])(?:0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)[lLjJ]?)
+  | (?P<word>[A-Za-z_]\w*)
+""", re.VERBOSE)
+
+_DECORATOR_RE = re.compile(r"\s*(@[\w.]+)")
+
+_STRING_END_RE = {
+    "'": re.compile(r"(?:[^'\\]|\\.)*'"),
+    '"': re.compile(r'(?:[^"\\]|\\.)*"'),
+    "'''": re.compile(r"(?:[^\\]|\\.)*?'''"),
+    '"""': re.compile(r'(?:[^\\]|\\.)*?"""'),
+}
+
+_KEYWORDS = frozenset(pythonkeyword.kwlist)
+_BUILTINS = frozenset(dir(__builtin__))
+
+
+def _close_string(text, pos, delimiter):
+    """Returns the end of the string starting at pos, or -1 if it runs past the block."""
+    match = _STRING_END_RE[delimiter].match(text, pos)
+    if match:
+        return match.end()
+    return -1
+
+
+def _continues(text):
+    """Returns True if text ends in an unescaped backslash."""
+    stripped = text.rstrip('\\')
+    return (len(text) - len(stripped)) % 2 == 1
+
+
+def tokenize_block(text, state=STATE_NORMAL):
+    """Scans a single line of python source in one pass.
+
+    Returns a list of (start, length, kind) tuples, where kind is one of
+    'keyword', 'builtin', 'string', 'number', 'comment' or 'decorator', and the
+    state the following block starts in.
+    """
+    tokens = []
+    length = len(text)
+    pos = 0
+
+    if state != STATE_NORMAL:
+        delimiter = _STATE_DELIMITERS[state]
+        end = _close_string(text, 0, delimiter)
+        if end < 0:
+            tokens.append((0, length, 'string'))
+            if len(delimiter) == 3 or _continues(text):
+                return tokens, state
+            return tokens, STATE_NORMAL
+        tokens.append((0, end, 'string'))
+        pos = end
+    else:
+        match = _DECORATOR_RE.match(text)
+        if match:
+            tokens.append((match.start(1), match.end(1) - match.start(1), 'decorator'))
+            pos = match.end()
+
+    while pos < length:
+        match = _TOKEN_RE.search(text, pos)
+        if match is None:
+            break
+        kind = match.lastgroup
+        start = match.start()
+        pos = match.end()
+
+        if kind == 'word':
+            word = match.group()
+            if word in _KEYWORDS:
+                tokens.append((start, pos - start, 'keyword'))
+            elif word in _BUILTINS and (start == 0 or text[start - 1] != '.'):
+                tokens.append((start, pos - start, 'builtin'))
+        elif kind == 'string':
+            opener = match.group()
+            delimiter = opener.lstrip('rRuUbB')
+            end = _close_string(text, pos, delimiter)
+            if end < 0:
+                tokens.append((start, length - start, 'string'))
+                if len(delimiter) == 3 or _continues(text):
+                    return tokens, _STRING_STATES[delimiter]
+                return tokens, STATE_NORMAL
+            tokens.append((start, end - start, 'string'))
+            pos = end
+        else:
+            tokens.append((start, pos - start, kind))
+
+    return tokens, STATE_NORMAL
+
+
+def _scan_state(text, state):
+    """Returns the state following text without collecting any tokens."""
+    # Only triple quotes and trailing backslashes can carry a string onward.
+    if (state == STATE_NORMAL and "'''" not in text and '"""' not in text
+            and not text.endswith('\\')):
+        return STATE_NORMAL
+    return tokenize_block(text, state)[1]
+
+
+def _char_format(color, weight=None):
+    brush = QtGui.QBrush(color, QtCore.Qt.SolidPattern)
+    fmt = QtGui.QTextCharFormat()
+    fmt.setForeground(brush)
+    if weight is not None:
+        fmt.setFontWeight(weight)
+    return fmt
+
+
+# Built on first use, since formats need a running application, then shared
+# by every highlighter.
+_formats = {}
+
+def highlight_formats():
+    """Returns the process wide token kind to QTextCharFormat mapping.
+
+    It is shared, so treat it as read only; give a highlighter a copy in its
+    formats attribute to change its colours.
+    """
+    if not _formats:
+        _formats.update({
+            'builtin': _char_format(QtCore.Qt.darkGreen, QtGui.QFont.Bold),
+            'keyword': _char_format(QtCore.Qt.darkBlue, QtGui.QFont.Bold),
+            'comment': _char_format(QtGui.QColor.fromRgb(255,140,0), QtGui.QFont.Light),
+            'string': _char_format(QtCore.Qt.darkRed),
+            'number': _char_format(QtCore.Qt.darkCyan),
+            'decorator': _char_format(QtCore.Qt.darkMagenta),
+        })
+    return _formats
+
+# Shared formats for output, keyed by ansi.Style and built as styles are seen.
+_outputFormats = {}
+
+def output_format(style):
+    """Returns the QTextCharFormat output written in an ansi.Style is shown with."""
+    fmt = _outputFormats.get(style)
+    if fmt is None:
+        fmt = QtGui.QTextCharFormat()
+        foreground, background = style.foreground, style.background
+        if style.inverse:
+            foreground, background = background or (255, 255, 255), foreground or (0, 0, 0)
+        if foreground is not None:
+            fmt.setForeground(QtGui.QBrush(QtGui.QColor(*foreground), QtCore.Qt.SolidPattern))
+        if background is not None:
+            fmt.setBackground(QtGui.QBrush(QtGui.QColor(*background), QtCore.Qt.SolidPattern))
+        if style.bold:
+            fmt.setFontWeight(QtGui.QFont.Bold)
+        if style.italic:
+            fmt.setFontItalic(True)
+        if style.underline:
+            fmt.setFontUnderline(True)
+        _outputFormats[style] = fmt
+    return fmt
+
+def link_format(href, toolTip=None):
+    fmt = _char_format(QtCore.Qt.blue)
+    fmt.setAnchor(True)
+    fmt.setAnchorHref(href)
+    fmt.setFontUnderline(True)
+    if toolTip:
+        fmt.setToolTip(toolTip)
+    return fmt
 
-class HighlightRule(object):
-    def __init__(self, pattern, format):
-        self.pattern = pattern
-        self.format = format
 
 class PythonHighlighter(QtGui.QSyntaxHighlighter):
     def __init__(self, parent):
         super(PythonHighlighter, self).__init__(parent)
-        self.rules = []
-
-        brush = QtGui.QBrush(QtCore.Qt.darkGreen, QtCore.Qt.SolidPattern)
-        builtin = QtGui.QTextCharFormat()
-        builtin.setForeground(brush)
-        builtin.setFontWeight(QtGui.QFont.Bold)
-        builtins = dir(__builtin__)
-
-        for word in builtins:
-            pattern = QtCore.QRegExp("\\b{w}\\b".format(w=word))
-            rule = HighlightRule(pattern, builtin)
-            self.rules.append(rule)
-
-        brush = QtGui.QBrush( QtCore.Qt.darkBlue, QtCore.Qt.SolidPattern)
-        keyword = QtGui.QTextCharFormat()
-        keyword.setForeground(brush)
-        keyword.setFontWeight(QtGui.QFont.Bold)
-        keywords = pythonkeyword.kwlist
-
-        for word in keywords:
-            pattern = QtCore.QRegExp("\\b{w}\\b".format(w=word))
-            rule = HighlightRule(pattern, keyword)
-            self.rules.append(rule)
-
-        brush = QtGui.QBrush(QtGui.QColor.fromRgb(255,140,0),QtCore.Qt.SolidPattern)
-        pattern = QtCore.QRegExp( "#[^\n]*")
-        comment = QtGui.QTextCharFormat()
-        comment.setForeground(brush)
-        comment.setFontWeight(QtGui.QFont.Light)
-        rule = HighlightRule(pattern, comment)
-        self.rules.append(rule)
+
+        self.formats = highlight_formats()
+
+        self.largeDocumentThreshold = LARGE_DOCUMENT_THRESHOLD
+        self._editor = parent
+        self._window = (0, IDLE_SLICE_BLOCKS)
+        self._slice = None
+        self._formatting = False
+        self._idleBlock = -1
+
+        self._idleTimer = QtCore.QTimer(self)
+        self._idleTimer.setInterval(IDLE_INTERVAL_MS)
+        self._idleTimer.timeout.connect(self._highlightIdleSlice)
 
         self.setDocument(parent.document())
 
+    def isLazy(self):
+        document = self.document()
+        return document is not None and document.blockCount() > self.largeDocumentThreshold
+
+    def window(self):
+        return self._window
+
+    def highlightRange(self, first, last):
+        """Makes blocks first through last the formatted window and formats any still pending."""
+        self._window = (first, last)
+        document = self.document()
+        if document is None:
+            return
+        if self._formatting:
+            # Re-layout while formatting can scroll the viewport, leave the
+            # new window to the idle pass rather than recursing.
+            self._deferBlock(first)
+        else:
+            self._formatPending(document.findBlockByNumber(first), last)
+
+    def _inWindow(self, number):
+        first, last = self._window
+        if first <= number <= last:
+            return True
+        return self._slice is not None and self._slice[0] <= number <= self._slice[1]
+
+    def _formatPending(self, block, last):
+        self._formatting = True
+        try:
+            while block.isValid() and block.blockNumber() <= last:
+                if block.userState() > 0 and block.userState() & STATE_PENDING:
+                    self.rehighlightBlock(block)
+                block = block.next()
+        finally:
+            self._formatting = False
+        return block
+
+    def _deferBlock(self, number):
+        if self._idleBlock < 0 or number < self._idleBlock:
+            self._idleBlock = number
+        if not self._idleTimer.isActive():
+            self._idleTimer.start()
+
+    def _highlightIdleSlice(self):
+        document = self.document()
+        if document is None or self._idleBlock < 0:
+            self._idleTimer.stop()
+            return
+
+        elapsed = QtCore.QElapsedTimer()
+        elapsed.start()
+        block = document.findBlockByNumber(self._idleBlock)
+        try:
+            while block.isValid() and elapsed.elapsed() < IDLE_SLICE_MS:
+                last = block.blockNumber() + IDLE_SLICE_BLOCKS
+                self._slice = (block.blockNumber(), last)
+                block = self._formatPending(block, last)
+        finally:
+            self._slice = None
+
+        if block.isValid():
+            self._idleBlock = block.blockNumber()
+        else:
+            self._idleBlock = -1
+            self._idleTimer.stop()
+
     def highlightBlock(self, text):
-        for rule in self.rules:
-            expression = QtCore.QRegExp(rule.pattern)
-            index = expression.indexIn(text)
-            while index>=0:
-                length = expression.matchedLength()
-                self.setFormat(index, length, rule.format)
-                index = expression.indexIn(text, index+length)
-        self.setCurrentBlockState(0)
-            
+        state = max(self.previousBlockState(), STATE_NORMAL) & ~STATE_PENDING
+
+        if self.isLazy():
+            number = self.currentBlock().blockNumber()
+            if not self._inWindow(number):
+                # Away from the viewport only the string state is tracked, the
+                # formatting is filled in by the idle pass or when scrolled to.
+                self.setCurrentBlockState(_scan_state(text, state) | STATE_PENDING)
+                self._deferBlock(number)
+                return
+
+        # Qt only moves on to the next block when the state we set here differs
+        # from the one it had before, so an edit stops re-highlighting as soon
+        # as the string state settles.
+        tokens, state = tokenize_block(text, state)
+        formats = self.formats
+        for start, length, kind in tokens:
+            self.setFormat(start, length, formats[kind])
+        self.setCurrentBlockState(state)
+
+# Milliseconds of quiet after an edit before the buffer is syntax checked.
+SYNTAX_CHECK_DELAY = 400
+SYNTAX_CACHE_SIZE = 64
+
+class SyntaxChecker(QtCore.QObject):
+    """Parses sources on a worker thread.
+
+    Only the newest source handed to check() is parsed; older ones still
+    waiting are dropped.  checked reports the revision along with a (line,
+    column, message) tuple, or None if it parsed cleanly.  Results are cached
+    by source hash so text seen before is never parsed again.
+    """
+
+    checked = QtCore.Signal(int, object)
+
+    def __init__(self, parent=None):
+        super(SyntaxChecker, self).__init__(parent)
+        self._lock = Lock()
+        self._wake = Event()
+        self._request = None
+        self._results = OrderedDict()
+        self._worker = None
+        self._stopped = False
+
+    def stop(self):
+        """Stops the worker thread, once it has finished what it is parsing."""
+        with self._lock:
+            self._stopped = True
+            self._request = None
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def check(self, revision, source):
+        key = source_key(source)
+        with self._lock:
+            if self._stopped:
+                return
+            if key in self._results:
+                error = self._results[key]
+                self._request = None
+                self.checked.emit(revision, error)
+                return
+            self._request = (revision, key, source)
+        if self._worker is None:
+            self._worker = Thread(target=self._work, name='SyntaxChecker')
+            self._worker.daemon = True
+            self._worker.start()
+        self._wake.set()
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if self._stopped:
+                    return
+                self._wake.clear()
+                request, self._request = self._request, None
+            if request is None:
+                continue
+
+            revision, key, source = request
+            error = None
+            try:
+                compile(source, INTERACTIVE_FILENAME, 'exec', ast.PyCF_ONLY_AST)
+            except SyntaxError as e:
+                error = (e.lineno or 1, e.offset or 0, e.msg)
+            except (TypeError, ValueError) as e:
+                error = (1, 0, str(e))
+
+            with self._lock:
+                self._results[key] = error
+                while len(self._results) > SYNTAX_CACHE_SIZE:
+                    self._results.popitem(last=False)
+                # A newer revision is waiting, this result is already stale.
+                if self._request is not None:
+                    continue
+            try:
+                self.checked.emit(revision, error)
+            except RuntimeError:
+                # The checker was deleted along with its widget.
+                return
+
+class SymbolIndexer(QtCore.QObject):
+    """Keeps a SymbolIndex up to date on a worker thread.
+
+    indexed reports a dotted path once its attributes can be completed, or
+    '' once top level names have been refreshed.  Requests already waiting
+    are not queued twice.
+    """
+
+    indexed = QtCore.Signal(str)
+
+    def __init__(self, namespaces=(), parent=None):
+        super(SymbolIndexer, self).__init__(parent)
+        self.index = SymbolIndex(namespaces)
+        self._lock = Lock()
+        self._wake = Event()
+        self._requests = []
+        self._worker = None
+        self._stopped = False
+
+    def stop(self):
+        """Stops the worker thread, once it has finished what it is indexing."""
+        with self._lock:
+            self._stopped = True
+            self._requests = []
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def _request(self, request):
+        with self._lock:
+            if self._stopped or request in self._requests:
+                return
+            self._requests.append(request)
+        if self._worker is None:
+            self._worker = Thread(target=self._work, name='SymbolIndexer')
+            self._worker.daemon = True
+            self._worker.start()
+        self._wake.set()
+
+    def refresh(self):
+        self._request('')
+
+    def indexAttributes(self, path):
+        self._request(path)
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if self._stopped:
+                    return
+                self._wake.clear()
+                requests, self._requests = self._requests, []
+            for path in requests:
+                if not path:
+                    self.index.refresh()
+                elif not self.index.index(path):
+                    continue
+                try:
+                    self.indexed.emit(path)
+                except RuntimeError:
+                    # The indexer was deleted along with its widget.
+                    return
+
+class _MeasuredCoroutine(object):
+    """Wraps a task's coroutine, adding up the cpu time and output of its steps.
+
+    Tasks interleave on one thread, so each is measured only while it runs.
+    """
+
+    def __init__(self, coroutine, redirect):
+        self._coroutine = coroutine
+        self._redirect = redirect
+        self.cpuTime = 0.0
+        self.outputChars = 0
+
+    def _step(self, method, *args):
+        written = self._redirect.counters()[0]
+        cpu = _kernel.thread_cpu_time()
+        try:
+            return method(*args)
+        finally:
+            self.cpuTime += _kernel.thread_cpu_time() - cpu
+            self.outputChars += self._redirect.counters()[0] - written
+
+    def send(self, value):
+        return self._step(self._coroutine.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coroutine.throw, *args)
+
+    def close(self):
+        return self._coroutine.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+class QtTermTaskLoop(QtCore.QObject):
+    """Runs a console's asyncio tasks from the Qt event loop, see qtterm.tasks.
+
+    While there are tasks a timer steps the loop, running whatever is ready
+    without waiting for I/O, with output going to the console's redirect.
+    If the thread already has a running loop, eg one installed by an asyncio
+    Qt integration, tasks go there instead and are never stepped.
+    """
+
+    # The number of pending tasks.
+    changed = QtCore.Signal(int)
+    # The number of a finished task, the task, and what was measured while it
+    # ran as QtTermExecutor.measured has it.
+    taskDone = QtCore.Signal(int, object, object)
+
+    def __init__(self, redirect, parent=None):
+        super(QtTermTaskLoop, self).__init__(parent)
+        self._redirect = redirect
+        self._loop = None
+        self.tasks = _tasks.TaskTable()
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(TASK_STEP_MS)
+        self._timer.timeout.connect(self._step)
+
+    def loop(self):
+        if self._loop is None:
+            try:
+                self._loop = _tasks.asyncio.get_running_loop()
+            except RuntimeError:
+                self._loop = _tasks.asyncio.new_event_loop()
+        return self._loop
+
+    def start(self, coroutine, label):
+        """Wraps coroutine in a task and returns the task's number."""
+        loop = self.loop()
+        measured = _MeasuredCoroutine(coroutine, self._redirect)
+        task = loop.create_task(measured)
+        number = self.tasks.add(task, label)
+        start, flushes = time.time(), self._redirect.counters()[1]
+        task.add_done_callback(lambda task: self._done(number, task, measured, start, flushes))
+        if not loop.is_running():
+            self._timer.start()
+        self.changed.emit(len(self.tasks.pending()))
+        return number
+
+    def _done(self, number, task, measured, start, flushes):
+        self.tasks.discard(number)
+        # Drained first so the task's last output counts as flushed.
+        self._redirect.flush()
+        self.taskDone.emit(number, task, {
+            'wallTime': time.time() - start,
+            'cpuTime': measured.cpuTime,
+            # Other tasks allocate in between, so memory isn't attributed.
+            'peakMemory': None,
+            'netMemory': None,
+            'outputChars': measured.outputChars,
+            'flushes': self._redirect.counters()[1] - flushes,
+        })
+        self.changed.emit(len(self.tasks.pending()))
+
+    def _step(self):
+        loop = self._loop
+        if loop.is_running():
+            self._timer.stop()
+            return
+        with self._redirect:
+            # stop() is queued behind what is ready now, so this returns
+            # without blocking once those callbacks have run.
+            loop.call_soon(loop.stop)
+            loop.run_forever()
+        # Finished tasks stay in the table until their done callback has
+        # run, which can take another step.
+        if not self.tasks and not _tasks.asyncio.all_tasks(loop):
+            self._timer.stop()
+
 class QtTermEntryLineNumberWidget(QtGui.QWidget):
     def __init__(self, parent):
         super(QtTermEntryLineNumberWidget, self).__init__(parent)
@@ -147,24 +1432,245 @@ class QtTermEntryLineNumberWidget(QtGui.QWidget):
     def paintEvent(self, event):
         self._editor.lineNumberAreaPaintEvent(event)
 
+# Files are read LOAD_CHUNK_SIZE bytes at a time and appended to the entry
+# widget for at most LOAD_SLICE_MS milliseconds per event loop pass.
+LOAD_CHUNK_SIZE = 1 << 16
+LOAD_SLICE_MS = 10
+
+class QtTermFileLoader(QtCore.QObject):
+    """Appends a file to an editor's document without blocking the GUI.
+
+    A worker thread reads and decodes the file, and the text is inserted in
+    time limited batches from the event loop.
+    """
+
+    # Bytes inserted so far and the file's size.
+    progress = QtCore.Signal(int, int)
+    # True if the whole file was loaded.
+    finished = QtCore.Signal(bool)
+    _chunk = QtCore.Signal(object)
+
+    def __init__(self, path, editor, encoding='utf-8', parent=None):
+        super(QtTermFileLoader, self).__init__(parent)
+        self.path = path
+        self.error = None
+        self._editor = editor
+        self._encoding = encoding
+        self._cancelled = Event()
+        self._pending = deque()
+        self._loaded = 0
+        self._total = 0
+        self._done = False
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._insertSlice)
+        self._chunk.connect(self._queueChunk)
+
+    def isDone(self):
+        return self._done
+
+    def start(self):
+        try:
+            self._total = os.path.getsize(self.path)
+        except (IOError, OSError) as e:
+            self._queueChunk(e)
+            return
+        reader = Thread(target=self._read, name='QtTermFileLoader')
+        reader.daemon = True
+        reader.start()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._finish(False)
+
+    def _read(self):
+        decoder = codecs.getincrementaldecoder(self._encoding)(errors='replace')
+        carry = ''
+        try:
+            try:
+                with open(self.path, 'rb') as handle:
+                    while not self._cancelled.is_set():
+                        data = handle.read(LOAD_CHUNK_SIZE)
+                        text = carry + decoder.decode(data, not data)
+                        # Hold back a trailing \r in case its \n starts the next chunk.
+                        carry = '\r' if data and text.endswith('\r') else ''
+                        if carry:
+                            text = text[:-1]
+                        self._chunk.emit((text.replace('\r\n', '\n'), len(data)))
+                        if not data:
+                            break
+            except (IOError, OSError) as e:
+                self._chunk.emit(e)
+        except RuntimeError:
+            # The loader was deleted along with its editor.
+            pass
+
+    def _queueChunk(self, chunk):
+        if self._done:
+            return
+        self._pending.append(chunk)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _insertSlice(self):
+        cursor = QtGui.QTextCursor(self._editor.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        elapsed = QtCore.QElapsedTimer()
+        elapsed.start()
+        while self._pending and elapsed.elapsed() < LOAD_SLICE_MS:
+            chunk = self._pending.popleft()
+            if isinstance(chunk, EnvironmentError):
+                self.error = chunk
+                self._finish(False)
+                return
+            text, size = chunk
+            cursor.insertText(text)
+            self._loaded += size
+            if not size:
+                self._finish(True)
+                return
+        self.progress.emit(self._loaded, self._total)
+        if not self._pending:
+            self._timer.stop()
+
+    def _finish(self, completed):
+        if self._done:
+            return
+        self._done = True
+        self._timer.stop()
+        self._pending.clear()
+        self.progress.emit(self._loaded, self._total)
+        self.finished.emit(completed)
+
+class HistorySearcher(QtCore.QObject):
+    """Searches history on a worker thread.
+
+    Substring search scans the whole history, so only the newest request
+    handed to search() runs; one still running is cancelled and older ones
+    waiting are dropped.  found reports the request number along with the
+    matching entry number, or -1.
+    """
+
+    found = QtCore.Signal(int, object)
+
+    def __init__(self, parent=None):
+        super(HistorySearcher, self).__init__(parent)
+        self._lock = Lock()
+        self._wake = Event()
+        self._request = None
+        self._worker = None
+        self._stopped = False
+
+    def stop(self):
+        """Stops the worker thread, cancelling what it is searching."""
+        with self._lock:
+            self._stopped = True
+            self._request = None
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def search(self, request, history, text, before=None):
+        with self._lock:
+            if self._stopped:
+                return
+            self._request = (request, history, text, before)
+        if self._worker is None:
+            self._worker = Thread(target=self._work, name='HistorySearcher')
+            self._worker.daemon = True
+            self._worker.start()
+        self._wake.set()
+
+    def _superseded(self):
+        return self._stopped or self._request is not None
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if self._stopped:
+                    return
+                self._wake.clear()
+                request, self._request = self._request, None
+            if request is None:
+                continue
+
+            number, history, text, before = request
+            match = history.search(text, before, self._superseded)
+            if match is None:
+                continue
+            try:
+                self.found.emit(number, match)
+            except RuntimeError:
+                # The searcher was deleted along with its widget.
+                return
+
+class QtTermHistorySearch(QtGui.QLineEdit):
+    """The reverse incremental search bar shown over the entry widget by Ctrl+R."""
+
+    older = QtCore.Signal()
+    accepted = QtCore.Signal()
+    cancelled = QtCore.Signal()
+
+    def __init__(self, parent=None):
+        super(QtTermHistorySearch, self).__init__(parent)
+        self.setPlaceholderText("reverse-i-search")
+        self.hide()
+
+    def keyPressEvent(self, event):
+        if event.key() in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter):
+            self.accepted.emit()
+        elif event.key() == QtCore.Qt.Key_Escape:
+            self.cancelled.emit()
+        elif event.key() == QtCore.Qt.Key_R and event.modifiers() & QtCore.Qt.ControlModifier:
+            self.older.emit()
+        else:
+            super(QtTermHistorySearch, self).keyPressEvent(event)
+
+    def focusOutEvent(self, event):
+        super(QtTermHistorySearch, self).focusOutEvent(event)
+        if self.isVisible():
+            self.accepted.emit()
+
 class QtTermEntryWidget(QtGui.QPlainTextEdit):
 
     traceback = QtCore.Signal(int)
     syntaxError = QtCore.Signal(int)
+    # The label of a finished cell and its wall clock seconds.
+    cellFinished = QtCore.Signal(str, float)
+    # The index of a profiling result stored in the QtTermWidget.
+    profile = QtCore.Signal(int)
+    # The index of an expression result stored in the QtTermWidget.
+    display = QtCore.Signal(int)
+    # The record of every finished run, see executionHistory.
+    executed = QtCore.Signal(object)
+    # The number of tasks started with top-level await that are still running.
+    tasksChanged = QtCore.Signal(int)
+    # Bytes loaded and total size of the file being loaded.
+    loadProgress = QtCore.Signal(int, int)
+    # The path of a finished load and whether it completed.
+    loadFinished = QtCore.Signal(str, bool)
 
     def __init__(self, parent=None):
         super(QtTermEntryWidget, self).__init__(parent)
 
         self._termWidget = parent
+        self._lineNumberGlyphs = {}
+        self._currentLineSelections = []
+        self._errorSelections = []
         font = QtGui.QFont("Monaco")
         font.setStyleHint(font.TypeWriter, font.PreferDefault)
         self.setFont(font)
 
         self._lineNumber = QtTermEntryLineNumberWidget(self)
-        self._highlighter = PythonHighlighter(self)
+        # Created on first show, hidden consoles never pay for highlighting.
+        self._highlighter = None
+        self._largeDocumentThreshold = LARGE_DOCUMENT_THRESHOLD
 
         self.blockCountChanged.connect(self.updateLineNumberAreaWidth)
         self.updateRequest.connect(self.updateLineNumberArea)
+        self.updateRequest.connect(self.updateHighlightWindow)
         self.cursorPositionChanged.connect(self.highlightCurrentLine)
 
         self.updateLineNumberAreaWidth(0);
@@ -175,13 +1681,145 @@ class QtTermEntryWidget(QtGui.QPlainTextEdit):
         self.executeAction.triggered.connect(self.execute)
         self.addAction(self.executeAction)
 
+        self.runCellAction = QtGui.QAction('Run Cell', self)
+        self.runCellAction.setShortcut(QtGui.QKeySequence("Ctrl+Shift+Return"))
+        self.runCellAction.triggered.connect(self.runCell)
+        self.addAction(self.runCellAction)
+
+        self.runSelectionAction = QtGui.QAction('Run Selection', self)
+        self.runSelectionAction.setShortcut(QtGui.QKeySequence("F9"))
+        self.runSelectionAction.triggered.connect(self.runSelection)
+        self.addAction(self.runSelectionAction)
+
+        self.runChangedCellsAction = QtGui.QAction('Run Changed Cells', self)
+        self.runChangedCellsAction.setShortcut(QtGui.QKeySequence("Ctrl+Alt+Return"))
+        self.runChangedCellsAction.triggered.connect(self.runChangedCells)
+        self.addAction(self.runChangedCellsAction)
+
+        self.interruptAction = QtGui.QAction('Interrupt Python', self)
+        self.interruptAction.setShortcut(QtGui.QKeySequence("Ctrl+Shift+C"))
+        self.interruptAction.setEnabled(False)
+        self.addAction(self.interruptAction)
+
         self.syntaxError.connect(self.displaySyntaxError)
 
+        self._checkedRevision = -1
+        self._syntaxChecker = SyntaxChecker(self)
+        self._syntaxChecker.checked.connect(self.handleSyntaxCheck)
+        self._syntaxTimer = QtCore.QTimer(self)
+        self._syntaxTimer.setSingleShot(True)
+        self._syntaxTimer.setInterval(SYNTAX_CHECK_DELAY)
+        self._syntaxTimer.timeout.connect(self.checkSyntax)
+        self.textChanged.connect(self._syntaxTimer.start)
+
         self.stdoutRedirect = OutputRedirect()
 
+        self._codeCache = CodeCache()
+        # Keys of cells whose last run succeeded, for runChangedCells.
+        self._executedCells = set()
+        # (label, cell key, source, first line, compile seconds) of every
+        # submission still waiting for finished.
+        self._submissions = deque()
+        self._measurement = {}
+        self._executionHistory = deque(maxlen=EXECUTION_HISTORY_SIZE)
+
+        # Code sees this module's globals unless given a namespace of its own.
+        self._globals = globals()
         self._locals = {}
-
-    def displaySyntaxError(self, line):
+        # Sets _ in the console's namespace rather than in builtins.
+        self._displayHook = _display.DisplayHook(self._locals)
+
+        self._asyncMode = bool(_tasks.TOP_LEVEL_AWAIT)
+        self._taskLoop = None
+        # {task number: (source, first line)} for tracebacks.
+        self._taskSources = {}
+
+        self._symbols = SymbolIndexer(parent=self)
+        self._symbols.indexed.connect(self._symbolsIndexed)
+        self.executed.connect(self._refreshSymbols)
+
+        self.executor = None
+        self.setExecutor(QtTermExecutor(self.stdoutRedirect, parent=self))
+
+        self._history = None
+        # Recall state: the matching entry numbers, the position in them, the
+        # store generation they belong to and the buffer before recall began.
+        self._historyMatches = None
+        self._historyPosition = 0
+        self._historyGeneration = 0
+        self._historyDraft = ''
+        self._historyPrefix = 0
+        self._recalling = False
+        self.textChanged.connect(self._editedDuringRecall)
+
+        self._historySearch = QtTermHistorySearch(self)
+        self._historySearch.textEdited.connect(self._searchHistory)
+        self._historySearch.older.connect(self._searchOlder)
+        self._historySearch.accepted.connect(self._endHistorySearch)
+        self._historySearch.cancelled.connect(self._cancelHistorySearch)
+        self._searchMatch = -1
+        # The number of the newest search and whether it looks further back
+        # than the match shown, results of any other search are stale.
+        self._searchRequest = 0
+        self._searchingOlder = False
+        self._searcher = HistorySearcher(self)
+        self._searcher.found.connect(self.handleSearchResult)
+
+        self._loader = None
+
+        self.loadFileAction = QtGui.QAction('Load File...', self)
+        self.loadFileAction.setShortcut(QtGui.QKeySequence("Ctrl+O"))
+        self.loadFileAction.triggered.connect(self.openFile)
+        self.addAction(self.loadFileAction)
+
+        self.runFileAction = QtGui.QAction('Run File...', self)
+        self.runFileAction.setShortcut(QtGui.QKeySequence("Ctrl+Shift+O"))
+        self.runFileAction.triggered.connect(self.openAndRunFile)
+        self.addAction(self.runFileAction)
+
+        # The dotted path whose attributes are awaited for the popup.
+        self._completionPath = None
+        # Created by the first completion.
+        self._completer = None
+        self._symbolsStale = True
+
+        self.completeAction = QtGui.QAction('Complete', self)
+        self.completeAction.setShortcut(QtGui.QKeySequence("Ctrl+Space"))
+        self.completeAction.triggered.connect(self.complete)
+        self.addAction(self.completeAction)
+
+        self.searchHistoryAction = QtGui.QAction('Search History', self)
+        self.searchHistoryAction.setShortcut(QtGui.QKeySequence("Ctrl+R"))
+        self.searchHistoryAction.triggered.connect(self.searchHistory)
+        self.addAction(self.searchHistoryAction)
+
+    def shutdown(self):
+        """Stops the syntax checker's, symbol indexer's and history searcher's worker threads."""
+        self._syntaxTimer.stop()
+        self._syntaxChecker.stop()
+        self._symbols.stop()
+        self._searcher.stop()
+
+    def setExecutor(self, executor):
+        """Runs code with executor, a QtTermExecutor or QtTermKernel."""
+        if self.executor is not None:
+            self.executor.finished.disconnect(self.executionFinished)
+            self.executor.result.disconnect(self.executionResult)
+            self.executor.measured.disconnect(self._setMeasurement)
+            self.executor.busyChanged.disconnect(self.interruptAction.setEnabled)
+            self.interruptAction.triggered.disconnect(self.executor.interrupt)
+
+        self.executor = executor
+        self._submissions.clear()
+        self._updateCompletionNamespaces()
+        self.executor.finished.connect(self.executionFinished)
+        self.executor.result.connect(self.executionResult)
+        self.executor.measured.connect(self._setMeasurement)
+        self.executor.busyChanged.connect(self.interruptAction.setEnabled)
+        self.interruptAction.triggered.connect(self.executor.interrupt)
+        self.interruptAction.setEnabled(self.executor.isBusy())
+
+    def displaySyntaxError(self, line, column=0, message=None):
 
         sel = QtGui.QTextEdit.ExtraSelection()
         lineColor = QtGui.QColor(QtCore.Qt.red).lighter(150)
@@ -190,32 +1828,629 @@ class QtTermEntryWidget(QtGui.QPlainTextEdit):
         sel.cursor = QtGui.QTextCursor(self.document())
         sel.cursor.movePosition(sel.cursor.NextBlock, QtGui.QTextCursor.MoveAnchor, line-1)
         sel.cursor.clearSelection()
-        extraSelections = [sel]
+        self._errorSelections = [sel]
+
+        if column:
+            mark = QtGui.QTextEdit.ExtraSelection()
+            mark.format.setUnderlineColor(QtCore.Qt.red)
+            mark.format.setUnderlineStyle(QtGui.QTextCharFormat.WaveUnderline)
+            mark.cursor = QtGui.QTextCursor(sel.cursor)
+            mark.cursor.movePosition(QtGui.QTextCursor.Right, QtGui.QTextCursor.MoveAnchor, column-1)
+            mark.cursor.movePosition(QtGui.QTextCursor.Right, QtGui.QTextCursor.KeepAnchor)
+            self._errorSelections.append(mark)
+
+        if message:
+            self.viewport().setToolTip("Line {line}: {message}".format(line=line, message=message))
+
+        self.setExtraSelections(self._currentLineSelections + self._errorSelections)
+
+    def clearSyntaxError(self):
+        self._errorSelections = []
+        self.viewport().setToolTip('')
+        self.setExtraSelections(self._currentLineSelections)
+
+    def checkSyntax(self):
+        revision = self.document().revision()
+        if revision != self._checkedRevision:
+            self._checkedRevision = revision
+            self._syntaxChecker.check(revision, self.toPlainText())
+
+    def handleSyntaxCheck(self, revision, error):
+        # Anything typed since is already on its way to the checker.
+        if revision != self.document().revision():
+            return
+        if error is None:
+            self.clearSyntaxError()
+        else:
+            self.displaySyntaxError(*error)
 
-        self.setExtraSelections(extraSelections)
+    def codeCache(self):
+        return self._codeCache
 
     def execute(self):
-        script = self.toPlainText()
+        source = self.toPlainText()
+        if self.runSource(source) and self._history is not None and source.strip():
+            self._history.append(source)
+        self._historyMatches = None
+
+    def _chooseFile(self, caption):
+        path = QtGui.QFileDialog.getOpenFileName(self, caption, "", "Python (*.py);;All Files (*)")
+        # PySide returns (path, filter), PyQt4 just the path.
+        if isinstance(path, tuple):
+            path = path[0]
+        return path
+
+    def openFile(self):
+        path = self._chooseFile("Load File")
+        if path:
+            self.loadFile(path)
+
+    def openAndRunFile(self):
+        path = self._chooseFile("Run File")
+        if path:
+            self.runFile(path)
+
+    def isLoading(self):
+        return self._loader is not None
+
+    def loadFile(self, path, encoding='utf-8'):
+        """Replaces the buffer with the file at path, read in the background.
+
+        The buffer is read only and unhighlighted until loading finishes or
+        is cancelled.  Returns the QtTermFileLoader.
+        """
+        self.cancelLoad()
+        self.clear()
+        self.setReadOnly(True)
+        self.document().setUndoRedoEnabled(False)
+        if self._highlighter is not None:
+            self._highlighter.setDocument(None)
+
+        self._loader = QtTermFileLoader(path, self, encoding, parent=self)
+        self._loader.progress.connect(self.loadProgress)
+        self._loader.finished.connect(self._loadFinished)
+        self._loader.start()
+        return self._loader
+
+    def cancelLoad(self):
+        if self._loader is not None:
+            self._loader.cancel()
+
+    def _loadFinished(self, completed):
+        loader, self._loader = self._loader, None
+        if self._highlighter is not None:
+            self._highlighter.setDocument(self.document())
+        self.document().setUndoRedoEnabled(True)
+        self.setReadOnly(False)
+        self.moveCursor(QtGui.QTextCursor.Start)
+        if loader.error is not None:
+            self.stdoutRedirect.write("Couldn't load {path}: {error}\n".format(path=loader.path, error=loader.error))
+        self.loadFinished.emit(loader.path, completed)
+        loader.deleteLater()
+
+    def runFile(self, path):
+        """Runs the file at path without loading it into the buffer.
+
+        The compiled code is cached until the file changes.  Returns False if
+        the file couldn't be read or compiled, or the executor refused it.
+        """
+        label = os.path.basename(path)
+        codeCache = self._codeCache
+
+        if isinstance(self.executor, QtTermKernel):
+            try:
+                code = codeCache.compileFile(path)
+            except (IOError, OSError, SyntaxError) as e:
+                self.stdoutRedirect.write("Couldn't run {path}: {error}\n".format(path=path, error=e))
+                return False
+            runner = None
+        else:
+            # Reading and compiling a large file happens on the executor's thread.
+            code = compile('', path, 'exec')
+
+            def runner(code, globals_, locals_):
+                exec(codeCache.compileFile(path), globals_, locals_)
+
+        self._submissions.append((label, None, None, 0, 0.0))
+        if not self.executor.submit(code, self._globals, self._locals, runner):
+            self._submissions.pop()
+            return False
+        return True
+
+    def _updateCompletionNamespaces(self):
+        namespaces = [__builtin__.__dict__]
+        # A kernel's names live in the child, only builtins can be completed.
+        if not isinstance(self.executor, QtTermKernel):
+            namespaces[:0] = [self._locals] if self._globals is self._locals else [self._locals, self._globals]
+        self._symbols.index.setNamespaces(namespaces)
+        self._symbolsStale = True
+
+    def namespace(self):
+        """Returns the dict names defined by the console's code go in."""
+        return self._locals
+
+    def setNamespace(self, namespace):
+        """Runs code with namespace as both its globals and locals."""
+        self._globals = self._locals = namespace
+        self._displayHook.namespace = namespace
+        self._updateCompletionNamespaces()
+
+    def symbolIndex(self):
+        return self._symbols.index
+
+    def _refreshSymbols(self):
+        self._symbolsStale = False
+        self._symbols.refresh()
+
+    def complete(self):
+        """Shows completions for the dotted name before the cursor.
+
+        If the attributes of the name haven't been indexed yet they are
+        indexed on a worker thread and the popup appears once they are.
+        """
+        if self._symbolsStale:
+            # Names are indexed when first needed, then after every run.
+            self._symbolsStale = False
+            self._completionPath = ''
+            self._symbols.refresh()
+            return
+        cursor = self.textCursor()
+        expression = expression_before(cursor.block().text()[:cursor.positionInBlock()])
+        candidates, path = self._symbols.index.complete(expression)
+        self._completionPath = path
+        if path is not None:
+            self._symbols.indexAttributes(path)
+            return
+        popup = self.completer().popup()
+        if not candidates:
+            popup.hide()
+            return
+
+        self._completer.model().setStringList(candidates)
+        self._completer.setCompletionPrefix(expression.rpartition('.')[2])
+        popup.setCurrentIndex(self._completer.completionModel().index(0, 0))
+        rect = self.cursorRect()
+        rect.setWidth(popup.sizeHintForColumn(0) + popup.verticalScrollBar().sizeHint().width())
+        self._completer.complete(rect)
+
+    def completer(self):
+        if self._completer is None:
+            self._completer = QtGui.QCompleter(self)
+            self._completer.setWidget(self)
+            self._completer.setCompletionMode(QtGui.QCompleter.PopupCompletion)
+            self._completer.setCaseSensitivity(QtCore.Qt.CaseSensitive)
+            self._completer.setModel(QtGui.QStringListModel(self._completer))
+            self._completer.activated[str].connect(self.insertCompletion)
+        return self._completer
+
+    def _symbolsIndexed(self, path):
+        if path == self._completionPath:
+            self.complete()
+
+    def insertCompletion(self, word):
+        cursor = self.textCursor()
+        expression = expression_before(cursor.block().text()[:cursor.positionInBlock()])
+        cursor.movePosition(QtGui.QTextCursor.Left, QtGui.QTextCursor.KeepAnchor,
+                            len(expression.rpartition('.')[2]))
+        cursor.insertText(word)
+        self.setTextCursor(cursor)
+
+    def history(self):
+        return self._history
+
+    def setHistory(self, store):
+        """Records executed buffers in store, a qtterm.history.HistoryStore or MemoryHistory, or None."""
+        self._history = store
+        self._historyMatches = None
+
+    def _replaceText(self, text):
+        # Edited through a cursor rather than setPlainText so undo still works.
+        self._recalling = True
+        cursor = self.textCursor()
+        cursor.select(QtGui.QTextCursor.Document)
+        cursor.insertText(text)
+        self._recalling = False
+
+    def _editedDuringRecall(self):
+        if not self._recalling:
+            self._historyMatches = None
+
+    def recallHistory(self, step):
+        """Replaces the buffer with an older (step -1) or newer (step 1) history entry.
+
+        Only entries starting with the text before the cursor when recall began
+        are visited.  Stepping past the newest restores that text.
+        """
+        if self._history is None:
+            return False
+        if self._historyMatches is None or self._historyGeneration != self._history.generation():
+            if step > 0:
+                return False
+            self._historyDraft = self.toPlainText()
+            prefix = self._historyDraft[:self.textCursor().position()]
+            self._historyMatches = self._history.prefixMatches(prefix)
+            self._historyPosition = len(self._historyMatches)
+            self._historyGeneration = self._history.generation()
+            self._historyPrefix = len(prefix)
+
+        current = self.toPlainText()
+        position = self._historyPosition
+        while True:
+            position += step
+            if position < 0:
+                return False
+            if position >= len(self._historyMatches):
+                text = self._historyDraft
+                break
+            text = self._history.entry(self._historyMatches[position])
+            # Duplicates stay in the store until it is compacted.
+            if text != current:
+                break
+        self._historyPosition = position
+        self._replaceText(text)
+
+        cursor = self.textCursor()
+        if step < 0:
+            # On the first line, so Up keeps going back.
+            cursor.setPosition(min(self._historyPrefix, len(self.document().firstBlock().text())))
+        else:
+            cursor.movePosition(QtGui.QTextCursor.End)
+        self.setTextCursor(cursor)
+        if position >= len(self._historyMatches):
+            self._historyMatches = None
+        return True
+
+    def searchHistory(self):
+        """Opens the reverse incremental search bar, or searches further back if it's open."""
+        if self._history is None:
+            return
+        if self._historySearch.isVisible():
+            # The shortcut wins over the search bar's own handling of Ctrl+R.
+            self._searchOlder()
+            return
+        self._historyDraft = self.toPlainText()
+        self._searchMatch = -1
+        self._historySearch.clear()
+        self._placeHistorySearch()
+        self._historySearch.show()
+        self._historySearch.setFocus()
+
+    def _placeHistorySearch(self):
+        rect = self.viewport().geometry()
+        height = self._historySearch.sizeHint().height()
+        self._historySearch.setGeometry(rect.left(), rect.bottom() - height + 1, rect.width(), height)
+
+    def _showSearchMatch(self, match):
+        self._searchMatch = match
+        if match < 0:
+            self._historySearch.setStyleSheet("color: darkred")
+            return
+        self._historySearch.setStyleSheet("")
+        text = self._history.entry(match)
+        self._replaceText(text)
+        cursor = self.textCursor()
+        cursor.setPosition(max(text.find(self._historySearch.text()), 0))
+        self.setTextCursor(cursor)
+
+    def _searchHistory(self, text):
+        self._searchRequest += 1
+        self._searchingOlder = False
+        self._searcher.search(self._searchRequest, self._history, text)
+
+    def _searchOlder(self):
+        if self._searchMatch > 0:
+            self._searchRequest += 1
+            self._searchingOlder = True
+            self._searcher.search(self._searchRequest, self._history, self._historySearch.text(), self._searchMatch)
+
+    def handleSearchResult(self, request, match):
+        if request != self._searchRequest or not self._historySearch.isVisible():
+            return
+        # Searching further back keeps the match shown if there is no older one.
+        if match >= 0 or not self._searchingOlder:
+            self._showSearchMatch(match)
+
+    def _endHistorySearch(self):
+        self._searchRequest += 1
+        self._historySearch.hide()
+        self.setFocus()
+
+    def _cancelHistorySearch(self):
+        self._searchRequest += 1
+        self._historySearch.hide()
+        self._replaceText(self._historyDraft)
+        self.setFocus()
+
+    def keyPressEvent(self, event):
+        popup = self._completer.popup() if self._completer is not None else None
+        if popup is not None and popup.isVisible() and event.key() in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter, QtCore.Qt.Key_Escape,
+                                                 QtCore.Qt.Key_Tab, QtCore.Qt.Key_Backtab):
+            # Left for the completer to accept or dismiss.
+            event.ignore()
+            return
+        if event.key() == QtCore.Qt.Key_Tab and event.modifiers() == QtCore.Qt.NoModifier:
+            cursor = self.textCursor()
+            if not cursor.hasSelection() and expression_before(cursor.block().text()[:cursor.positionInBlock()]):
+                self.complete()
+                return
+
+        if event.modifiers() == QtCore.Qt.NoModifier:
+            cursor = self.textCursor()
+            if event.key() == QtCore.Qt.Key_Up and cursor.blockNumber() == 0:
+                if self.recallHistory(-1):
+                    return
+            elif event.key() == QtCore.Qt.Key_Down and cursor.blockNumber() == self.blockCount() - 1:
+                if self.recallHistory(1):
+                    return
+        super(QtTermEntryWidget, self).keyPressEvent(event)
+
+        # Narrow an open popup as the name is typed.
+        if popup is not None and popup.isVisible() and event.text():
+            self.complete()
+
+    def runSource(self, source, firstLine=0, label=None, cell=None):
+        """Compiles and submits source as if it started on line firstLine of the buffer.
+
+        Runs with a label report their time through cellFinished.  Returns
+        False if the source didn't compile or the executor refused it.
+        Source starting with a profiling magic is run under the profiler,
+        and source using top-level await is started as a task.
+        """
+        try:
+            command = _tasks.parse_command(source)
+        except _tasks.CommandError as e:
+            self.stdoutRedirect.write("{error}\n".format(error=e))
+            return False
+        if command is not None:
+            self.taskCommand(*command)
+            return True
 
         try:
-            script_code = compile(script, '<interactive interpreter>', 'exec')
+            magic = profiling.parse_magic(source)
+        except profiling.MagicError as e:
+            self.stdoutRedirect.write("{error}\n".format(error=e))
+            return False
+        runner = None
+        if magic is not None:
+            if isinstance(self.executor, QtTermKernel):
+                self.stdoutRedirect.write("%{name} is not available in kernel mode\n".format(name=magic.name))
+                return False
+            runner = profiling.runner(magic)
+            source = magic.body
+            firstLine += magic.firstLine
+
+        start = time.time()
+        try:
+            if runner is None and not isinstance(self.executor, QtTermKernel):
+                # A final expression is shown through the display hook.
+                script_code, expression = self._codeCache.compileDisplay(source, INTERACTIVE_FILENAME, firstLine)
+                if expression is not None:
+                    runner = _display.runner(expression, self._displayHook)
+            else:
+                script_code = self._codeCache.compile(source, INTERACTIVE_FILENAME, 'exec', firstLine)
         except (SyntaxError) as e:
+            if runner is None and self._asyncMode:
+                try:
+                    code = self._codeCache.compile(source, INTERACTIVE_FILENAME, 'exec', firstLine, _tasks.TOP_LEVEL_AWAIT)
+                except SyntaxError:
+                    code = None
+                if code is not None and _tasks.is_async(code):
+                    return self.startTask(code, source, firstLine, label, time.time() - start)
             self.syntaxError.emit(e.lineno)
+            return False
+        compileTime = time.time() - start
+
+        # Recorded first, an unthreaded executor finishes before submit returns.
+        self._submissions.append((label, cell, source, firstLine, compileTime))
+        if not self.executor.submit(script_code, self._globals, self._locals, runner):
+            self._submissions.pop()
+            return False
+        return True
+
+    def asyncMode(self):
+        return self._asyncMode
+
+    def setAsyncMode(self, enabled):
+        """Lets source use await at the top level.  Returns False if this python can't."""
+        if enabled and not _tasks.TOP_LEVEL_AWAIT:
+            return False
+        self._asyncMode = enabled
+        return True
+
+    def taskLoop(self):
+        """Returns the QtTermTaskLoop running this console's tasks."""
+        if self._taskLoop is None:
+            self._taskLoop = QtTermTaskLoop(self.stdoutRedirect, parent=self)
+            self._taskLoop.changed.connect(self.tasksChanged)
+            self._taskLoop.taskDone.connect(self._taskDone)
+        return self._taskLoop
+
+    def startTask(self, code, source, firstLine=0, label=None, compileTime=0.0):
+        """Starts code compiled with top-level await as a task on the console's loop.
+
+        The task's run is recorded in executionHistory once it finishes,
+        under label.
+        """
+        if isinstance(self.executor, QtTermKernel):
+            self.stdoutRedirect.write("Top-level await is not available in kernel mode\n")
+            return False
+        # Running the code only creates the coroutine.
+        coroutine = eval(code, self._globals, self._locals)
+        number = self.taskLoop().start(coroutine, source.strip().split('\n')[0][:TASK_LABEL_CHARS])
+        self._taskSources[number] = (source, firstLine, label, compileTime)
+        self.stdoutRedirect.write("[{number}] started\n".format(number=number))
+        return True
+
+    def _taskDone(self, number, task, measurement):
+        source, firstLine, label, compileTime = self._taskSources.pop(number, (None, 0, None, 0.0))
+        error = None if task.cancelled() else task.exception()
+        self._recordRun(measurement, label, compileTime, task.cancelled() or error is not None)
+        if task.cancelled():
+            self.stdoutRedirect.write("[{number}] cancelled\n".format(number=number))
+            return
+        if error is None:
+            self.stdoutRedirect.write("[{number}] done\n".format(number=number))
             return
-        with self.stdoutRedirect:
-            try:
-                exec(script_code, globals(), self._locals)
-            except (StandardError) as e: #Which error should this be?
-                type_, value_, traceback_ = sys.exc_info()
-                tb = traceback.extract_tb(traceback_)
-
-                index = self._termWidget.storeTraceback(tb)
-                self.traceback.emit(index)
 
+        self.stdoutRedirect.flush()
+        traceback_ = error.__traceback__
+        # Skip the event loop's and the measuring wrapper's frames above the
+        # console's code.
+        while traceback_ is not None and os.path.dirname(traceback_.tb_frame.f_code.co_filename) in \
+                (os.path.dirname(_tasks.asyncio.__file__), _PACKAGE_DIR):
+            traceback_ = traceback_.tb_next
+        tb = StoredTraceback(traceback_ or error.__traceback__, type(error), error)
+        tb.setSource(source, firstLine)
+        self.traceback.emit(self._termWidget.storeTraceback(tb))
+
+    def taskCommand(self, name, numbers):
+        """Runs %tasks, or %cancel with its task numbers (None for all)."""
+        table = self._taskLoop.tasks if self._taskLoop is not None else _tasks.TaskTable()
+        if name == 'tasks':
+            lines = table.describe() or ["No pending tasks"]
+            self.stdoutRedirect.write("\n".join(lines) + "\n")
+            return
+        missing = table.cancel(numbers)
+        if missing:
+            self.stdoutRedirect.write("No pending task {numbers}\n".format(
+                numbers=", ".join(str(number) for number in missing)))
+
+    def runCell(self):
+        cells = split_cells(self.toPlainText())
+        index = cell_at(cells, self.textCursor().blockNumber())
+        firstLine, source = cells[index]
+        self.runSource(source, firstLine, "cell {n}".format(n=index+1), source_key(source))
+
+    def runSelection(self):
+        cursor = self.textCursor()
+        if not cursor.hasSelection():
+            return
+        firstLine = self.document().findBlock(cursor.selectionStart()).blockNumber()
+        # selectedText() separates lines with unicode paragraph separators.
+        source = textwrap.dedent(cursor.selectedText().replace(u'\u2029', '\n'))
+        self.runSource(source, firstLine, "selection")
+
+    def runChangedCells(self):
+        """Runs, in order, every cell that hasn't run successfully since it last changed."""
+        cells = split_cells(self.toPlainText())
+        keys = [source_key(source) for firstLine, source in cells]
+        self._executedCells.intersection_update(keys)
+        for index, ((firstLine, source), key) in enumerate(zip(cells, keys)):
+            if key in self._executedCells or not source.strip():
+                continue
+            if not self.runSource(source, firstLine, "cell {n}".format(n=index+1), key):
+                break
+
+    def _setMeasurement(self, measurement):
+        self._measurement = measurement
+
+    def executionHistory(self):
+        """Returns the records of the last EXECUTION_HISTORY_SIZE runs, oldest first.
+
+        Each is a dict of the executor's measurements plus 'label' (or None),
+        'compileTime' in seconds, 'failed' and the 'finished' time.
+        """
+        return list(self._executionHistory)
+
+    def clearExecutionHistory(self):
+        self._executionHistory.clear()
+
+    def executionResult(self, result):
+        # Output written during the run goes above the result.
+        self.stdoutRedirect.flush()
+        if result.kind == 'display':
+            self.display.emit(self._termWidget.storeDisplay(result))
+        else:
+            self.profile.emit(self._termWidget.storeProfile(result))
+
+    def executionFinished(self, tb):
+        label, cell, source, firstLine, compileTime = (None, None, None, 0, 0.0)
+        if self._submissions:
+            label, cell, source, firstLine, compileTime = self._submissions.popleft()
+
+        if tb is not None:
+            tb.setSource(source, firstLine)
+            index = self._termWidget.storeTraceback(tb)
+            self.traceback.emit(index)
+            self._executedCells.discard(cell)
+        elif cell is not None:
+            self._executedCells.add(cell)
+
+        measurement, self._measurement = self._measurement, {}
+        self._recordRun(measurement, label, compileTime, tb is not None)
+
+    def _recordRun(self, measurement, label, compileTime, failed):
+        if label is not None:
+            self.cellFinished.emit(label, measurement.get('wallTime', 0.0))
+
+        record = {
+            'wallTime': 0.0,
+            'cpuTime': 0.0,
+            'peakMemory': None,
+            'netMemory': None,
+            'outputChars': 0,
+            'flushes': 0,
+        }
+        record.update(measurement)
+        record.update({
+            'label': label,
+            'compileTime': compileTime,
+            'failed': failed,
+            'finished': time.time(),
+        })
+        self._executionHistory.append(record)
+        self.executed.emit(record)
+
+    def highlighter(self):
+        """Returns the PythonHighlighter, or None until the widget is first shown."""
+        return self._highlighter
+
+    def showEvent(self, event):
+        if self._highlighter is None:
+            self._highlighter = PythonHighlighter(self)
+            self._highlighter.largeDocumentThreshold = self._largeDocumentThreshold
+            if self._loader is not None:
+                self._highlighter.setDocument(None)
+            self.updateHighlightWindow()
+        super(QtTermEntryWidget, self).showEvent(event)
+
+    def largeDocumentThreshold(self):
+        return self._largeDocumentThreshold
+
+    def setLargeDocumentThreshold(self, lines):
+        """Sets the block count above which highlighting is limited to the viewport."""
+        self._largeDocumentThreshold = lines
+        if self._highlighter is not None:
+            self._highlighter.largeDocumentThreshold = lines
+            self.updateHighlightWindow()
+
+    def updateHighlightWindow(self, *args):
+        if self._highlighter is None:
+            return
+        first = self.firstVisibleBlock().blockNumber()
+        rows = self.viewport().height() // max(self.fontMetrics().height(), 1) + 1
+        # Keep a page either side formatted so scrolling doesn't show plain text.
+        window = (max(first - rows, 0), first + rows * 2)
+        if window != self._highlighter.window():
+            self._highlighter.highlightRange(*window)
+
+    def lineNumberGlyph(self, number):
+        glyph = self._lineNumberGlyphs.get(number)
+        if glyph is None:
+            if len(self._lineNumberGlyphs) >= LINE_NUMBER_CACHE_SIZE:
+                self._lineNumberGlyphs.clear()
+            text = QtGui.QStaticText(str(number))
+            text.prepare(QtGui.QTransform(), self.font())
+            glyph = (text, text.size().width())
+            self._lineNumberGlyphs[number] = glyph
+        return glyph
 
     def lineNumberAreaPaintEvent(self, event):
         painter = QtGui.QPainter(self._lineNumber)
         painter.fillRect(event.rect(), QtGui.QColor.fromRgb(200,200,200))
+        painter.setPen(QtCore.Qt.black)
+        painter.setFont(self.font())
+        width = self._lineNumber.width()
         block = self.firstVisibleBlock()
         blockNumber = block.blockNumber()
         top = int(self.blockBoundingGeometry(block).translated(self.contentOffset()).top())
@@ -223,15 +2458,19 @@ class QtTermEntryWidget(QtGui.QPlainTextEdit):
 
         while block.isValid() and top <= event.rect().bottom():
             if block.isVisible() and bottom >= event.rect().top():
-                number = str(blockNumber+1)
-                painter.setPen(QtCore.Qt.black)
-                painter.drawText(0, top, self._lineNumber.width(), self.fontMetrics().height(), QtCore.Qt.AlignRight, number)
+                text, textWidth = self.lineNumberGlyph(blockNumber+1)
+                painter.drawStaticText(width - textWidth, top, text)
 
             block = block.next()
             top = bottom
             bottom = top + int(self.blockBoundingRect(block).height())
             blockNumber += 1
 
+    def changeEvent(self, event):
+        if event.type() == QtCore.QEvent.FontChange:
+            self._lineNumberGlyphs.clear()
+        super(QtTermEntryWidget, self).changeEvent(event)
+
     def highlightCurrentLine(self):
 
         sel = QtGui.QTextEdit.ExtraSelection()
@@ -240,9 +2479,9 @@ class QtTermEntryWidget(QtGui.QPlainTextEdit):
         sel.format.setProperty(QtGui.QTextFormat.FullWidthSelection, True)
         sel.cursor = self.textCursor()
         sel.cursor.clearSelection()
-        extraSelections = [sel]
+        self._currentLineSelections = [sel]
 
-        self.setExtraSelections(extraSelections)
+        self.setExtraSelections(self._currentLineSelections + self._errorSelections)
 
     def updateLineNumberArea(self, area, num):
         if (num):
@@ -267,8 +2506,34 @@ class QtTermEntryWidget(QtGui.QPlainTextEdit):
         cr = self.contentsRect()
         nr = QtCore.QRect(cr.left(), cr.top(), self.lineNumberAreaWidth(), cr.height())
         self._lineNumber.setGeometry(nr)
+        if self._historySearch.isVisible():
+            self._placeHistorySearch()
+
+# Default scrollback limits of the results pane, 0 means unlimited.  Bytes are
+# estimated from the UTF-16 text the document holds.
+SCROLLBACK_LINES = 100000
+SCROLLBACK_BYTES = 0
+
+# Once over a limit this fraction of it is evicted in one edit, so trimming
+# happens in bulk rather than a line at a time.
+SCROLLBACK_SLACK = 0.1
+
+# A single output chunk longer than SPILL_THRESHOLD characters, well above
+# OUTPUT_BUFFER_SIZE so only a huge write makes one, is written to a
+# SpillFile.  Only SPILL_PREVIEW characters go into the document, and each
+# "show more" adds SPILL_PAGE_SIZE bytes.  At most SPILL_FILES_KEPT are kept.
+SPILL_THRESHOLD = 1 << 20
+SPILL_PREVIEW = 1 << 12
+SPILL_PAGE_SIZE = 1 << 16
+SPILL_FILES_KEPT = 32
+
+# Evicted lines matching a search listed in the search bar's tooltip.
+SEARCH_EVICTED_SHOWN = 20
 
 class QtTermResultsWidget(QtGui.QTextBrowser):
+
+    usageChanged = QtCore.Signal(int, int)
+
     def __init__(self, parent=None):
         super(QtTermResultsWidget, self).__init__(parent)
         self.setOpenLinks(False)
@@ -280,33 +2545,826 @@ class QtTermResultsWidget(QtGui.QTextBrowser):
 
         self.writeLock = Lock()
 
+        self._scrollbackLines = SCROLLBACK_LINES
+        self._scrollbackBytes = SCROLLBACK_BYTES
+        self._evictedLines = 0
+        # (line, traceback index) of every traceback link still in the document.
+        self._anchors = deque()
+
+        self._spillThreshold = SPILL_THRESHOLD
+        # {index: [SpillFile, offset shown up to]}, oldest first.
+        self._spills = OrderedDict()
+        self._nextSpill = 0
+        # (line, spill index) of every "show more" link, like _anchors.
+        self._spillAnchors = deque()
+
+        # Colours and line redraws carry over from one chunk of output to the next.
+        self._ansi = _ansi.AnsiParser()
+
+        # Every finished line is indexed, evicted ones included.  The line
+        # being written isn't, a carriage return can still change it.
+        self._searchIndex = ScrollbackIndex()
+        self._indexedLines = 0
+        # The last search: its pattern for highlighting, the matching lines
+        # still in the document, and the one selected.
+        self._searchPattern = None
+        self._searchLines = []
+        self._searchEvicted = []
+        self._searchCurrent = -1
+        self.verticalScrollBar().valueChanged.connect(self._updateSearchHighlights)
+
+        # (compressed log, formats, line count) while the document is released.
+        self._released = None
+
+    def scrollbackLines(self):
+        return self._scrollbackLines
+
+    def setScrollbackLines(self, lines):
+        self._scrollbackLines = lines
+        # The search index keeps at least what the document can hold.
+        self._searchIndex.setLimit(max(lines, INDEX_LINES) if lines else 0)
+        self._trimScrollback()
+
+    def spillThreshold(self):
+        return self._spillThreshold
+
+    def setSpillThreshold(self, size):
+        """Sets the chunk size above which output is kept on disk, 0 never spills.
+
+        The console's OutputRedirect only emits a chunk above its
+        maxBufferSize for a single write, so a size above that spills just
+        huge writes, never many small ones collected while the GUI was busy.
+        """
+        self._spillThreshold = size
+
+    def scrollbackBytes(self):
+        return self._scrollbackBytes
+
+    def setScrollbackBytes(self, size):
+        self._scrollbackBytes = size
+        self._trimScrollback()
+
+    def memoryUsage(self):
+        """Returns a summary of what the scrollback currently holds."""
+        document = self.document()
+        return {
+            'lines': document.blockCount() if self._released is None else self._released[2],
+            'bytes': document.characterCount() * 2,
+            'tracebacks': len(self._anchors),
+            'spilledBytes': sum(spill.size for spill, offset in self._spills.values()),
+            'releasedBytes': 0 if self._released is None else len(self._released[0]),
+            'evictedLines': self._evictedLines,
+        }
+
+    def shutdown(self):
+        """Stops the search index's worker and removes its files and the spill files."""
+        self.clearSearch()
+        self._searchIndex.close()
+        for index in list(self._spills):
+            self._releaseSpill(index)
+
+    def isReleased(self):
+        return self._released is not None
+
+    def releaseDocument(self):
+        """Empties the document, keeping a compressed log to rebuild it from.
+
+        The log is the document's text plus the format of each run of it,
+        with the tables profiles insert kept as html.  Anything adding to or
+        reading the document restores it first, as does showing the widget.
+        """
+        with self.writeLock:
+            if self._released is not None:
+                return
+            self._indexLines()
+            document = self.document()
+            tables = deque((frame.firstPosition(), frame.lastPosition())
+                           for frame in document.rootFrame().childFrames())
+            texts = []
+            # Pairs of (length, format index), or (html index, -1) for a table.
+            runs = []
+            htmls = []
+
+            block = document.begin()
+            while block.isValid():
+                if tables and block.position() >= tables[0][0]:
+                    first, last = tables.popleft()
+                    cursor = QtGui.QTextCursor(document)
+                    cursor.setPosition(first - 1)
+                    cursor.setPosition(last + 1, QtGui.QTextCursor.KeepAnchor)
+                    runs.extend((len(htmls), -1))
+                    htmls.append(cursor.selection().toHtml())
+                    while block.isValid() and block.position() <= last:
+                        block = block.next()
+                    continue
+
+                iterator = block.begin()
+                while not iterator.atEnd():
+                    fragment = iterator.fragment()
+                    text = fragment.text()
+                    texts.append(text)
+                    if runs and runs[-1] == fragment.charFormatIndex():
+                        runs[-2] += len(text)
+                    else:
+                        runs.extend((len(text), fragment.charFormatIndex()))
+                    iterator += 1
+                following = block.next()
+                # A table starts on a block of its own, there's no line break before it.
+                if following.isValid() and not (tables and following.position() >= tables[0][0]):
+                    # The break carries the format of the block it starts.
+                    texts.append("\n")
+                    if runs and runs[-1] == following.charFormatIndex():
+                        runs[-2] += 1
+                    else:
+                        runs.extend((1, following.charFormatIndex()))
+                block = following
+
+            log = zlib.compress(marshal.dumps((u''.join(texts), runs, htmls)), 1)
+            self._released = (log, document.allFormats(), document.blockCount())
+            self.setExtraSelections([])
+            document.clear()
+
+    def restoreDocument(self):
+        """Rebuilds a document emptied by releaseDocument.  Call with writeLock held."""
+        if self._released is None:
+            return
+        log, formats, lines = self._released
+        self._released = None
+        text, runs, htmls = marshal.loads(zlib.decompress(log))
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.beginEditBlock()
+        position = 0
+        for i in range(0, len(runs), 2):
+            length, index = runs[i], runs[i+1]
+            if index < 0:
+                cursor.insertHtml(htmls[length])
+            else:
+                cursor.insertText(text[position:position+length], formats[index].toCharFormat())
+                position += length
+        cursor.endEditBlock()
+        self.setTextCursor(cursor)
+        self._trimScrollback()
+        self._updateSearchHighlights()
+
+    def showEvent(self, event):
+        with self.writeLock:
+            self.restoreDocument()
+        super(QtTermResultsWidget, self).showEvent(event)
+
+    def _indexLines(self):
+        document = self.document()
+        last = self._evictedLines + document.blockCount() - 1
+        if self._indexedLines >= last:
+            return
+        block = document.findBlockByNumber(self._indexedLines - self._evictedLines)
+        lines = []
+        for i in range(last - self._indexedLines):
+            lines.append(block.text())
+            block = block.next()
+        self._searchIndex.append(lines)
+        self._indexedLines = last
+
+    def _trimScrollback(self):
+        # A released document is trimmed once it is restored.
+        if self._released is not None:
+            return
+        self._indexLines()
+        document = self.document()
+        blocks = document.blockCount()
+        remove = 0
+
+        if self._scrollbackLines and blocks > self._scrollbackLines:
+            remove = blocks - int(self._scrollbackLines * (1 - SCROLLBACK_SLACK))
+
+        characters = document.characterCount()
+        if self._scrollbackBytes and characters * 2 > self._scrollbackBytes:
+            keep = int(self._scrollbackBytes * (1 - SCROLLBACK_SLACK)) // 2
+            block = document.findBlock(characters - keep)
+            remove = max(remove, block.blockNumber() + 1)
+
+        # The last block is the one being written to, it always stays.
+        remove = min(remove, blocks - 1)
+        if remove > 0:
+            cursor = QtGui.QTextCursor(document)
+            cursor.setPosition(document.findBlockByNumber(remove).position(), QtGui.QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+            self._evictedLines += remove
+
+            while self._anchors and self._anchors[0][0] < self._evictedLines:
+                self._termWidget.releaseTraceback(self._anchors.popleft()[1])
+            while self._spillAnchors and self._spillAnchors[0][0] < self._evictedLines:
+                self._releaseSpill(self._spillAnchors.popleft()[1])
+
+        self.usageChanged.emit(document.blockCount(), document.characterCount() * 2)
+
     def handleLink(self, url):
-        pass
-        #TODO: Implement some sort of traceback display.
+        if url.scheme() == 'traceback':
+            index = int(url.path().strip('/'))
+            if not self._termWidget.showTraceback(index):
+                self.handleOutput("Traceback {index} is no longer available\n".format(index=index))
+        elif url.scheme() == 'display':
+            index = int(url.path().strip('/'))
+            if not self._termWidget.expandDisplay(index):
+                self.handleOutput("Result {index} is no longer available\n".format(index=index))
+        elif url.scheme() == 'output':
+            index = int(url.path().strip('/'))
+            if not self.showMore(index):
+                self.handleOutput("That output is no longer available\n")
+        elif url.scheme() == 'profile':
+            # profile:///index opens the profile, profile:///index/row the source of a row.
+            path = [int(part) for part in url.path().strip('/').split('/')]
+            result = self._termWidget.profile(path[0])
+            if result is None:
+                self.handleOutput("Profile {index} is no longer available\n".format(index=path[0]))
+            elif len(path) == 1:
+                self._termWidget.showProfile(path[0])
+            else:
+                row = result.rows()[path[1]]
+                if result.kind == 'sample':
+                    self._termWidget.showSource(row[1], row[2])
+                else:
+                    self._termWidget.showSource(row.filename, row.line)
 
     def handleOutput(self, text):
         with self.writeLock:
+            self.restoreDocument()
             self.moveCursor(QtGui.QTextCursor.End)
-            self.insertPlainText(text)
+            if self._spillThreshold and len(text) > self._spillThreshold:
+                self._spillOutput(_ansi.strip(text) if '\x1b' in text else text)
+            else:
+                self._insertOutput(self._ansi.feed(text))
+            self._trimScrollback()
+
+    def _insertOutput(self, runs):
+        """Inserts the runs of an ansi.AnsiParser as a single edit."""
+        cursor = self.textCursor()
+        cursor.beginEditBlock()
+        for text, style in runs:
+            if text is None:
+                cursor.movePosition(QtGui.QTextCursor.StartOfBlock, QtGui.QTextCursor.KeepAnchor)
+                cursor.removeSelectedText()
+            else:
+                cursor.insertText(text, output_format(style))
+        cursor.endEditBlock()
+        self.setTextCursor(cursor)
+
+    def _spillOutput(self, text):
+        spill = SpillFile(text)
+        preview, offset = spill.page(0, SPILL_PREVIEW)
+        index = self._nextSpill
+        self._nextSpill += 1
+        self._spills[index] = [spill, offset]
+        while len(self._spills) > SPILL_FILES_KEPT:
+            self._releaseSpill(next(iter(self._spills)))
+
+        cursor = self.textCursor()
+        cursor.insertText(preview, QtGui.QTextCharFormat())
+        self._insertShowMore(cursor, index)
+        self.setTextCursor(cursor)
+
+    def _insertShowMore(self, cursor, index):
+        spill, offset = self._spills[index]
+        fmt = link_format('output:///{index}'.format(index=index))
+        cursor.insertText("[show more, {kb} KB left]".format(kb=(spill.size - offset) // 1024), fmt)
+        cursor.insertText("\n", QtGui.QTextCharFormat())
+        self._spillAnchors.append((self._evictedLines + cursor.blockNumber() - 1, index))
+
+    def _releaseSpill(self, index):
+        entry = self._spills.pop(index, None)
+        if entry is not None:
+            entry[0].close()
+
+    def showMore(self, index):
+        """Replaces a "show more" link with the next page of its spilled output."""
+        entry = self._spills.get(index)
+        href = 'output:///{index}'.format(index=index)
+        anchor = None
+        for position, (line, spillIndex) in enumerate(self._spillAnchors):
+            if spillIndex == index:
+                anchor = position
+                break
+        if entry is None or anchor is None:
+            return False
 
-    def handleTraceback(self, index):
         with self.writeLock:
-            tb = self._termWidget.traceback(index)
-            self.moveCursor(QtGui.QTextCursor.End)
+            self.restoreDocument()
+            block = self.document().findBlockByNumber(self._spillAnchors[anchor][0] - self._evictedLines)
+            iterator = block.begin()
+            while not iterator.atEnd():
+                fragment = iterator.fragment()
+                if fragment.charFormat().anchorHref() == href:
+                    break
+                iterator += 1
+            else:
+                return False
+
+            del self._spillAnchors[anchor]
+            cursor = QtGui.QTextCursor(self.document())
+            cursor.setPosition(fragment.position())
+            cursor.setPosition(fragment.position() + fragment.length() + 1, QtGui.QTextCursor.KeepAnchor)
+            blocks = self.document().blockCount()
+            spill, offset = entry
+            text, entry[1] = spill.page(offset, SPILL_PAGE_SIZE)
+            cursor.insertText(text, QtGui.QTextCharFormat())
+            if entry[1] < spill.size:
+                self._insertShowMore(cursor, index)
+                # Keep the anchors in line order.
+                self._spillAnchors.rotate(-anchor)
+                self._spillAnchors.appendleft(self._spillAnchors.pop())
+                self._spillAnchors.rotate(anchor)
+            else:
+                # The line break after the link was replaced too.
+                if not text.endswith("\n"):
+                    cursor.insertText("\n", QtGui.QTextCharFormat())
+                self._releaseSpill(index)
+
+            # Links below the expanded one moved down.
+            added = self.document().blockCount() - blocks
+            line = self._evictedLines + block.blockNumber()
+            # Lines from the link on are indexed again.
+            self._searchIndex.truncate(line)
+            self._indexedLines = min(self._indexedLines, line)
+            for anchors in (self._anchors, self._spillAnchors):
+                for position, (anchorLine, anchorIndex) in enumerate(anchors):
+                    if anchorLine > line and anchorIndex != index:
+                        anchors[position] = (anchorLine + added, anchorIndex)
+            self._trimScrollback()
+        return True
+
+    def search(self, query, regex=False, caseSensitive=False):
+        """Finds the lines matching query, highlighting those in view.
+
+        Returns a dict of the number of matching lines still in the
+        document ('matches'), evicted from it ('evicted') and in spilled
+        output not shown yet ('spilled').  Raises re.error for a bad
+        regular expression.
+        """
+        flags = re.UNICODE | (0 if caseSensitive else re.IGNORECASE)
+        pattern = re.compile(query if regex else re.escape(query), flags) if query else None
+        with self.writeLock:
+            self.restoreDocument()
+            self._indexLines()
+            lines = self._searchIndex.find(query, regex, caseSensitive)
+            last = self.document().lastBlock()
+            if pattern is not None and pattern.search(last.text()):
+                lines.append(self._evictedLines + last.blockNumber())
+
+            evicted = bisect_left(lines, self._evictedLines)
+            spilled = 0
+            if query:
+                needle = query.encode('utf-8') if regex else re.escape(query.encode('utf-8'))
+                spillPattern = re.compile(needle, re.MULTILINE | (0 if caseSensitive else re.IGNORECASE))
+                for spill, offset in self._spills.values():
+                    spilled += spill.count(spillPattern, offset)
+
+            self._searchPattern = pattern
+            self._searchEvicted = lines[:evicted]
+            self._searchLines = lines[evicted:]
+            self._searchCurrent = -1
+        if pattern is None:
+            self.setExtraSelections([])
+        self._updateSearchHighlights()
+        return {'matches': len(self._searchLines), 'evicted': evicted, 'spilled': spilled}
+
+    def searchPosition(self):
+        """Returns which of the matches in the document is selected, from 0, or -1."""
+        return self._searchCurrent
+
+    def evictedMatches(self, limit=SEARCH_EVICTED_SHOWN):
+        """Returns (line, text) of the last search's newest matches that were evicted."""
+        return [(line, self._searchIndex.line(line)) for line in self._searchEvicted[-limit:]]
+
+    def findNext(self, backward=False):
+        """Selects the next (or previous) match of the last search after the cursor.
+
+        Returns False if there are none.
+        """
+        lines = self._searchLines
+        if not lines:
+            return False
+        line = self._evictedLines + self.textCursor().blockNumber()
+        if backward:
+            current = bisect_left(lines, line) - 1
+        else:
+            current = bisect_right(lines, line)
+            # Staying on the cursor's line finds its later matches first.
+            if self._searchCurrent == -1 and current and lines[current-1] == line:
+                current -= 1
+        current %= len(lines)
+        block = self.document().findBlockByNumber(lines[current] - self._evictedLines)
+        if not block.isValid():
+            return False
+        match = self._searchPattern.search(block.text())
+        cursor = QtGui.QTextCursor(block)
+        if match is not None:
+            cursor.setPosition(block.position() + match.start())
+            cursor.setPosition(block.position() + match.end(), QtGui.QTextCursor.KeepAnchor)
+        self.setTextCursor(cursor)
+        self.ensureCursorVisible()
+        self._searchCurrent = current
+        self._updateSearchHighlights()
+        return True
+
+    def clearSearch(self):
+        self._searchPattern = None
+        self._searchLines = []
+        self._searchEvicted = []
+        self._searchCurrent = -1
+        self.setExtraSelections([])
+
+    def _updateSearchHighlights(self):
+        if self._searchPattern is None:
+            return
+        # Only what can be seen is highlighted, whatever the scrollback holds.
+        viewport = self.viewport()
+        block = self.cursorForPosition(QtCore.QPoint(0, 0)).block()
+        last = self.cursorForPosition(QtCore.QPoint(0, viewport.height() - 1)).block().blockNumber()
+        fmt = QtGui.QTextCharFormat()
+        fmt.setBackground(QtGui.QBrush(QtCore.Qt.yellow, QtCore.Qt.SolidPattern))
+        selections = []
+        while block.isValid() and block.blockNumber() <= last:
+            for match in self._searchPattern.finditer(block.text()):
+                if match.end() == match.start():
+                    continue
+                selection = QtGui.QTextEdit.ExtraSelection()
+                selection.format = fmt
+                selection.cursor = QtGui.QTextCursor(block)
+                selection.cursor.setPosition(block.position() + match.start())
+                selection.cursor.setPosition(block.position() + match.end(), QtGui.QTextCursor.KeepAnchor)
+                selections.append(selection)
+            block = block.next()
+        self.setExtraSelections(selections)
 
-            linkName = "Error: {path}".format(path=traceback.format_list(tb)[-1])
-            hoverText = ' '.join(traceback.format_list(tb))
-            # For some reason the </a> doesn't get closed unless we have something after it, hence the space.
-            self.insertHtml("""<a href='traceback:///{index}' title='{hoverText}'>{linkName} </a>&nbsp""".format(
-                    linkName=linkName,
+    def handleCellTiming(self, label, seconds):
+        with self.writeLock:
+            self.restoreDocument()
+            cursor = QtGui.QTextCursor(self.document())
+            cursor.movePosition(QtGui.QTextCursor.End)
+            fmt = QtGui.QTextCharFormat()
+            fmt.setForeground(QtGui.QBrush(QtCore.Qt.gray, QtCore.Qt.SolidPattern))
+            text = "[{label}: {seconds:.3f}s]\n".format(label=label, seconds=seconds)
+            if cursor.block().length() > 1:
+                text = "\n" + text
+            cursor.insertText(text, fmt)
+            self._trimScrollback()
+
+    def handleProfile(self, index):
+        with self.writeLock:
+            result = self._termWidget.profile(index)
+            if result is None:
+                return
+            self.restoreDocument()
+            self.moveCursor(QtGui.QTextCursor.End)
+            if self.textCursor().block().length() > 1:
+                self.insertPlainText("\n")
+            if result.kind == 'timeit':
+                self.insertPlainText(result.summary() + "\n")
+                self._trimScrollback()
+                return
+
+            # Only the top rows go inline, the profile view has the rest.
+            rows = []
+            for number, row in enumerate(result.rows()[:PROFILE_INLINE_ROWS]):
+                if result.kind == 'sample':
+                    count, filename, line = row
+                    cells = [str(count), "{percent:.1f}%".format(percent=100.0 * count / max(result.total, 1))]
+                    function = ''
+                else:
+                    filename, line, function = row.filename, row.line, row.function
+                    cells = [str(row.calls), "{t:.4f}".format(t=row.totalTime), "{t:.4f}".format(t=row.cumulativeTime)]
+                location = html_escape("{file}:{line} {function}".format(file=filename, line=line, function=function))
+                if line:
+                    location = "<a href='profile:///{index}/{row}'>{location}</a>".format(
+                        index=index, row=number, location=location)
+                rows.append("<tr>{cells}<td>{location}</td></tr>".format(
+                    cells=''.join("<td align='right'>{cell}</td>".format(cell=cell) for cell in cells),
+                    location=location,
+                ))
+            if result.kind == 'sample':
+                header = ["samples", "share", "line"]
+            else:
+                header = ["calls", "tottime", "cumtime", "function"]
+
+            self.insertHtml("""<a href='profile:///{index}'>{summary} </a>&nbsp;<table cellspacing='0' cellpadding='2'><tr>{header}</tr>{rows}</table>""".format(
                     index=index,
-                    hoverText=hoverText,
+                    summary=html_escape(result.summary()),
+                    header=''.join("<th>{name}</th>".format(name=name) for name in header),
+                    rows=''.join(rows),
                 )
             )
+            self.moveCursor(QtGui.QTextCursor.End)
             self.insertPlainText("\n")
+            self._trimScrollback()
+
+    def handleDisplay(self, index):
+        with self.writeLock:
+            result = self._termWidget.displayResult(index)
+            if result is None:
+                return
+            self.restoreDocument()
+            self.moveCursor(QtGui.QTextCursor.End)
+            cursor = self.textCursor()
+            if cursor.block().length() > 1:
+                cursor.insertText("\n")
+            cursor.insertText(result.text, QtGui.QTextCharFormat())
+            if result.truncated:
+                cursor.insertText(" ", QtGui.QTextCharFormat())
+                cursor.insertText("[full repr]", link_format('display:///{index}'.format(index=index)))
+            cursor.insertText("\n", QtGui.QTextCharFormat())
+            self.setTextCursor(cursor)
+            self._trimScrollback()
+
+    def handleTraceback(self, index):
+        with self.writeLock:
+            tb = self._termWidget.traceback(index)
+            if tb is None:
+                return
+            self.restoreDocument()
+            self.moveCursor(QtGui.QTextCursor.End)
+            self._anchors.append((self._evictedLines + self.document().blockCount() - 1, index))
+
+            # Only the last frame is formatted here, the rest waits for the browser.
+            frames = tb.frames()
+            hoverText = None
+            if frames:
+                hoverText = traceback.format_list(frames[-1:])[0].strip()
+            cursor = self.textCursor()
+            cursor.insertText(tb.summary(), link_format('traceback:///{index}'.format(index=index), hoverText))
+            cursor.insertText("\n", QtGui.QTextCharFormat())
+            self.setTextCursor(cursor)
+            self._trimScrollback()
+
+class QtTermResultsSearch(QtGui.QWidget):
+    """The find bar for the results widget, opened with Ctrl+F.
+
+    Return finds the next match, Shift+Return the previous, Escape closes.
+    """
+
+    def __init__(self, results, parent=None):
+        super(QtTermResultsSearch, self).__init__(parent)
+        self._results = results
+
+        layout = QtGui.QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self._query = QtGui.QLineEdit(self)
+        self._query.setPlaceholderText("Search output")
+        self._query.installEventFilter(self)
+        layout.addWidget(self._query)
+        self._regex = QtGui.QCheckBox("Regex", self)
+        layout.addWidget(self._regex)
+        self._caseSensitive = QtGui.QCheckBox("Match case", self)
+        layout.addWidget(self._caseSensitive)
+        self._count = QtGui.QLabel(self)
+        layout.addWidget(self._count)
+        previous = QtGui.QPushButton("Previous", self)
+        layout.addWidget(previous)
+        next_ = QtGui.QPushButton("Next", self)
+        layout.addWidget(next_)
+        close = QtGui.QPushButton("Close", self)
+        layout.addWidget(close)
+        self.hide()
+
+        self._counts = None
+        self._query.textChanged.connect(self.search)
+        self._regex.toggled.connect(self.search)
+        self._caseSensitive.toggled.connect(self.search)
+        previous.clicked.connect(lambda: self.findNext(True))
+        next_.clicked.connect(lambda: self.findNext(False))
+        close.clicked.connect(self.close)
+
+    def open(self):
+        self.show()
+        self._query.setFocus()
+        self._query.selectAll()
+        self.search()
+
+    def close(self):
+        self.hide()
+        self._results.clearSearch()
+
+    def search(self):
+        try:
+            self._counts = self._results.search(
+                self._query.text(), self._regex.isChecked(), self._caseSensitive.isChecked())
+        except re.error as e:
+            self._counts = None
+            self._count.setText("Bad pattern: {error}".format(error=e))
+            return
+        self.updateCount()
+
+    def findNext(self, backward=False):
+        self._results.findNext(backward)
+        self.updateCount()
+
+    def updateCount(self):
+        counts = self._counts
+        if counts is None or not self._query.text():
+            self._count.setText('')
+            return
+        position = self._results.searchPosition()
+        text = "{matches} matches".format(matches=counts['matches'])
+        if position >= 0:
+            text = "{position} of {text}".format(position=position + 1, text=text)
+        if counts['evicted']:
+            text += ", {evicted} evicted".format(evicted=counts['evicted'])
+        if counts['spilled']:
+            text += ", {spilled} in spilled output".format(spilled=counts['spilled'])
+        self._count.setText(text)
+        self._count.setToolTip('\n'.join("{line}: {text}".format(line=line + 1, text=text)
+                                         for line, text in self._results.evictedMatches()))
+
+    def eventFilter(self, watched, event):
+        if event.type() == QtCore.QEvent.KeyPress:
+            if event.key() in (QtCore.Qt.Key_Return, QtCore.Qt.Key_Enter):
+                self.findNext(bool(event.modifiers() & QtCore.Qt.ShiftModifier))
+                return True
+            if event.key() == QtCore.Qt.Key_Escape:
+                self.close()
+                return True
+        return super(QtTermResultsSearch, self).eventFilter(watched, event)
+
+class QtTermTracebackBrowser(QtGui.QTreeWidget):
+    """Shows the frames of a StoredTraceback.
+
+    Each frame expands to its source line and, while the frames are still
+    alive, its locals.  Nothing is formatted until a frame is expanded.
+    """
+
+    def __init__(self, parent=None):
+        super(QtTermTracebackBrowser, self).__init__(parent)
+        self.setWindowFlags(QtCore.Qt.Tool)
+        self.setColumnCount(2)
+        self.setHeaderLabels(["Frame", "Value"])
+        self.resize(700, 400)
+        self._traceback = None
+        self.itemExpanded.connect(self.expandFrame)
+
+    def setTraceback(self, tb):
+        self._traceback = tb
+        self.clear()
+        self.setWindowTitle(tb.summary())
+        for index, (filename, lineno, name, line) in enumerate(tb.frames()):
+            item = QtGui.QTreeWidgetItem(self, ["{name}  {file}:{line}".format(name=name, file=filename, line=lineno)])
+            item.setData(0, QtCore.Qt.UserRole, index)
+            item.setChildIndicatorPolicy(QtGui.QTreeWidgetItem.ShowIndicator)
+        self.resizeColumnToContents(0)
+
+    def expandFrame(self, item):
+        if item.parent() is not None or item.childCount():
+            return
+        index = item.data(0, QtCore.Qt.UserRole)
+        filename, lineno, name, line = self._traceback.frames()[index]
+        QtGui.QTreeWidgetItem(item, ["source", line])
+        if not self._traceback.hasLocals():
+            QtGui.QTreeWidgetItem(item, ["locals", "no longer available"])
+            return
+        for localName, text in self._traceback.locals(index):
+            QtGui.QTreeWidgetItem(item, [localName, text])
+
+class QtTermProfileView(QtGui.QWidget):
+    """Sortable table of every row of a %prun or %sample result."""
 
-class QtTermWidget(QtGui.QWidget):
     def __init__(self, parent=None):
+        super(QtTermProfileView, self).__init__(parent)
+        self.setWindowFlags(QtCore.Qt.Tool)
+        self.resize(800, 500)
+        self._termWidget = parent
+        self._result = None
+
+        layout = QtGui.QVBoxLayout(self)
+        self._table = QtGui.QTableWidget(self)
+        self._table.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self._table.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
+        self._table.verticalHeader().hide()
+        self._table.itemDoubleClicked.connect(self.openRow)
+        layout.addWidget(self._table)
+
+        self._exportButton = QtGui.QPushButton("Export .pstats...", self)
+        self._exportButton.clicked.connect(self.export)
+        layout.addWidget(self._exportButton)
+
+    def setResult(self, result):
+        self._result = result
+        self.setWindowTitle(result.summary())
+        self._exportButton.setVisible(result.kind == 'prun')
+
+        table = self._table
+        table.setSortingEnabled(False)
+        table.clear()
+        if result.kind == 'sample':
+            header = ["samples", "share %", "file", "line"]
+            values = [(count, 100.0 * count / max(result.total, 1), filename, line)
+                      for count, filename, line in result.rows()]
+        else:
+            header = ["calls", "primitive", "tottime", "percall", "cumtime", "percall", "file", "line", "function"]
+            values = [(row.calls, row.primitiveCalls, row.totalTime, row.totalTime / max(row.calls, 1),
+                       row.cumulativeTime, row.cumulativeTime / max(row.primitiveCalls, 1),
+                       row.filename, row.line, row.function)
+                      for row in result.rows()]
+        table.setColumnCount(len(header))
+        table.setHorizontalHeaderLabels(header)
+        table.setRowCount(len(values))
+        for rowNumber, row in enumerate(values):
+            for column, value in enumerate(row):
+                item = QtGui.QTableWidgetItem()
+                # Numbers are stored as numbers so they sort as numbers.
+                item.setData(QtCore.Qt.DisplayRole, value)
+                table.setItem(rowNumber, column, item)
+        table.setSortingEnabled(True)
+        table.resizeColumnsToContents()
+
+    def openRow(self, item):
+        column = self._table.columnCount() - (1 if self._result.kind == 'sample' else 2)
+        filename = self._table.item(item.row(), column - 1).data(QtCore.Qt.DisplayRole)
+        line = self._table.item(item.row(), column).data(QtCore.Qt.DisplayRole)
+        if line:
+            self._termWidget.showSource(filename, line)
+
+    def export(self):
+        path = QtGui.QFileDialog.getSaveFileName(self, "Export Profile", "profile.pstats")
+        # PySide returns (path, filter), PyQt4 just the path.
+        if isinstance(path, tuple):
+            path = path[0]
+        if path:
+            self._result.dump(path)
+
+# Called as hook(widget, phase, seconds) as each console starts up: phase
+# 'construct' when its __init__ returns and 'show' when it is first shown,
+# both timed from the start of __init__.
+_startupHook = None
+
+def set_startup_hook(hook):
+    """Sets the function told how long consoles take to start, or None."""
+    global _startupHook
+    _startupHook = hook
+
+class DisplayExpander(object):
+    """Writes the full reprs of expression results to redirect from one worker thread.
+
+    Results are expanded in the order asked for; one already waiting or
+    being expanded isn't queued again, so repeated clicks cost nothing.
+    """
+
+    def __init__(self, redirect):
+        self._redirect = redirect
+        self._lock = Lock()
+        self._wake = Event()
+        self._queue = deque()
+        # The indexes queued or being expanded.
+        self._pending = set()
+        self._worker = None
+        self._stopped = False
+
+    def stop(self):
+        """Drops the queued results.  The worker isn't waited for, a repr may never return."""
+        with self._lock:
+            self._stopped = True
+            self._queue.clear()
+        self._wake.set()
+
+    def expand(self, index, value):
+        with self._lock:
+            if self._stopped or index in self._pending:
+                return
+            self._pending.add(index)
+            self._queue.append((index, value))
+        if self._worker is None:
+            self._worker = Thread(target=self._work, name='qtterm display')
+            self._worker.daemon = True
+            self._worker.start()
+        self._wake.set()
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if self._stopped:
+                    return
+                if not self._queue:
+                    self._wake.clear()
+                    continue
+                index, value = self._queue.popleft()
+
+            try:
+                text = _display.full_repr(value)
+            except Exception as e:
+                text = "repr failed: {error}".format(error=e)
+            with self._lock:
+                self._pending.discard(index)
+            self._redirect.write(text + "\n")
+            self._redirect.flush()
+
+class QtTermWidget(QtGui.QWidget):
+    def __init__(self, parent=None, kernel=False, historyPath=None, pool=None, namespace=None):
+        """historyPath is a directory executed code is recorded in, eg
+        qtterm.history.HISTORY_PATH.  Without one, or if it can't be opened,
+        history is only kept in memory.
+
+        Given a pool.FairPool, code runs on the pool's threads.  Given a
+        namespace dict, code runs in it rather than alongside this module.
+        """
+        self._startupStart = time.time()
+        self._startupTimes = {}
         super(QtTermWidget, self).__init__(parent)
 
         layout = QtGui.QVBoxLayout(self)
@@ -319,21 +3377,492 @@ class QtTermWidget(QtGui.QWidget):
         self._entry = QtTermEntryWidget(self)
         self._splitter.addWidget(self._entry)
 
+        self._resultsSearch = QtTermResultsSearch(self._results, self)
+        layout.addWidget(self._resultsSearch)
+
+        self._executionStatus = QtGui.QLabel(self)
+        layout.addWidget(self._executionStatus)
+
+        self._taskStatus = QtGui.QLabel(self)
+        self._taskStatus.hide()
+        layout.addWidget(self._taskStatus)
+
+        self._loadBar = QtGui.QWidget(self)
+        loadLayout = QtGui.QHBoxLayout(self._loadBar)
+        loadLayout.setContentsMargins(0, 0, 0, 0)
+        self._loadProgress = QtGui.QProgressBar(self._loadBar)
+        loadLayout.addWidget(self._loadProgress)
+        self._cancelLoad = QtGui.QPushButton("Cancel", self._loadBar)
+        loadLayout.addWidget(self._cancelLoad)
+        self._loadBar.hide()
+        layout.addWidget(self._loadBar)
+
+        self._usage = QtGui.QLabel(self)
+        layout.addWidget(self._usage)
+
+        self._kernelStatus = QtGui.QLabel(self)
+        self._kernelStatus.hide()
+        layout.addWidget(self._kernelStatus)
+
         self.setLayout(layout)
 
-        self._tracebacks = []
+        self._tracebacks = OrderedDict()
+        self._nextTraceback = 0
+        # Indexes of the tracebacks still holding their frames.
+        self._liveTracebacks = deque()
+        self._tracebackBrowser = None
+
+        self._profiles = OrderedDict()
+        self._nextProfile = 0
+        self._displays = OrderedDict()
+        self._nextDisplay = 0
+        self._expander = DisplayExpander(self._entry.stdoutRedirect)
+        self._profileView = None
+        self._sourceView = None
 
         self._entry.traceback.connect(self._results.handleTraceback)
+        self._entry.profile.connect(self._results.handleProfile)
+        self._entry.display.connect(self._results.handleDisplay)
 
         self._entry.stdoutRedirect.output.connect(self._results.handleOutput)
 
-    def traceback(self, index):
-        return self._tracebacks[index]
+        self._results.usageChanged.connect(self.updateUsage)
+        self._entry.cellFinished.connect(self._results.handleCellTiming)
+        self._entry.executed.connect(self.updateExecutionStatus)
+        self._entry.tasksChanged.connect(self.updateTaskStatus)
+        self._entry.loadProgress.connect(self.updateLoadProgress)
+        self._entry.loadFinished.connect(self._loadBar.hide)
+        self._cancelLoad.clicked.connect(self._entry.cancelLoad)
+
+        if pool is not None:
+            self._entry.setExecutor(QtTermExecutor(self._entry.stdoutRedirect, parent=self._entry, pool=pool))
+        if namespace is not None:
+            self._entry.setNamespace(namespace)
+        self._localExecutor = self._entry.executor
+        self._kernel = None
+
+        # Totals for usage, and when the console last did anything.
+        self._runs = 0
+        self._cpuTime = 0.0
+        self._wallTime = 0.0
+        self._pendingTasks = 0
+        self._lastActive = time.time()
+        self._entry.executed.connect(self._countRun)
+        self._entry.stdoutRedirect.output.connect(self._touch)
+
+        self.findAction = QtGui.QAction('Find in Output', self)
+        self.findAction.setShortcut(QtGui.QKeySequence("Ctrl+F"))
+        self.findAction.triggered.connect(self._resultsSearch.open)
+        self.addAction(self.findAction)
+
+        self.restartKernelAction = QtGui.QAction('Restart Kernel', self)
+        self.restartKernelAction.setShortcut(QtGui.QKeySequence("Ctrl+Shift+R"))
+        self.restartKernelAction.setEnabled(False)
+        self.restartKernelAction.triggered.connect(self.restartKernel)
+        self.addAction(self.restartKernelAction)
+
+        self.killKernelAction = QtGui.QAction('Kill Kernel', self)
+        self.killKernelAction.setEnabled(False)
+        self.killKernelAction.triggered.connect(self.killKernel)
+        self.addAction(self.killKernelAction)
+
+        self.setKernelMode(kernel)
+
+        history = None
+        if historyPath is not None:
+            try:
+                history = _history.open_store(historyPath)
+            except (IOError, OSError) as e:
+                self._entry.stdoutRedirect.write("History kept in memory, {path} can't be used: {error}\n".format(
+                    path=historyPath, error=e))
+        self._entry.setHistory(history if history is not None else _history.MemoryHistory())
+
+        self._startupPhase('construct')
+
+    def _startupPhase(self, phase):
+        seconds = time.time() - self._startupStart
+        self._startupTimes[phase] = seconds
+        if _startupHook is not None:
+            _startupHook(self, phase, seconds)
+
+    def startupTimes(self):
+        """Returns the seconds taken to reach each startup phase, see set_startup_hook."""
+        return dict(self._startupTimes)
+
+    def showEvent(self, event):
+        super(QtTermWidget, self).showEvent(event)
+        if 'show' not in self._startupTimes:
+            self._startupPhase('show')
+
+    def entryWidget(self):
+        return self._entry
+
+    def resultsWidget(self):
+        return self._results
+
+    def kernel(self):
+        return self._kernel
+
+    def setKernelMode(self, enabled, executable=None):
+        """Runs code in a child interpreter rather than in this process."""
+        if enabled and self._kernel is None:
+            self._kernel = QtTermKernel(self._entry.stdoutRedirect, executable=executable, parent=self)
+            self._kernel.statsChanged.connect(self.updateKernelStats)
+            self._kernel.start()
+            self._entry.setExecutor(self._kernel)
+            self._kernelStatus.setText("Kernel: pid {pid}".format(pid=self._kernel.pid()))
+            self._kernelStatus.show()
+        elif not enabled and self._kernel is not None:
+            self._entry.setExecutor(self._localExecutor)
+            self._kernel.shutdown()
+            self._kernel.deleteLater()
+            self._kernel = None
+            self._kernelStatus.hide()
+
+        self.restartKernelAction.setEnabled(enabled)
+        self.killKernelAction.setEnabled(enabled)
+
+    def restartKernel(self):
+        if self._kernel is not None:
+            self._kernel.restart()
+            self._kernelStatus.setText("Kernel: pid {pid}".format(pid=self._kernel.pid()))
+
+    def killKernel(self):
+        if self._kernel is not None:
+            self._kernel.kill()
+            self._kernelStatus.setText("Kernel: not running")
+
+    def updateKernelStats(self, stats):
+        self._kernelStatus.setText("Kernel: pid {pid}, {mb:.1f} MB, {cpu:.2f}s cpu".format(
+                pid=self._kernel.pid(),
+                mb=stats.get('memory', 0) / 1048576.0,
+                cpu=stats.get('cpu', 0),
+            )
+        )
+
+    def updateUsage(self, lines, size):
+        self._usage.setText("Scrollback: {lines} lines, {kb} KB, {tracebacks} tracebacks".format(
+                lines=lines,
+                kb=size // 1024,
+                tracebacks=len(self._tracebacks),
+            )
+        )
+
+    def updateLoadProgress(self, loaded, total):
+        # Percent rather than bytes, progress bars hold an int.
+        self._loadProgress.setValue(100 * loaded // max(total, 1))
+        self._loadBar.setVisible(self._entry.isLoading())
+
+    def updateExecutionStatus(self, record):
+        parts = [
+            "compile {time}".format(time=profiling.format_time(record['compileTime'])),
+            "wall {time}".format(time=profiling.format_time(record['wallTime'])),
+            "cpu {time}".format(time=profiling.format_time(record['cpuTime'])),
+            "{chars} chars out in {flushes} flushes".format(chars=record['outputChars'], flushes=record['flushes']),
+        ]
+        if record['peakMemory'] is not None:
+            parts.append("peak {kb:.1f} KB".format(kb=record['peakMemory'] / 1024.0))
+        if record['netMemory'] is not None:
+            parts.append("net {kb:+.1f} KB".format(kb=record['netMemory'] / 1024.0))
+        text = ", ".join(parts)
+        if record['label'] is not None:
+            text = "{label}: {text}".format(label=record['label'], text=text)
+        if record['failed']:
+            text += " (failed)"
+        self._executionStatus.setText(text)
+
+    def updateTaskStatus(self, pending):
+        self._pendingTasks = pending
+        self._taskStatus.setText("{pending} tasks pending, %tasks lists them and %cancel stops them".format(pending=pending))
+        self._taskStatus.setVisible(pending > 0)
+
+    def _countRun(self, record):
+        self._runs += 1
+        self._cpuTime += record['cpuTime']
+        self._wallTime += record['wallTime']
+        self._touch()
+
+    def _touch(self, *args):
+        self._lastActive = time.time()
+
+    def isBusy(self):
+        """Returns True while code or tasks are running, or a file is loading."""
+        return self._entry.executor.isBusy() or self._pendingTasks > 0 or self._entry.isLoading()
+
+    def idleTime(self):
+        """Returns the seconds since the console last ran code or wrote output."""
+        return 0.0 if self.isBusy() else time.time() - self._lastActive
+
+    def usage(self):
+        """Returns a dict of what the console uses.
+
+        'runs' counts its runs and 'cpuTime' and 'wallTime' are their total
+        seconds.  'namespaceBytes' adds up sys.getsizeof of each name's
+        value, so it is only an estimate.  'kernel' is the kernel's stats
+        in kernel mode, otherwise None.  The rest is the results widget's
+        memoryUsage.
+        """
+        namespaceBytes = 0
+        for value in list(self._entry.namespace().values()):
+            try:
+                namespaceBytes += sys.getsizeof(value)
+            except Exception:
+                pass
+        usage = self._results.memoryUsage()
+        usage.update({
+            'runs': self._runs,
+            'cpuTime': self._cpuTime,
+            'wallTime': self._wallTime,
+            'namespaceBytes': namespaceBytes,
+            'kernel': self._kernel.stats() if self._kernel is not None else None,
+        })
+        return usage
+
+    def shutdown(self):
+        """Drops queued runs, interrupts the running one, stops any kernel and
+        every worker thread, and removes the results' files.
+        """
+        self._entry.cancelLoad()
+        if self._pendingTasks:
+            self._entry.taskLoop().tasks.cancel()
+        self._entry.executor.clearQueue()
+        self._entry.executor.interrupt()
+        self.setKernelMode(False)
+        self._localExecutor.shutdown()
+        self._entry.shutdown()
+        self._expander.stop()
+        self._results.shutdown()
 
+    def traceback(self, index):
+        """Returns the StoredTraceback, or None if it has been released or evicted."""
+        tb = self._tracebacks.pop(index, None)
+        if tb is not None:
+            self._tracebacks[index] = tb
+        return tb
+
+    def releaseTraceback(self, index):
+        self._tracebacks.pop(index, None)
+
+    def showTraceback(self, index):
+        """Opens the stacktrace browser on a stored traceback."""
+        tb = self.traceback(index)
+        if tb is None:
+            return False
+        if self._tracebackBrowser is None:
+            self._tracebackBrowser = QtTermTracebackBrowser(self)
+        self._tracebackBrowser.setTraceback(tb)
+        self._tracebackBrowser.show()
+        self._tracebackBrowser.raise_()
+        return True
+
+    def profile(self, index):
+        """Returns a stored profiling result, or None if it has been evicted."""
+        return self._profiles.get(index)
+
+    def storeProfile(self, result):
+        index = self._nextProfile
+        self._nextProfile += 1
+        self._profiles[index] = result
+        while len(self._profiles) > PROFILE_STORE_SIZE:
+            self._profiles.popitem(last=False)
+        return index
+
+    def showProfile(self, index):
+        result = self.profile(index)
+        if result is None or result.kind == 'timeit':
+            return False
+        if self._profileView is None:
+            self._profileView = QtTermProfileView(self)
+        self._profileView.setResult(result)
+        self._profileView.show()
+        self._profileView.raise_()
+        return True
+
+    def displayResult(self, index):
+        """Returns a stored expression result, or None if it has been evicted."""
+        return self._displays.get(index)
+
+    def storeDisplay(self, result):
+        index = self._nextDisplay
+        self._nextDisplay += 1
+        self._displays[index] = result
+        while len(self._displays) > DISPLAY_STORE_SIZE:
+            self._displays.popitem(last=False)
+        return index
+
+    def expandDisplay(self, index):
+        """Writes the full repr of a stored expression result to the results.
+
+        The repr is built on a worker thread, very large ones are spilled to
+        disk by the results widget.
+        """
+        result = self.displayResult(index)
+        if result is None:
+            return False
+        self._expander.expand(index, result.value)
+        return True
+
+    def showSource(self, filename, line):
+        """Shows line of filename, in the entry widget if it came from there."""
+        if filename == INTERACTIVE_FILENAME:
+            block = self._entry.document().findBlockByNumber(line - 1)
+            if block.isValid():
+                self._entry.setTextCursor(QtGui.QTextCursor(block))
+                self._entry.setFocus()
+            return block.isValid()
+
+        lines = linecache.getlines(filename)
+        if not lines:
+            return False
+        if self._sourceView is None:
+            self._sourceView = QtGui.QPlainTextEdit(self)
+            self._sourceView.setWindowFlags(QtCore.Qt.Tool)
+            self._sourceView.setReadOnly(True)
+            self._sourceView.setFont(self._entry.font())
+            self._sourceView.resize(700, 500)
+            self._sourceView._highlighter = PythonHighlighter(self._sourceView)
+        self._sourceView.setWindowTitle(filename)
+        self._sourceView.setPlainText(''.join(lines))
+        block = self._sourceView.document().findBlockByNumber(line - 1)
+        self._sourceView.setTextCursor(QtGui.QTextCursor(block))
+        self._sourceView.centerCursor()
+        self._sourceView.show()
+        self._sourceView.raise_()
+        return True
 
     def storeTraceback(self, tb):
-        self._tracebacks.append(tb)
-        return len(self._tracebacks)-1
+        if not isinstance(tb, StoredTraceback):
+            tb = StoredTraceback(tb)
+        index = self._nextTraceback
+        self._nextTraceback += 1
+        self._tracebacks[index] = tb
+
+        if tb.hasLocals():
+            self._liveTracebacks.append(index)
+            while len(self._liveTracebacks) > TRACEBACK_FRAMES_KEPT:
+                old = self._tracebacks.get(self._liveTracebacks.popleft())
+                if old is not None:
+                    old.release()
+
+        while len(self._tracebacks) > TRACEBACK_STORE_SIZE:
+            self._tracebacks.popitem(last=False)
+        return index
+
+# Worker threads shared by the consoles of a QtTermSessions.
+SESSION_POOL_SIZE = 4
+# Consoles out of sight and idle this many seconds have their results
+# released, see QtTermResultsWidget.releaseDocument.  0 never releases.
+SESSION_IDLE_SECONDS = 300
+SESSION_CHECK_MS = 10000
+
+class QtTermSessions(QtGui.QTabWidget):
+    """Consoles in tabs, each with its own namespace, results and stores.
+
+    Every console runs its code on one FairPool, so however many are open
+    at most SESSION_POOL_SIZE threads run code and busy consoles take turns.
+    Each tab's tooltip shows what its console uses.
+    """
+
+    def __init__(self, parent=None, poolSize=SESSION_POOL_SIZE, historyPath=None):
+        super(QtTermSessions, self).__init__(parent)
+        self.setTabsClosable(True)
+        self.setMovable(True)
+        self._pool = FairPool(poolSize, name='qtterm session')
+        self._historyPath = historyPath
+        self._idleSeconds = SESSION_IDLE_SECONDS
+        self._nextNumber = 1
+
+        self.tabCloseRequested.connect(self.closeSession)
+        self.currentChanged.connect(self.updateUsage)
+
+        self._checkTimer = QtCore.QTimer(self)
+        self._checkTimer.setInterval(SESSION_CHECK_MS)
+        self._checkTimer.timeout.connect(self.releaseIdle)
+        self._checkTimer.timeout.connect(self.updateUsage)
+        self._checkTimer.start()
+
+        self.newSessionAction = QtGui.QAction('New Console', self)
+        self.newSessionAction.setShortcut(QtGui.QKeySequence("Ctrl+T"))
+        self.newSessionAction.triggered.connect(self.newSession)
+        self.addAction(self.newSessionAction)
+
+        self.newSession()
+
+    def pool(self):
+        return self._pool
+
+    def idleSeconds(self):
+        return self._idleSeconds
+
+    def setIdleSeconds(self, seconds):
+        self._idleSeconds = seconds
+
+    def session(self, index):
+        """Returns the QtTermWidget of a tab."""
+        return self.widget(index)
+
+    def sessions(self):
+        return [self.widget(index) for index in range(self.count())]
+
+    def newSession(self, name=None):
+        """Opens a console with an empty namespace in a new tab and returns it."""
+        if not name:
+            name = "Console {number}".format(number=self._nextNumber)
+        self._nextNumber += 1
+        # exec adds __builtins__ itself.
+        namespace = {'__name__': '__console__'}
+        console = QtTermWidget(self, historyPath=self._historyPath, pool=self._pool, namespace=namespace)
+        self.setCurrentIndex(self.addTab(console, name))
+        return console
+
+    def closeSession(self, index):
+        """Closes a tab, dropping its queued runs and interrupting its running one."""
+        console = self.widget(index)
+        if console is None:
+            return
+        self.removeTab(index)
+        console.shutdown()
+        console.deleteLater()
+        if not self.count():
+            self.newSession()
+
+    def shutdown(self):
+        """Shuts every console down and stops the pool they share."""
+        self._checkTimer.stop()
+        for console in self.sessions():
+            console.shutdown()
+        self._pool.stop()
+
+    def closeEvent(self, event):
+        self.shutdown()
+        super(QtTermSessions, self).closeEvent(event)
+
+    def releaseIdle(self):
+        """Releases the results of consoles out of sight for longer than idleSeconds."""
+        if not self._idleSeconds:
+            return
+        current = self.currentWidget()
+        for console in self.sessions():
+            results = console.resultsWidget()
+            if console is not current and not results.isReleased() and console.idleTime() > self._idleSeconds:
+                results.releaseDocument()
+
+    def updateUsage(self, *args):
+        for index, console in enumerate(self.sessions()):
+            usage = console.usage()
+            text = "{runs} runs, {cpu:.2f}s cpu, namespace {namespace} KB, results {lines} lines".format(
+                runs=usage['runs'],
+                cpu=usage['cpuTime'],
+                namespace=usage['namespaceBytes'] // 1024,
+                lines=usage['lines'],
+            )
+            if usage['releasedBytes']:
+                text += " (released, {kb} KB)".format(kb=usage['releasedBytes'] // 1024)
+            else:
+                text += " ({kb} KB)".format(kb=usage['bytes'] // 1024)
+            if usage['kernel'] is not None:
+                text += ", kernel {mb:.1f} MB".format(mb=usage['kernel'].get('memory', 0) / 1048576.0)
+            self.setTabToolTip(index, text)
 
 def main():
     import sys
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""
+Terminal escape handling for output shown in the results widget.
+
+AnsiParser turns output into runs of (text, Style), reading SGR colour and
+attribute codes and the carriage returns progress bars use to redraw their
+line.  A run whose text is None means "erase the line being written".  The
+parser keeps its state between chunks, so a colour set in one write applies
+to the next and an escape sequence split between two writes still works.
+
+Redraws within one chunk are collapsed as the chunk is parsed: a progress
+bar that ticked a hundred times since the last flush produces one run.
+Escape sequences other than SGR and erase-line are dropped.
+"""
+
+import re
+from collections import namedtuple
+
+# Colours are (red, green, blue) tuples, or None for the widget's default.
+Style = namedtuple('Style', 'foreground background bold italic underline inverse')
+
+DEFAULT_STYLE = Style(None, None, False, False, False, False)
+
+# The xterm palette for codes 30-37, 40-47 and their bright 90-97, 100-107
+# variants, which are also the first 16 of the 256 colour palette.
+BASIC_COLOURS = (
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+    (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+    (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+)
+
+_ESCAPE = r"""
+    \x1b\[(?P<params>[0-9;?]*)(?P<command>[@-~])
+  | \x1b\][^\x07\x1b]*(?:\x07|\x1b\\)
+  | \x1b[()][0-9A-Za-z]
+"""
+
+# An escape sequence, a carriage return, or a run of anything else.  A
+# sequence cut off by the end of a chunk is matched as partial so it can be
+# completed by the next one, any other stray escape character is dropped.
+_TOKEN_RE = re.compile(_ESCAPE + r"""
+  | (?P<partial>\x1b(?:\[[0-9;?]*|\][^\x07\x1b]*|[()])?\Z)
+  | \x1b
+  | (?P<cr>\r)
+  | (?P<text>[^\x1b\r]+)
+""", re.VERBOSE)
+
+_STRIP_RE = re.compile(_ESCAPE.replace('?P<params>', '').replace('?P<command>', '') + r'| \x1b', re.VERBOSE)
+
+
+def colour_rgb(index):
+    """Returns the (red, green, blue) of a 256 colour palette index."""
+    if index < 16:
+        return BASIC_COLOURS[index]
+    if index < 232:
+        index -= 16
+        levels = [0 if level == 0 else 55 + level * 40 for level in (index // 36, index // 6 % 6, index % 6)]
+        return tuple(levels)
+    grey = 8 + (index - 232) * 10
+    return (grey, grey, grey)
+
+
+def strip(text):
+    """Returns text with every escape sequence removed."""
+    return _STRIP_RE.sub('', text)
+
+
+def _extended_colour(codes, i):
+    """Reads the colour of a 38 or 48 code at codes[i].  Returns (colour, next i)."""
+    if codes[i+1:i+2] == [5] and i + 2 < len(codes):
+        return colour_rgb(codes[i+2] % 256), i + 3
+    if codes[i+1:i+2] == [2] and i + 4 < len(codes):
+        return tuple(max(0, min(c, 255)) for c in codes[i+2:i+5]), i + 5
+    return None, len(codes)
+
+
+def apply_sgr(style, params):
+    """Returns style changed by the codes of an SGR sequence, eg "1;31"."""
+    codes = [int(code) if code.isdigit() else 0 for code in params.split(';')]
+    fields = style._asdict()
+    i = 0
+    while i < len(codes):
+        code = codes[i]
+        i += 1
+        if code == 0:
+            fields = DEFAULT_STYLE._asdict()
+        elif code == 1:
+            fields['bold'] = True
+        elif code == 3:
+            fields['italic'] = True
+        elif code == 4:
+            fields['underline'] = True
+        elif code == 7:
+            fields['inverse'] = True
+        elif code == 22:
+            fields['bold'] = False
+        elif code == 23:
+            fields['italic'] = False
+        elif code == 24:
+            fields['underline'] = False
+        elif code == 27:
+            fields['inverse'] = False
+        elif 30 <= code <= 37:
+            fields['foreground'] = BASIC_COLOURS[code - 30]
+        elif 90 <= code <= 97:
+            fields['foreground'] = BASIC_COLOURS[code - 82]
+        elif 40 <= code <= 47:
+            fields['background'] = BASIC_COLOURS[code - 40]
+        elif 100 <= code <= 107:
+            fields['background'] = BASIC_COLOURS[code - 92]
+        elif code == 39:
+            fields['foreground'] = None
+        elif code == 49:
+            fields['background'] = None
+        elif code in (38, 48):
+            colour, i = _extended_colour(codes, i - 1)
+            if colour is not None:
+                fields['foreground' if code == 38 else 'background'] = colour
+    return Style(**fields)
+
+
+class AnsiParser(object):
+
+    def __init__(self):
+        self.style = DEFAULT_STYLE
+        # An escape sequence cut off at the end of the last chunk.
+        self._partial = ''
+        # A carriage return was seen, the next text replaces the line.
+        self._returned = False
+
+    def reset(self):
+        self.__init__()
+
+    def feed(self, text):
+        """Returns the [(text or None, Style)] runs for the next chunk of output."""
+        text = self._partial + text
+        self._partial = ''
+        runs = []
+        # Runs from lineStart on are the line being written.  Once the line
+        # is owned by this chunk, a redraw just drops them.
+        lineStart = 0
+        lineOwned = False
+
+        for match in _TOKEN_RE.finditer(text):
+            chunk = match.group('text')
+            if chunk is not None:
+                if self._returned:
+                    self._returned = False
+                    # A \r\n is just a line ending.
+                    if chunk[0] != '\n':
+                        del runs[lineStart:]
+                        if not lineOwned:
+                            runs.append((None, self.style))
+                            lineStart = len(runs)
+                            lineOwned = True
+
+                newline = chunk.rfind('\n') + 1
+                for part in (chunk[:newline], chunk[newline:]):
+                    if not part:
+                        continue
+                    if len(runs) > lineStart and runs[-1][1] == self.style:
+                        runs[-1] = (runs[-1][0] + part, self.style)
+                    else:
+                        runs.append((part, self.style))
+                    if part[-1] == '\n':
+                        lineStart = len(runs)
+                        lineOwned = True
+            elif match.group('cr') is not None:
+                self._returned = True
+            elif match.group('partial') is not None:
+                self._partial = match.group('partial')
+            elif match.group('command') == 'm':
+                self.style = apply_sgr(self.style, match.group('params'))
+            elif match.group('command') == 'K' and match.group('params') == '2':
+                self._returned = True
+        return runs
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+"""
+Cell splitting and compiled code caching for the entry widget.
+
+Lines starting with a "# %%" marker divide a script into cells, so parts of it
+can be run on their own.  Compiled code is kept in a small LRU keyed by a hash
+of its source, so re-running unchanged code never compiles it again.  Files
+run from disk are keyed by path and modification time instead, so an
+unchanged file is not even read.
+"""
+
+import __future__
+import ast
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+CELL_MARKER = re.compile(r'#\s*%%')
+
+CODE_CACHE_SIZE = 256
+
+# The code flags __future__ imports set, which a separately compiled final
+# expression has to be given to behave like the rest of its source.
+FUTURE_FLAGS = 0
+for _name in __future__.all_feature_names:
+    FUTURE_FLAGS |= getattr(__future__, _name).compiler_flag
+del _name
+
+
+def source_key(source):
+    """Returns a hash identifying source."""
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+
+def split_cells(source):
+    """Splits source at cell markers.
+
+    Returns a list of (first line, source) tuples, lines counted from 0.  Each
+    marker line starts the cell it belongs to; text before the first marker is
+    a cell of its own.
+    """
+    lines = source.split('\n')
+    cells = []
+    start = 0
+    for number, line in enumerate(lines):
+        if number and CELL_MARKER.match(line):
+            cells.append((start, '\n'.join(lines[start:number])))
+            start = number
+    cells.append((start, '\n'.join(lines[start:])))
+    return cells
+
+
+def cell_at(cells, line):
+    """Returns the index of the cell containing line."""
+    index = 0
+    for i, (start, source) in enumerate(cells):
+        if start > line:
+            break
+        index = i
+    return index
+
+
+class CodeCache(object):
+    """LRU of compiled code objects keyed by source hash."""
+
+    def __init__(self, size=CODE_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._codes = OrderedDict()
+        # Files can be compiled from the executor's thread.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._codes)
+
+    def clear(self):
+        with self._lock:
+            self._codes.clear()
+
+    def _cached(self, key, build):
+        with self._lock:
+            code = self._codes.pop(key, None)
+            if code is not None:
+                self.hits += 1
+                self._codes[key] = code
+                return code
+        self.misses += 1
+        code = build()
+        with self._lock:
+            self._codes[key] = code
+            while len(self._codes) > self.size:
+                self._codes.popitem(last=False)
+        return code
+
+    def compile(self, source, filename, mode='exec', firstLine=0, flags=0):
+        """Compiles source as if it started on line firstLine (from 0) of filename.
+
+        flags are passed on to compile().  Raises SyntaxError like compile()
+        does, failures are not cached.
+        """
+        key = (source_key(source), filename, mode, firstLine, flags)
+        # Padding keeps line numbers in tracebacks and syntax errors
+        # matching the lines of the whole buffer.
+        return self._cached(key, lambda: compile('\n' * firstLine + source, filename, mode, flags))
+
+    def compileDisplay(self, source, filename, firstLine=0):
+        """Like compile, but a final expression statement is compiled on its own.
+
+        Returns (code, expression) where expression is None, or the last
+        statement compiled in 'single' mode so running it passes its value to
+        sys.displayhook.
+        """
+        key = (source_key(source), filename, 'display', firstLine)
+
+        def build():
+            tree = ast.parse('\n' * firstLine + source, filename)
+            if not tree.body or not isinstance(tree.body[-1], ast.Expr):
+                return compile(tree, filename, 'exec'), None
+            expression = ast.Interactive(body=[tree.body.pop()])
+            code = compile(tree, filename, 'exec')
+            return code, compile(expression, filename, 'single', code.co_flags & FUTURE_FLAGS)
+        return self._cached(key, build)
+
+    def compileFile(self, path):
+        """Compiles the file at path, reading it only if it changed since last time.
+
+        Raises SyntaxError, or IOError/OSError if the file can't be read.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = ('file', path, stat.st_mtime, stat.st_size)
+
+        def build():
+            # Read as bytes so compile honours any coding declaration.
+            with open(path, 'rb') as handle:
+                return compile(handle.read(), path, 'exec')
+        return self._cached(key, build)
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+
+"""
+Symbol index for completing names and attribute chains in the entry widget.
+
+Names are kept in prefix tries, one for the names visible at the top level
+and one per attribute chain completed so far ("os.path", "numpy.linalg").
+Building and refreshing them calls dir() and getattr(), which can be slow and
+can run arbitrary code, so SymbolIndex.refresh and SymbolIndex.index are meant
+for a worker thread.  SymbolIndex.complete only walks tries that already
+exist and is cheap enough to call on every keystroke.
+"""
+
+import keyword
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+COMPLETION_LIMIT = 200
+
+# Attribute tries kept for the most recently completed chains.
+ATTRIBUTE_CACHE_SIZE = 128
+
+# Words sharing a prefix are kept in a sorted list until there are more than
+# this many, then split into a node per next character.
+BUCKET_SIZE = 32
+
+_EXPRESSION_RE = re.compile(r'[A-Za-z_][\w.]*$|$')
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*$')
+
+
+def expression_before(text):
+    """Returns the dotted name text ends with, eg "os.pa" for "x = os.pa"."""
+    return _EXPRESSION_RE.search(text).group(0)
+
+
+class PrefixTrie(object):
+    """A set of words that can be listed by prefix, in sorted order.
+
+    Nodes are dicts from a character to the next node.  A node's '' key marks
+    the end of a word.  Sparse subtrees are sorted lists of word suffixes
+    instead, which keeps large indexes compact.
+    """
+
+    def __init__(self, words=()):
+        self._root = {}
+        self._size = 0
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, word):
+        node = self._root
+        for i in range(len(word) + 1):
+            if i == len(word):
+                if '' not in node:
+                    node[''] = True
+                    self._size += 1
+                return
+            child = node.get(word[i])
+            if child is None:
+                node[word[i]] = [word[i+1:]]
+                self._size += 1
+                return
+            if isinstance(child, list):
+                suffix = word[i+1:]
+                position = bisect_left(child, suffix)
+                if position < len(child) and child[position] == suffix:
+                    return
+                child.insert(position, suffix)
+                self._size += 1
+                if len(child) > BUCKET_SIZE:
+                    node[word[i]] = self._burst(child)
+                return
+            node = child
+
+    def _burst(self, bucket):
+        node = {}
+        for suffix in bucket:
+            if suffix:
+                # The bucket is sorted, so each new list is too.
+                node.setdefault(suffix[0], []).append(suffix[1:])
+            else:
+                node[''] = True
+        return node
+
+    def discard(self, word):
+        path = []
+        node = self._root
+        for i in range(len(word) + 1):
+            if i == len(word):
+                if node.pop('', None) is None:
+                    return
+                break
+            child = node.get(word[i])
+            if child is None:
+                return
+            if isinstance(child, list):
+                suffix = word[i+1:]
+                position = bisect_left(child, suffix)
+                if position == len(child) or child[position] != suffix:
+                    return
+                del child[position]
+                if not child:
+                    del node[word[i]]
+                break
+            path.append((node, word[i]))
+            node = child
+        self._size -= 1
+
+        # Drop nodes left empty.
+        while path and not path[-1][0][path[-1][1]]:
+            parent, char = path.pop()
+            del parent[char]
+
+    def complete(self, prefix, limit=COMPLETION_LIMIT, hidePrivate=None):
+        """Returns up to limit words starting with prefix, sorted.
+
+        Words starting with an underscore are left out unless prefix starts
+        with one, or hidePrivate is False.
+        """
+        if hidePrivate is None:
+            hidePrivate = not prefix
+        node = self._root
+        for i, char in enumerate(prefix):
+            child = node.get(char)
+            if child is None:
+                return []
+            if isinstance(child, list):
+                rest = prefix[i+1:]
+                results = []
+                for suffix in child[bisect_left(child, rest):]:
+                    if not suffix.startswith(rest) or len(results) >= limit:
+                        break
+                    results.append(prefix[:i+1] + suffix)
+                return results
+            node = child
+
+        results = []
+        stack = [(prefix, node)]
+        while stack and len(results) < limit:
+            word, node = stack.pop()
+            if isinstance(node, list):
+                results.extend(word + suffix for suffix in node[:limit - len(results)])
+                continue
+            if '' in node:
+                results.append(word)
+            # Pushed in reverse so the smallest character is visited first.
+            for char in sorted((char for char in node if char), reverse=True):
+                if hidePrivate and char == '_' and word == prefix:
+                    continue
+                stack.append((word + char, node[char]))
+        return results
+
+
+def _fingerprint(value):
+    """Changes when value is replaced, or gains or loses attributes."""
+    try:
+        size = len(getattr(value, '__dict__', None) or ())
+    except Exception:
+        size = 0
+    return (id(value), type(value), size)
+
+
+class SymbolIndex(object):
+    """Completion candidates for a list of namespace dicts, searched in order."""
+
+    def __init__(self, namespaces=()):
+        self._lock = threading.Lock()
+        self._namespaces = list(namespaces)
+        # Filled in by the first refresh.
+        self._names = PrefixTrie()
+        self._nameSet = set()
+        # {dotted path: (fingerprint, PrefixTrie)}, least recently used first.
+        self._attributes = OrderedDict()
+
+    def setNamespaces(self, namespaces):
+        self._namespaces = list(namespaces)
+
+    def resolve(self, path):
+        """Returns the object a dotted path names, or raises LookupError.
+
+        Only plain names and attributes are followed, nothing is called.
+        """
+        parts = path.split('.')
+        if not all(_IDENTIFIER_RE.match(part) for part in parts):
+            raise LookupError(path)
+        for namespace in self._namespaces:
+            if parts[0] in namespace:
+                value = namespace[parts[0]]
+                break
+        else:
+            raise LookupError(path)
+        for part in parts[1:]:
+            try:
+                value = getattr(value, part)
+            except Exception:
+                raise LookupError(path)
+        return value
+
+    def refresh(self):
+        """Brings the name index up to date and drops stale attribute indexes."""
+        names = set(keyword.kwlist)
+        for namespace in self._namespaces:
+            # list() copies the keys in one step, even if another thread is
+            # adding names.
+            names.update(name for name in list(namespace) if isinstance(name, str))
+        with self._lock:
+            for name in names - self._nameSet:
+                self._names.add(name)
+            for name in self._nameSet - names:
+                self._names.discard(name)
+            self._nameSet = names
+            paths = list(self._attributes.items())
+
+        stale = []
+        for path, (fingerprint, trie) in paths:
+            try:
+                if _fingerprint(self.resolve(path)) != fingerprint:
+                    stale.append(path)
+            except LookupError:
+                stale.append(path)
+        with self._lock:
+            for path in stale:
+                self._attributes.pop(path, None)
+
+    def index(self, path):
+        """Builds the attribute index for path.  Returns False if it can't be resolved."""
+        try:
+            value = self.resolve(path)
+        except LookupError:
+            return False
+        try:
+            names = dir(value)
+        except Exception:
+            names = []
+        trie = PrefixTrie(name for name in names if isinstance(name, str))
+        with self._lock:
+            self._attributes.pop(path, None)
+            self._attributes[path] = (_fingerprint(value), trie)
+            while len(self._attributes) > ATTRIBUTE_CACHE_SIZE:
+                self._attributes.popitem(last=False)
+        return True
+
+    def complete(self, expression, limit=COMPLETION_LIMIT):
+        """Returns (candidates, None), or (None, path) if path has to be indexed first.
+
+        expression is a dotted name like "os.pa"; candidates are the words
+        that can replace its last part.
+        """
+        path, dot, prefix = expression.rpartition('.')
+        with self._lock:
+            if not dot:
+                return self._names.complete(prefix, limit), None
+            entry = self._attributes.get(path)
+            if entry is None:
+                return None, path
+            self._attributes[path] = self._attributes.pop(path)
+            return entry[1].complete(prefix, limit), None
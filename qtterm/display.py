@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+"""
+Bounded display of expression results for the entry widget.
+
+When the last statement of a run is an expression it is compiled in 'single'
+mode, which hands its value to sys.displayhook.  install_hook replaces
+sys.displayhook with a dispatcher that passes values from a thread running
+inside a DisplayHook to that hook, and everything else to the original.
+
+A DisplayHook summarises the value the way reprlib does, with every container
+cut short and long reprs truncated, so showing a huge list or array costs the
+same as showing a small one.  The summary is worked out on a helper thread
+and abandoned after DISPLAY_TIMEOUT seconds, so a slow __repr__ can't hold up
+the run.  An abandoned helper is interrupted the next time it runs python
+code, and while DISPLAY_ABANDONED of them are stuck in C code no more are
+started.  full_repr gives the untruncated text when it is asked for.
+"""
+
+import ctypes
+import sys
+import threading
+import time
+
+try:
+    from reprlib import Repr
+except ImportError:
+    from repr import Repr
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+# Summaries are cut off after this many characters.
+DISPLAY_CHARS = 2000
+# Items shown from each container, and how deep containers are followed.
+DISPLAY_ITEMS = 50
+DISPLAY_LEVELS = 4
+# Seconds a summary may take before it is given up on.
+DISPLAY_TIMEOUT = 1.0
+# Abandoned summaries that may still be running before new ones are skipped.
+DISPLAY_ABANDONED = 4
+
+# Containers with more items than this get their size and type in front.
+_LENGTH_PREFIX = 10
+
+# Threads running inside a DisplayHook, see _dispatch.
+_hooks = {}
+
+# Summary threads given up on that hadn't finished yet.
+_abandoned = []
+
+
+class _Abandoned(BaseException):
+    """Raised in a summary thread that took too long."""
+
+
+class _SummaryRepr(Repr):
+    """A Repr noting whether it left anything out, one per summary."""
+
+    def __init__(self):
+        Repr.__init__(self)
+        self.maxlevel = DISPLAY_LEVELS
+        self.maxtuple = self.maxlist = self.maxarray = DISPLAY_ITEMS
+        self.maxset = self.maxfrozenset = self.maxdeque = DISPLAY_ITEMS
+        self.maxdict = DISPLAY_ITEMS // 2
+        self.maxstring = self.maxlong = self.maxother = DISPLAY_CHARS
+        self.truncated = False
+
+    def _cut(self, text, size):
+        """Shortens text to size characters by leaving out its middle."""
+        if len(text) <= size:
+            return text
+        self.truncated = True
+        head = max(0, (size - 3) // 2)
+        tail = max(0, size - 3 - head)
+        return text[:head] + '...' + text[len(text) - tail:]
+
+    def _repr_iterable(self, x, level, left, right, maxiter, trail=''):
+        if (level <= 0 and len(x)) or len(x) > maxiter:
+            self.truncated = True
+        return Repr._repr_iterable(self, x, level, left, right, maxiter, trail)
+
+    def repr_dict(self, x, level):
+        if len(x) and (level <= 0 or len(x) > self.maxdict):
+            self.truncated = True
+        return Repr.repr_dict(self, x, level)
+
+    def repr_str(self, x, level):
+        return self._cut(repr(x[:self.maxstring]), self.maxstring)
+
+    def repr_int(self, x, level):
+        return self._cut(repr(x), self.maxlong)
+
+    repr_long = repr_int
+
+    def repr_instance(self, x, level):
+        numpy = sys.modules.get('numpy')
+        if numpy is not None and isinstance(x, numpy.ndarray):
+            if x.size > DISPLAY_ITEMS:
+                self.truncated = True
+            return _array_summary(numpy, x)
+        try:
+            text = repr(x)
+        except Exception:
+            return '<{type} instance at {id:#x}>'.format(type=type(x).__name__, id=id(x))
+        return self._cut(text, self.maxother)
+
+
+def _array_summary(numpy, array):
+    # array2string leaves out the middle of big arrays itself, so this never
+    # formats more than a few edge items per axis.
+    text = numpy.array2string(array, threshold=DISPLAY_ITEMS, edgeitems=3, separator=', ')
+    return "array({text}, shape={shape}, dtype={dtype})".format(
+        text=text, shape=array.shape, dtype=array.dtype)
+
+
+def summarize(value):
+    """Returns (text, truncated) for a repr of value no longer than DISPLAY_CHARS.
+
+    truncated is False only if text is the whole repr, however big value is.
+    """
+    summary = _SummaryRepr()
+    try:
+        text = summary.repr(value)
+        truncated = summary.truncated
+        try:
+            length = len(value) if isinstance(value, (list, tuple, dict, set, frozenset)) else None
+        except Exception:
+            length = None
+        if length is not None and length > _LENGTH_PREFIX:
+            text = "{type} of {length} items: {text}".format(
+                type=type(value).__name__, length=length, text=text)
+    except Exception as e:
+        text = "<{type} object, repr failed: {error}>".format(type=type(value).__name__, error=e)
+        truncated = True
+    if len(text) > DISPLAY_CHARS:
+        text = text[:DISPLAY_CHARS] + '...'
+        truncated = True
+    return text, truncated
+
+
+def full_repr(value):
+    """Returns the complete repr of value, arrays included."""
+    numpy = sys.modules.get('numpy')
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return numpy.array2string(value, threshold=sys.maxsize, separator=', ')
+    return repr(value)
+
+
+class DisplayResult(object):
+    kind = 'display'
+
+    def __init__(self, value, text, truncated):
+        self.value = value
+        self.text = text
+        # False if text is known to be the whole repr.
+        self.truncated = truncated
+
+    def summary(self):
+        return self.text
+
+
+class DisplayHook(object):
+    """Collects the value of a run's final expression and stores it in namespace['_']."""
+
+    def __init__(self, namespace, timeout=DISPLAY_TIMEOUT):
+        self.namespace = namespace
+        self.timeout = timeout
+        self.result = None
+
+    def __call__(self, value):
+        if value is None:
+            return
+        self.namespace['_'] = value
+        _abandoned[:] = [worker for worker in _abandoned if worker.is_alive()]
+        if len(_abandoned) >= DISPLAY_ABANDONED:
+            text = "<{type} object, earlier reprs are still running>".format(type=type(value).__name__)
+            self.result = DisplayResult(value, text, True)
+            return
+
+        summary = []
+        lock = threading.Lock()
+        worker = threading.Thread(target=_summarize_into, args=(value, summary, lock), name='qtterm display')
+        worker.daemon = True
+        worker.start()
+        worker.join(self.timeout)
+        with lock:
+            if not summary:
+                # Tells the worker not to finish, the exception is on its way.
+                summary.append(None)
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(worker.ident), ctypes.py_object(_Abandoned))
+                _abandoned.append(worker)
+        if summary[0] is not None:
+            text, truncated = summary[0]
+        else:
+            text = "<{type} object, repr took longer than {timeout}s>".format(
+                type=type(value).__name__, timeout=self.timeout)
+            truncated = True
+        self.result = DisplayResult(value, text, truncated)
+
+
+def _summarize_into(value, summary, lock):
+    """Appends summarize(value) to summary, unless the summary was abandoned."""
+    try:
+        result = summarize(value)
+        with lock:
+            abandoned = bool(summary)
+            if not abandoned:
+                summary.append(result)
+        while abandoned:
+            # Wait here for _Abandoned rather than let it escape the thread.
+            time.sleep(0.001)
+    except _Abandoned:
+        pass
+
+
+def _dispatch(value):
+    hook = _hooks.get(get_ident())
+    if hook is None:
+        return _dispatch.original(value)
+    hook(value)
+
+_dispatch.original = sys.displayhook
+
+
+def install_hook():
+    """Replaces sys.displayhook with the dispatcher, unless it already is."""
+    if sys.displayhook is not _dispatch:
+        _dispatch.original = sys.displayhook
+        sys.displayhook = _dispatch
+
+
+def runner(expression, hook):
+    """Returns an executor runner that runs its code, then expression under hook.
+
+    The runner returns the hook's DisplayResult, or None if the expression
+    evaluated to None.
+    """
+    def run(code, globals_, locals_):
+        exec(code, globals_, locals_)
+        install_hook()
+        ident = get_ident()
+        previous = _hooks.get(ident)
+        _hooks[ident] = hook
+        hook.result = None
+        try:
+            exec(expression, globals_, locals_)
+        finally:
+            if previous is None:
+                _hooks.pop(ident, None)
+            else:
+                _hooks[ident] = previous
+        return hook.result
+    return run
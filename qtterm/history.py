@@ -0,0 +1,451 @@
+#!/usr/bin/python
+
+"""
+Persistent execution history for the entry widget.
+
+A store is a directory of three files:
+
+    history.dat     every entry's source as UTF-8, back to back
+    history.idx     an (offset, length) pair per entry, fixed size, in order
+    history.sorted  entry numbers ordered by source, for prefix lookups
+
+Entries are only ever appended, so the data and index files are memory
+mapped and nothing is read until it is asked for; opening a store of any
+size costs the same.  The files can be shared by several processes.  Appends
+take history.lock and write at the end of the files, wherever another
+process left it, and each store maps the files again once they have grown,
+so entries appended elsewhere show up as newer entries.
+
+history.sorted covers the entries present at the last compaction.  Once more
+than COMPACT_THRESHOLD entries fall outside it a background thread rewrites
+the store, dropping all but the newest copy of duplicate entries, and swaps
+the new files in.  Compaction renumbers entries, so anything holding entry
+numbers should check generation() before using them.
+
+Substring search has no index: it scans history.dat backwards, so it costs
+time in proportion to the history searched.  It takes the lock a chunk at a
+time and can be cancelled between chunks, so it belongs on a worker thread.
+
+Stores are shared per path within a process, see open_store.  MemoryHistory
+offers the same interface without any files.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.qtterm', 'history')
+
+# Entries allowed outside the sorted index before the store is compacted.
+COMPACT_THRESHOLD = 1000
+
+# Bytes of history.dat searched at a time, between which the lock is released
+# and cancellation is checked.
+SEARCH_CHUNK = 1 << 20
+
+_INDEX = struct.Struct('<QI')
+_ORDER = struct.Struct('<I')
+
+_stores = {}
+_storesLock = threading.Lock()
+
+
+def open_store(path=None):
+    """Returns the HistoryStore for path, shared by everything in this process.
+
+    Raises OSError or IOError if the store's directory can't be created.
+    """
+    path = os.path.realpath(path or HISTORY_PATH)
+    with _storesLock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = HistoryStore(path)
+        return store
+
+
+def _map(path):
+    """Returns a read only mapping of path, or b'' if it is empty or missing."""
+    try:
+        with open(path, 'rb') as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError):
+        return b''
+
+
+def _close(mapping):
+    if isinstance(mapping, mmap.mmap):
+        mapping.close()
+
+
+def _stat(path):
+    """Returns ((device, inode), size) of path, or (None, 0) if it is missing.
+
+    The first tells a file from another renamed over it.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, 0
+    return (stat.st_dev, stat.st_ino), stat.st_size
+
+
+class _FileLock(object):
+    """Holds an exclusive lock on a file while in a with block, across processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._handle = None
+
+    def __enter__(self):
+        self._handle = open(self.path, 'ab')
+        if fcntl is not None:
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_EX)
+        else:
+            self._handle.seek(0)
+            msvcrt.locking(self._handle.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+            else:
+                self._handle.seek(0)
+                msvcrt.locking(self._handle.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._handle.close()
+            self._handle = None
+
+
+class HistoryStore(object):
+    """An append-only list of executed sources, see the module docstring."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._dataPath = os.path.join(path, 'history.dat')
+        self._indexPath = os.path.join(path, 'history.idx')
+        self._sortedPath = os.path.join(path, 'history.sorted')
+        self._fileLock = _FileLock(os.path.join(path, 'history.lock'))
+
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._compactor = None
+        self._data = self._index = self._sorted = b''
+        with self._lock:
+            with self._fileLock:
+                self._dropPartialEntry()
+            self._load()
+        self.compactInBackground()
+
+    def _dropPartialEntry(self):
+        """Cuts off an index entry left partly written by a crash.  Call with the file lock held."""
+        try:
+            size = os.path.getsize(self._indexPath)
+        except OSError:
+            return
+        if size % _INDEX.size:
+            with open(self._indexPath, 'r+b') as handle:
+                handle.truncate(size - size % _INDEX.size)
+
+    def _load(self):
+        for mapping in (self._data, self._index, self._sorted):
+            _close(mapping)
+        self._identity = _stat(self._indexPath)[0]
+        # The index first, so the data mapped after it holds every entry it lists.
+        self._index = _map(self._indexPath)
+        self._data = _map(self._dataPath)
+        self._sorted = _map(self._sortedPath)
+        self._mapped = len(self._index) // _INDEX.size
+        self._sortedCount = len(self._sorted) // _ORDER.size
+
+    def _refresh(self):
+        """Maps the files again if they grew or were replaced.  Call with the lock held."""
+        identity, size = _stat(self._indexPath)
+        if identity != self._identity or size < len(self._index):
+            # Another process compacted the store.
+            self._load()
+            self._generation += 1
+        elif size // _INDEX.size > self._mapped:
+            self._load()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self._mapped
+
+    def generation(self):
+        """Returns a number that changes whenever entries are renumbered."""
+        return self._generation
+
+    def _offset(self, index):
+        return _INDEX.unpack_from(self._index, index * _INDEX.size)
+
+    def _raw(self, index):
+        offset, length = self._offset(index)
+        return self._data[offset:offset+length]
+
+    def _order(self, position):
+        return _ORDER.unpack_from(self._sorted, position * _ORDER.size)[0]
+
+    def entry(self, index):
+        """Returns the source of entry index, counted from the oldest."""
+        with self._lock:
+            self._refresh()
+            if index < 0:
+                index += self._mapped
+            if not 0 <= index < self._mapped:
+                raise IndexError(index)
+            return self._raw(index).decode('utf-8')
+
+    def append(self, source):
+        data = source.encode('utf-8')
+        with self._lock:
+            with self._fileLock:
+                self._dropPartialEntry()
+                with open(self._dataPath, 'ab') as handle:
+                    # Wherever the last append, from any process, left the end.
+                    handle.seek(0, 2)
+                    offset = handle.tell()
+                    handle.write(data)
+                with open(self._indexPath, 'ab') as handle:
+                    handle.write(_INDEX.pack(offset, len(data)))
+            self._refresh()
+        if self.needsCompaction():
+            self.compactInBackground()
+
+    def search(self, text, before=None, cancelled=None):
+        """Returns the newest entry before index before containing text, or -1.
+
+        This is a linear scan, see the module docstring.  None is returned if
+        cancelled() turns true between chunks.  If the entries are renumbered
+        meanwhile the search starts again from the newest entry.
+        """
+        needle = text.encode('utf-8')
+        with self._lock:
+            self._refresh()
+            if before is None or before > self._mapped:
+                before = self._mapped
+            if not self._mapped or not needle:
+                return before - 1
+            generation = self._generation
+            end = self._offset(before)[0] if before < self._mapped else len(self._data)
+
+        while end >= len(needle):
+            if cancelled is not None and cancelled():
+                return None
+            with self._lock:
+                self._refresh()
+                if generation != self._generation:
+                    generation = self._generation
+                    end = len(self._data)
+                    continue
+                # Search the mapped data directly, then find which entry the
+                # match is in.  Matches spanning two entries are skipped.
+                start = max(end - SEARCH_CHUNK - len(needle), 0)
+                position = self._data.rfind(needle, start, end)
+                while position >= 0:
+                    index = self._entryAt(position)
+                    offset, length = self._offset(index)
+                    if position + len(needle) <= offset + length:
+                        return index
+                    position = self._data.rfind(needle, start, position + len(needle) - 1)
+            if not start:
+                break
+            # The next chunk overlaps this one by all but a byte of the needle,
+            # and is longer than it so the search moves on.
+            end = start + len(needle) - 1
+        return -1
+
+    def _entryAt(self, position):
+        low, high = 0, self._mapped - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._offset(middle)[0] <= position:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def prefixMatches(self, prefix):
+        """Returns the numbers of the entries starting with prefix, oldest first."""
+        with self._lock:
+            self._refresh()
+            needle = prefix.encode('utf-8')
+
+            # Entries sorted by source make those sharing a prefix contiguous,
+            # so both ends are found by binary search in the mapped order.
+            low, high = 0, self._sortedCount
+            while low < high:
+                middle = (low + high) // 2
+                if self._raw(self._order(middle)) < needle:
+                    low = middle + 1
+                else:
+                    high = middle
+            start = low
+            high = self._sortedCount
+            while low < high:
+                middle = (low + high) // 2
+                if self._raw(self._order(middle))[:len(needle)] == needle:
+                    low = middle + 1
+                else:
+                    high = middle
+            matches = sorted(self._order(position) for position in range(start, low))
+
+            # Entries since the last compaction are checked one by one, there
+            # are about COMPACT_THRESHOLD of them at most.
+            for index in range(self._sortedCount, self._mapped):
+                if self._raw(index).startswith(needle):
+                    matches.append(index)
+            return matches
+
+    def needsCompaction(self):
+        return self._mapped - self._sortedCount > COMPACT_THRESHOLD
+
+    def compactInBackground(self):
+        """Starts compaction on a worker thread if it is needed and not running."""
+        with self._lock:
+            if not self.needsCompaction() or self._compactor is not None:
+                return
+            self._compactor = threading.Thread(target=self.compact, name='qtterm history')
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _write(self, entries, suffix):
+        """Writes entries as a store with suffix added to the file names.
+
+        Returns the size of the data written.
+        """
+        offset = 0
+        with open(self._dataPath + suffix, 'wb') as data:
+            with open(self._indexPath + suffix, 'wb') as index:
+                for entry in entries:
+                    data.write(entry)
+                    index.write(_INDEX.pack(offset, len(entry)))
+                    offset += len(entry)
+        order = array('I', sorted(range(len(entries)), key=entries.__getitem__))
+        with open(self._sortedPath + suffix, 'wb') as handle:
+            handle.write(order.tobytes() if hasattr(order, 'tobytes') else order.tostring())
+        return offset
+
+    def compact(self):
+        """Rewrites the store without duplicates and with a complete sorted index."""
+        suffix = '.{pid}.{thread}.tmp'.format(pid=os.getpid(), thread=id(self))
+        data = index = b''
+        try:
+            with self._lock:
+                with self._fileLock:
+                    self._refresh()
+                    # Mapped separately, the store's own maps are replaced
+                    # whenever the files grow.
+                    data, index = _map(self._dataPath), _map(self._indexPath)
+                generation = self._generation
+                identity = self._identity
+                mapped = len(index) // _INDEX.size
+
+            # The files only grow until the swap below, so the slow part can
+            # run without the lock.
+            entries = []
+            for i in range(mapped):
+                offset, length = _INDEX.unpack_from(index, i * _INDEX.size)
+                entries.append(data[offset:offset+length])
+            _close(data)
+            _close(index)
+            seen = set()
+            unique = []
+            for entry in reversed(entries):
+                if entry not in seen:
+                    seen.add(entry)
+                    unique.append(entry)
+            unique.reverse()
+            size = self._write(unique, suffix)
+
+            with self._lock:
+                with self._fileLock:
+                    if generation != self._generation or _stat(self._indexPath)[0] != identity:
+                        # Another store compacted the files first.
+                        return
+                    # Entries appended meanwhile, by any process, go after the
+                    # sorted ones, the next compaction dedupes them.
+                    data, index = _map(self._dataPath), _map(self._indexPath)
+                    try:
+                        with open(self._dataPath + suffix, 'ab') as dataFile:
+                            with open(self._indexPath + suffix, 'ab') as indexFile:
+                                for i in range(mapped, len(index) // _INDEX.size):
+                                    offset, length = _INDEX.unpack_from(index, i * _INDEX.size)
+                                    dataFile.write(data[offset:offset+length])
+                                    indexFile.write(_INDEX.pack(size, length))
+                                    size += length
+                    finally:
+                        _close(data)
+                        _close(index)
+
+                    for mapping in (self._data, self._index, self._sorted):
+                        _close(mapping)
+                    self._data = self._index = self._sorted = b''
+                    for path in (self._dataPath, self._indexPath, self._sortedPath):
+                        if os.name == 'nt' and os.path.exists(path):
+                            os.remove(path)
+                        os.rename(path + suffix, path)
+                    self._load()
+                self._generation += 1
+        finally:
+            _close(data)
+            _close(index)
+            for path in (self._dataPath, self._indexPath, self._sortedPath):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            self._compactor = None
+
+    def close(self):
+        with self._lock:
+            for mapping in (self._data, self._index, self._sorted):
+                _close(mapping)
+            self._data = self._index = self._sorted = b''
+            self._mapped = self._sortedCount = 0
+
+
+class MemoryHistory(object):
+    """A HistoryStore kept in a list, for consoles that don't persist history."""
+
+    def __init__(self):
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self):
+        return 0
+
+    def entry(self, index):
+        return self._entries[index]
+
+    def append(self, source):
+        self._entries.append(source)
+
+    def search(self, text, before=None, cancelled=None):
+        if before is None or before > len(self._entries):
+            before = len(self._entries)
+        for index in range(before - 1, -1, -1):
+            if cancelled is not None and cancelled():
+                return None
+            if text in self._entries[index]:
+                return index
+        return -1
+
+    def prefixMatches(self, prefix):
+        return [index for index, source in enumerate(self._entries) if source.startswith(prefix)]
+
+    def close(self):
+        pass
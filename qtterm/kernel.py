@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+"""
+Out-of-process execution kernel for qtterm.
+
+QtTermKernel runs this file as a script in a child interpreter.  Requests and
+replies are pickled dictionaries, each preceded by a four byte length, sent
+over the child's stdin and a private copy of its stdout.  The real stdout and
+stdin file descriptors are pointed elsewhere so nothing the user's code does
+can corrupt the stream.
+
+Requests:
+    {'op': 'execute', 'id': int, 'code': marshalled code object}
+    {'op': 'shutdown'}
+
+Replies:
+    {'op': 'stdout' or 'stderr', 'data': str}
+    {'op': 'done', 'id': int, 'traceback': list or None, 'error': str or None,
+     'elapsed': float, 'cpu': float, 'outputChars': int, 'flushes': int,
+     'stats': dict}
+
+Tracebacks are lists of (filename, lineno, name, line) tuples, the same shape
+traceback.extract_tb returns and QtTermWidget.storeTraceback stores.
+
+Code is marshalled, and marshal only loads code written by the exact same
+python version.  The host passes its MAGIC_NUMBER as the script's argument and
+a child with another one reports it and exits with VERSION_MISMATCH, so a
+custom kernel executable has to be the host's python version.
+"""
+
+import binascii
+import marshal
+import os
+import pickle
+import signal
+import struct
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+_HEADER = struct.Struct('>I')
+
+# Child output is sent once this many characters are waiting, or every
+# OUTPUT_INTERVAL seconds otherwise.
+OUTPUT_BUFFER_SIZE = 1 << 14
+OUTPUT_INTERVAL = 0.02
+
+# Exit code of a child whose python can't load the host's marshalled code.
+VERSION_MISMATCH = 3
+
+
+def magic_hex():
+    """Returns this python's bytecode magic number as the host passes it."""
+    return binascii.hexlify(MAGIC_NUMBER).decode('ascii')
+
+
+def send_message(stream, message):
+    data = pickle.dumps(message, 2)
+    stream.write(_HEADER.pack(len(data)) + data)
+    stream.flush()
+
+
+def _read_exactly(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(stream):
+    """Returns the next message on stream, or None once it is closed."""
+    header = _read_exactly(stream, _HEADER.size)
+    if header is None:
+        return None
+    data = _read_exactly(stream, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def thread_cpu_time():
+    """Returns cpu seconds used by this thread, or by the process before python 3.7."""
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    times = os.times()
+    return times[0] + times[1]
+
+
+def usage():
+    """Returns the cpu seconds and bytes of memory used by this process."""
+    times = os.times()
+    stats = {'cpu': times[0] + times[1], 'memory': 0}
+    try:
+        with open('/proc/self/statm') as statm:
+            stats['memory'] = int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, AttributeError):
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Linux reports kilobytes, macOS bytes.
+            stats['memory'] = peak if sys.platform == 'darwin' else peak * 1024
+    return stats
+
+
+class _Channel(object):
+    """Serialises messages from the executing code and the output flusher."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            send_message(self._stream, message)
+
+
+class _OutputStream(object):
+    """Stands in for sys.stdout/sys.stderr, forwarding writes as messages."""
+
+    def __init__(self, channel, name):
+        self._channel = channel
+        self._name = name
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._size = 0
+        self.softspace = 0
+        # Characters written and messages sent, for the done reply.
+        self.written = 0
+        self.flushes = 0
+
+    def write(self, data):
+        with self._lock:
+            self._buffer.append(data)
+            self._size += len(data)
+            self.written += len(data)
+            full = self._size >= OUTPUT_BUFFER_SIZE
+        if full:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self.flushes += 1
+            self._channel.send({'op': self._name, 'data': data})
+
+    def isatty(self):
+        return False
+
+
+# SIGINT only interrupts user code, it is ignored between runs.
+_running = [False]
+
+
+def _interrupt(signum, frame):
+    if _running[0]:
+        raise KeyboardInterrupt
+
+
+def _flush_periodically(streams):
+    while True:
+        time.sleep(OUTPUT_INTERVAL)
+        for stream in streams:
+            stream.flush()
+
+
+def _read_requests(stream, requests):
+    while True:
+        message = recv_message(stream)
+        if message is None:
+            requests.put({'op': 'shutdown'})
+            return
+        requests.put(message)
+
+
+def main():
+    requests_in = os.fdopen(os.dup(0), 'rb')
+    replies_out = os.fdopen(os.dup(1), 'wb')
+
+    # Anything written to the real file descriptors now goes to stderr, and
+    # reads from stdin see an empty file, instead of touching the protocol.
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(2, 1)
+
+    channel = _Channel(replies_out)
+    if len(sys.argv) > 1 and sys.argv[1] != magic_hex():
+        channel.send({'op': 'stderr', 'data':
+            "The kernel runs python {version}, which can't load code compiled by the console's "
+            "python.  Use an interpreter of the console's version.\n".format(version=sys.version.split()[0])})
+        sys.exit(VERSION_MISMATCH)
+
+    stdout = _OutputStream(channel, 'stdout')
+    stderr = _OutputStream(channel, 'stderr')
+    sys.stdout = stdout
+    sys.stderr = stderr
+
+    requests = queue.Queue()
+    for target, args in ((_read_requests, (requests_in, requests)),
+                         (_flush_periodically, ((stdout, stderr),))):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    if hasattr(signal, 'SIGINT'):
+        signal.signal(signal.SIGINT, _interrupt)
+
+    namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+
+    while True:
+        request = requests.get()
+        if request['op'] == 'shutdown':
+            break
+
+        tb = None
+        error = None
+        written = stdout.written + stderr.written
+        flushes = stdout.flushes + stderr.flushes
+        cpu = thread_cpu_time()
+        start = time.time()
+        try:
+            _running[0] = True
+            exec(marshal.loads(request['code']), namespace)
+            _running[0] = False
+        except BaseException:
+            _running[0] = False
+            type_, value_, traceback_ = sys.exc_info()
+            # The first frame is the exec above.
+            tb = [tuple(frame) for frame in traceback.extract_tb(traceback_.tb_next)]
+            error = traceback.format_exception_only(type_, value_)[-1].strip()
+        elapsed = time.time() - start
+        cpu = thread_cpu_time() - cpu
+
+        stdout.flush()
+        stderr.flush()
+        channel.send({
+            'op': 'done',
+            'id': request['id'],
+            'traceback': tb,
+            'error': error,
+            'elapsed': elapsed,
+            'cpu': cpu,
+            'outputChars': stdout.written + stderr.written - written,
+            'flushes': stdout.flushes + stderr.flushes - flushes,
+            'stats': usage(),
+        })
+
+
+if __name__ == "__main__":
+    main()
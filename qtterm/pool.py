@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+"""
+A worker pool shared by several consoles.
+
+FairPool runs jobs on at most a fixed number of threads.  Jobs are queued per
+owner, each owner's jobs run one at a time in the order they were submitted,
+and owners with jobs waiting take turns: when a worker comes free it takes
+the next job of the owner that has waited longest, so a console queueing a
+hundred runs doesn't hold up the one that queued a single run after it.
+"""
+
+import threading
+from collections import OrderedDict, deque
+
+# Worker threads a pool starts at most.
+POOL_SIZE = 4
+
+
+class FairPool(object):
+
+    def __init__(self, size=POOL_SIZE, name='qtterm pool'):
+        self._size = max(1, size)
+        self._name = name
+        self._condition = threading.Condition()
+        # {owner: deque of jobs}, in the order the owners get their turn.
+        self._queues = OrderedDict()
+        # Owners with a job running, they wait for it before their next.
+        self._running = set()
+        self._workers = []
+        self._idle = 0
+        self._stopped = False
+
+    def size(self):
+        return self._size
+
+    def submit(self, owner, job):
+        """Queues job, a callable taking no arguments, behind owner's other jobs.
+
+        Raises RuntimeError once the pool is stopped.
+        """
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("submit to a stopped pool")
+            jobs = self._queues.get(owner)
+            if jobs is None:
+                jobs = self._queues[owner] = deque()
+            jobs.append(job)
+            if not self._idle and len(self._workers) < self._size:
+                worker = threading.Thread(target=self._work, name=self._name)
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+            self._condition.notify()
+
+    def stop(self):
+        """Drops the jobs that haven't started and ends the workers.
+
+        Idle workers end at once, busy ones once their job returns, which
+        isn't waited for.
+        """
+        with self._condition:
+            self._stopped = True
+            self._queues.clear()
+            self._condition.notify_all()
+
+    def workers(self):
+        """Returns the number of worker threads still running."""
+        with self._condition:
+            return len(self._workers)
+
+    def cancel(self, owner):
+        """Drops owner's jobs that haven't started.  Returns how many there were."""
+        with self._condition:
+            jobs = self._queues.pop(owner, None)
+            return len(jobs) if jobs else 0
+
+    def pending(self, owner=None):
+        """Returns the number of jobs waiting, owner's or everybody's."""
+        with self._condition:
+            if owner is not None:
+                return len(self._queues.get(owner, ()))
+            return sum(len(jobs) for jobs in self._queues.values())
+
+    def running(self):
+        """Returns the number of jobs running."""
+        with self._condition:
+            return len(self._running)
+
+    def _next(self):
+        """Takes the next job to run, or returns (None, None).  Call with the lock held."""
+        for owner in self._queues:
+            if owner in self._running:
+                continue
+            jobs = self._queues.pop(owner)
+            job = jobs.popleft()
+            # Back of the line for the owner's next job.
+            if jobs:
+                self._queues[owner] = jobs
+            self._running.add(owner)
+            return owner, job
+        return None, None
+
+    def _work(self):
+        while True:
+            try:
+                with self._condition:
+                    owner, job = self._next()
+                    while job is None:
+                        if self._stopped:
+                            self._workers.remove(threading.current_thread())
+                            return
+                        self._idle += 1
+                        try:
+                            self._condition.wait()
+                        finally:
+                            self._idle -= 1
+                        owner, job = self._next()
+            except KeyboardInterrupt:
+                # An interrupt that landed just as the previous job finished.
+                continue
+            try:
+                job()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                with self._condition:
+                    self._running.discard(owner)
+                    # The owner's next job can go now.
+                    self._condition.notify()
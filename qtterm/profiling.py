@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+"""
+Profiling magics for code run from the entry widget.
+
+A buffer (or cell) starting with one of these lines is profiled rather than
+just run:
+
+    %timeit [-n number] [-r repeat] statement
+    %%timeit [-n number] [-r repeat]
+    %prun statement
+    %%prun
+    %sample [-i milliseconds] statement
+    %%sample [-i milliseconds]
+
+The single % forms profile the rest of their line, the %% forms the rest of
+the buffer.  The run_* functions are handed to the executor as runners and
+return a result object describing what was measured.
+"""
+
+import cProfile
+import math
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+
+MAGICS = ('timeit', 'prun', 'sample')
+
+# %timeit raises its loop count until one repeat takes at least this long.
+TIMEIT_TARGET = 0.2
+TIMEIT_REPEAT = 3
+
+SAMPLE_INTERVAL = 0.001
+
+Magic = namedtuple('Magic', 'name options body firstLine')
+
+
+class MagicError(ValueError):
+    pass
+
+
+_OPTION_RE = re.compile(r'\s*-([nri])\s*(\S+)')
+
+
+def _parse_options(text):
+    """Splits leading -n/-r/-i options off text."""
+    options = {}
+    pos = 0
+    while True:
+        match = _OPTION_RE.match(text, pos)
+        if match is None:
+            break
+        try:
+            options[match.group(1)] = float(match.group(2))
+        except ValueError:
+            raise MagicError("-{option} expects a number, not {value!r}".format(
+                option=match.group(1), value=match.group(2)))
+        pos = match.end()
+    return options, text[pos:].strip()
+
+
+def parse_magic(source):
+    """Returns a Magic if source starts with a profiling magic, otherwise None.
+
+    firstLine is the line of source the body starts on, counted from 0.
+    Raises MagicError for a magic it recognises but can't parse.
+    """
+    lines = source.split('\n')
+    start = 0
+    while start < len(lines) and not lines[start].strip():
+        start += 1
+    if start == len(lines):
+        return None
+
+    line = lines[start].strip()
+    cell = line.startswith('%%')
+    words = line.lstrip('%').split(None, 1)
+    if not line.startswith('%') or not words or words[0] not in MAGICS:
+        return None
+    name = words[0]
+    options, rest = _parse_options(words[1] if len(words) > 1 else '')
+
+    if cell:
+        if rest:
+            raise MagicError("%%{name} takes no statement, it profiles the rest of the buffer".format(name=name))
+        return Magic(name, options, '\n'.join(lines[start+1:]), start + 1)
+
+    if not rest or any(l.strip() for l in lines[start+1:]):
+        raise MagicError("%{name} profiles a single statement, use %%{name} for a block".format(name=name))
+    return Magic(name, options, rest, start)
+
+
+def format_time(seconds):
+    """Formats a duration with a unit that suits it, eg "12.3 usec"."""
+    if seconds <= 0:
+        return "0 sec"
+    for unit, scale in (("sec", 1.0), ("msec", 1e3), ("usec", 1e6), ("nsec", 1e9)):
+        if seconds >= 1.0 / scale:
+            break
+    return "{value:.3g} {unit}".format(value=seconds * scale, unit=unit)
+
+
+class TimeitResult(object):
+    kind = 'timeit'
+
+    def __init__(self, number, timings):
+        self.number = number
+        # Seconds per loop of each repeat.
+        self.timings = timings
+
+    def best(self):
+        return min(self.timings)
+
+    def summary(self):
+        mean = sum(self.timings) / len(self.timings)
+        deviation = math.sqrt(sum((t - mean) ** 2 for t in self.timings) / len(self.timings))
+        return "{number} loops, best of {repeat}: {best} per loop (mean {mean} +- {deviation})".format(
+            number=self.number,
+            repeat=len(self.timings),
+            best=format_time(self.best()),
+            mean=format_time(mean),
+            deviation=format_time(deviation),
+        )
+
+
+def run_timeit(code, globals_, locals_, number=0, repeat=TIMEIT_REPEAT):
+    """Times code, calibrating the loop count unless number is given."""
+    timer = getattr(time, 'perf_counter', time.time)
+
+    def measure(loops):
+        start = timer()
+        for i in range(loops):
+            exec(code, globals_, locals_)
+        return timer() - start
+
+    number = int(number)
+    if not number:
+        number = 1
+        while True:
+            if measure(number) >= TIMEIT_TARGET:
+                break
+            number *= 10 if number < 1000 else 2
+
+    timings = [measure(number) / number for i in range(max(int(repeat), 1))]
+    return TimeitResult(number, timings)
+
+
+ProfileRow = namedtuple('ProfileRow', 'filename line function calls primitiveCalls totalTime cumulativeTime')
+
+
+class ProfileResult(object):
+    kind = 'prun'
+
+    def __init__(self, profile):
+        self._stats = pstats.Stats(profile)
+        self.totalTime = self._stats.total_tt
+        self.calls = self._stats.total_calls
+
+    def rows(self, sort='cumulativeTime'):
+        rows = []
+        for (filename, line, function), (primitive, calls, total, cumulative, callers) in self._stats.stats.items():
+            rows.append(ProfileRow(filename, line, function, calls, primitive, total, cumulative))
+        rows.sort(key=lambda row: getattr(row, sort), reverse=True)
+        return rows
+
+    def summary(self):
+        return "{calls} function calls in {time}".format(calls=self.calls, time=format_time(self.totalTime))
+
+    def dump(self, path):
+        """Writes the profile as a .pstats file, readable with pstats.Stats."""
+        self._stats.dump_stats(path)
+
+
+def run_prun(code, globals_, locals_):
+    profile = cProfile.Profile()
+    profile.runctx(code, globals_, locals_)
+    return ProfileResult(profile)
+
+
+class SampleResult(object):
+    kind = 'sample'
+
+    def __init__(self, counts, total, interval):
+        # {(filename, line): samples} for the innermost frame of each sample.
+        self.counts = counts
+        self.total = total
+        self.interval = interval
+
+    def rows(self):
+        return sorted(((count, filename, line) for (filename, line), count in self.counts.items()), reverse=True)
+
+    def summary(self):
+        return "{total} samples every {interval}".format(total=self.total, interval=format_time(self.interval))
+
+
+def run_sampled(code, globals_, locals_, interval=SAMPLE_INTERVAL):
+    """Runs code while another thread samples which line it is on."""
+    ident = threading.current_thread().ident
+    counts = {}
+    done = threading.Event()
+    total = [0]
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+            key = (frame.f_code.co_filename, frame.f_lineno)
+            counts[key] = counts.get(key, 0) + 1
+            total[0] += 1
+
+    sampler = threading.Thread(target=sample, name='qtterm sampler')
+    sampler.daemon = True
+    sampler.start()
+    try:
+        exec(code, globals_, locals_)
+    finally:
+        done.set()
+        sampler.join()
+    return SampleResult(counts, total[0], interval)
+
+
+def runner(magic):
+    """Returns the run_* function for magic with its options applied."""
+    options = magic.options
+    if magic.name == 'timeit':
+        return lambda code, globals_, locals_: run_timeit(
+            code, globals_, locals_, options.get('n', 0), options.get('r', TIMEIT_REPEAT))
+    if magic.name == 'prun':
+        return run_prun
+    interval = options.get('i', SAMPLE_INTERVAL * 1000) / 1000.0
+    return lambda code, globals_, locals_: run_sampled(code, globals_, locals_, interval)
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+"""
+Search index for the results widget's scrollback.
+
+ScrollbackIndex keeps the last INDEX_LINES lines the results widget has
+shown.  It keeps their text in an anonymous temporary file, so lines evicted
+from the widget can still be found, and maps each lower case word to the
+numbers of the lines containing it.  Lines are numbered from the first line
+the widget ever showed, the same numbers the widget's anchors use.
+
+A literal query is looked up word by word.  Words in the middle of the query
+must be whole words of a matching line.  The first and last words may be cut
+short, so they are matched against the vocabulary.  Only lines containing
+those words are then checked for the query itself.  Numbers aren't indexed.
+Regular expressions, and queries without any words or with very common ones,
+scan the text file instead, a line at a time, with the regex engine doing the
+work.
+"""
+
+import mmap
+import re
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+# Words start with a letter or underscore.  Numbers aren't indexed, they
+# are mostly unique and would make the index as big as the text.
+_WORD_RE = re.compile(r'[^\W\d]\w*', re.UNICODE)
+
+# Literal queries with candidates in more than one line in SCAN_FRACTION
+# scan the text instead of checking the candidates.
+SCAN_FRACTION = 8
+
+# Lines kept once the oldest are forgotten, which happens when there are a
+# tenth more, so the cost of forgetting is spread out.
+INDEX_LINES = 500000
+INDEX_SLACK = 0.1
+
+# Bytes copied at a time when lines are forgotten.
+_COPY_SIZE = 1 << 20
+
+# array only has 'Q' from python 3.3.
+try:
+    array('Q')
+    _OFFSET_TYPE = 'Q'
+except ValueError:
+    _OFFSET_TYPE = 'L'
+
+
+class _Archive(object):
+    """Lines appended to an anonymous temporary file, read back through a map."""
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._file = tempfile.TemporaryFile(dir=directory)
+        # Where each line starts, plus where the next will.
+        self.offsets = array(_OFFSET_TYPE, [0])
+        self._map = None
+
+    def append(self, encoded):
+        offsets = self.offsets
+        offset = offsets[-1]
+        for line in encoded:
+            offset += len(line)
+            offsets.append(offset)
+        self._file.seek(0, 2)
+        self._file.write(b''.join(encoded))
+
+    def truncate(self, count):
+        del self.offsets[count+1:]
+        self.close()
+        self._file.truncate(self.offsets[-1])
+
+    def forget(self, count):
+        """Drops the first count lines, copying the rest to a new file."""
+        data = self.data()
+        start = self.offsets[count]
+        replacement = tempfile.TemporaryFile(dir=self._directory)
+        for position in range(start, self.offsets[-1], _COPY_SIZE):
+            replacement.write(data[position:min(position + _COPY_SIZE, self.offsets[-1])])
+        self.close()
+        self._file.close()
+        self._file = replacement
+        self.offsets = array(_OFFSET_TYPE, [offset - start for offset in self.offsets[count:]])
+
+    def data(self):
+        if self._map is None or len(self._map) < self.offsets[-1]:
+            self.close()
+            self._file.flush()
+            if self.offsets[-1]:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map if self._map is not None else b''
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def closeFile(self):
+        self.close()
+        self._file.close()
+
+
+class ScrollbackIndex(object):
+    """Word index of the results widget's lines, see the module docstring.
+
+    append only queues lines, a worker thread indexes them; queries finish
+    the queue first, so they always see every line appended.  close stops
+    the worker and removes the files.
+    """
+
+    def __init__(self, directory=None, limit=INDEX_LINES):
+        self._limit = limit
+        # The number of the oldest line kept, those before it are forgotten.
+        self._first = 0
+        self._text = _Archive(directory)
+        # The same lines in lower case, for literal searches ignoring case.
+        self._lower = _Archive(directory)
+        # {word: array of line numbers, ascending}
+        self._postings = {}
+        # Every word seen, newline separated, for finding the words that
+        # contain a piece of one.
+        self._vocabulary = '\n'
+        self._newWords = []
+
+        self._lock = threading.RLock()
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._worker = None
+        self._closed = False
+
+    def __len__(self):
+        """Counts every line appended, forgotten ones included."""
+        with self._lock:
+            self._indexQueued()
+            return self._first + len(self._text.offsets) - 1
+
+    def first(self):
+        """Returns the number of the oldest line still kept."""
+        return self._first
+
+    def limit(self):
+        return self._limit
+
+    def setLimit(self, lines):
+        with self._lock:
+            self._limit = lines
+            self._indexQueued()
+
+    def append(self, lines):
+        """Queues lines, given without their line endings, to go after the last one."""
+        if self._closed:
+            return
+        self._queue.append(lines)
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, name='qtterm search')
+            self._worker.daemon = True
+            self._worker.start()
+        self._wake.set()
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                if self._closed:
+                    return
+                self._indexQueued()
+
+    def _indexQueued(self):
+        while self._queue:
+            self._index(self._queue.popleft())
+        kept = len(self._text.offsets) - 1
+        if self._limit and kept > self._limit * (1 + INDEX_SLACK):
+            self._forget(kept - self._limit)
+
+    def _forget(self, count):
+        """Drops the oldest count lines, from the postings as well as the files."""
+        first = self._first + count
+        postings = self._postings
+        for word in list(postings):
+            numbers = postings[word]
+            if not numbers or numbers[-1] < first:
+                del postings[word]
+            elif numbers[0] < first:
+                del numbers[:bisect_left(numbers, first)]
+        self._vocabulary = '\n' + ''.join(word + '\n' for word in postings)
+        del self._newWords[:]
+        self._text.forget(count)
+        self._lower.forget(count)
+        self._first = first
+
+    def _index(self, lines):
+        postings = self._postings
+        get = postings.get
+        findall = _WORD_RE.findall
+        number = self._first + len(self._text.offsets) - 1
+        lowered = []
+        for line in lines:
+            line = line.lower()
+            lowered.append(line.encode('utf-8') + b'\n')
+            for word in findall(line):
+                numbers = get(word)
+                if numbers is None:
+                    postings[word] = array('I', [number])
+                    self._newWords.append(word)
+                elif not numbers or numbers[-1] != number:
+                    numbers.append(number)
+            number += 1
+        self._text.append([line.encode('utf-8') + b'\n' for line in lines])
+        self._lower.append(lowered)
+
+    def truncate(self, count):
+        """Drops every line from line count on, so they can be added again."""
+        with self._lock:
+            self._indexQueued()
+            if count >= len(self) or self._closed:
+                return
+            count = max(count, self._first)
+            for numbers in self._postings.values():
+                if numbers and numbers[-1] >= count:
+                    del numbers[bisect_left(numbers, count):]
+            self._text.truncate(count - self._first)
+            self._lower.truncate(count - self._first)
+
+    def line(self, number):
+        """Returns the text of a line, or None if it has been forgotten."""
+        with self._lock:
+            self._indexQueued()
+            if number < self._first or self._closed:
+                return None
+            offsets = self._text.offsets
+            number -= self._first
+            return self._text.data()[offsets[number]:offsets[number+1]-1].decode('utf-8', 'replace')
+
+    def _words(self, piece, cutStart, cutEnd):
+        """Returns the words containing piece.
+
+        Unless cutStart they must start with it, unless cutEnd end with it.
+        """
+        if not cutStart and not cutEnd:
+            return [piece] if piece in self._postings else []
+        if self._newWords:
+            self._vocabulary += '\n'.join(self._newWords) + '\n'
+            del self._newWords[:]
+        vocabulary = self._vocabulary
+        needle = ('' if cutStart else '\n') + piece + ('' if cutEnd else '\n')
+        words = []
+        position = vocabulary.find(needle)
+        while position >= 0:
+            start = vocabulary.rfind('\n', 0, position + 1) + 1
+            end = vocabulary.find('\n', position + 1)
+            words.append(vocabulary[start:end])
+            position = vocabulary.find(needle, end)
+        return words
+
+    def _candidates(self, query):
+        """Returns the lines that can contain query, or None if any line can."""
+        pieces = list(_WORD_RE.finditer(query))
+        if not pieces:
+            return None
+        best = None
+        for match in pieces:
+            # A piece after digits can be the end of a word.
+            cutStart = match.start() == 0 or query[match.start()-1].isalnum()
+            words = self._words(match.group(0), cutStart, match.end() == len(query))
+            size = sum(len(self._postings[word]) for word in words)
+            if best is None or size < best[0]:
+                best = (size, words)
+            if not size:
+                break
+        size, words = best
+        if len(words) == 1:
+            return self._postings[words[0]]
+        return sorted(set().union(*[self._postings[word] for word in words]))
+
+    def find(self, query, regex=False, caseSensitive=False, start=0):
+        """Returns the numbers of the lines from start on matching query, ascending.
+
+        Raises re.error for a bad regular expression.
+        """
+        if not query or self._closed:
+            return []
+        with self._lock:
+            self._indexQueued()
+            start = max(start, self._first)
+            if regex:
+                pattern = re.compile(query.encode('utf-8'), re.MULTILINE | (0 if caseSensitive else re.IGNORECASE))
+
+                def search(data, position, end):
+                    match = pattern.search(data, position, end)
+                    return -1 if match is None else match.start()
+                return self._scan(self._text, search, start)
+
+            lowered = query.lower()
+            archive = self._text if caseSensitive else self._lower
+            needle = (query if caseSensitive else lowered).encode('utf-8')
+            candidates = self._candidates(lowered)
+            if candidates is None:
+                return self._scan(archive, lambda data, position, end: data.find(needle, position, end), start)
+            if start:
+                candidates = candidates[bisect_left(candidates, start):]
+
+            # Every word containing a lone word was looked up, so the
+            # candidates are exactly the matching lines.
+            word = _WORD_RE.match(lowered)
+            if not caseSensitive and word is not None and word.end() == len(lowered):
+                return list(candidates)
+            data = archive.data()
+            offsets = archive.offsets
+            first = self._first
+            if len(candidates) > (len(offsets) - 1) // SCAN_FRACTION:
+                return self._scan(archive, lambda data, position, end: data.find(needle, position, end), start)
+            return [number for number in candidates
+                    if data.find(needle, offsets[number-first], offsets[number-first+1]) >= 0]
+
+    def _scan(self, archive, search, start):
+        """Returns the lines from start on that search(data, position, end) finds."""
+        data = archive.data()
+        offsets = archive.offsets
+        count = len(offsets) - 1
+        matches = []
+        position = offsets[min(start - self._first, count)]
+        end = offsets[-1]
+        while position < end:
+            found = search(data, position, end)
+            if found < 0:
+                break
+            number = bisect_right(offsets, found) - 1
+            matches.append(self._first + number)
+            position = offsets[number+1]
+        return matches
+
+    def close(self):
+        """Stops the worker and removes the files.  Nothing is kept after this."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.clear()
+            self._wake.set()
+        worker = self._worker
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+        with self._lock:
+            self._postings = {}
+            self._vocabulary = '\n'
+            self._text.closeFile()
+            self._lower.closeFile()
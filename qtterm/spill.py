@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+"""
+Disk storage for output too large to put in the results widget.
+
+A SpillFile writes text to an anonymous temporary file as UTF-8 and maps it,
+so only the pages being shown are ever read back into memory.
+"""
+
+import mmap
+import tempfile
+
+# Pages end at the last newline in their final PAGE_LINE_SLACK bytes, so
+# pages don't cut lines in half unless the lines are very long.
+PAGE_LINE_SLACK = 1 << 12
+
+
+class SpillFile(object):
+
+    def __init__(self, text, directory=None):
+        data = text.encode('utf-8')
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.write(data)
+        self._file.flush()
+        self.size = len(data)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if data else b''
+
+    def page(self, offset, size):
+        """Returns (text, next offset) for about size bytes starting at offset."""
+        end = min(offset + size, self.size)
+        if end < self.size:
+            newline = self._map.rfind(b'\n', max(end - PAGE_LINE_SLACK, offset), end)
+            if newline >= 0:
+                end = newline + 1
+            else:
+                # Back up to the start of a UTF-8 sequence.
+                while end > offset and (ord(self._map[end:end+1]) & 0xC0) == 0x80:
+                    end -= 1
+        return self._map[offset:end].decode('utf-8'), end
+
+    def count(self, pattern, offset=0):
+        """Returns how many lines from offset on a compiled bytes regex matches."""
+        count = 0
+        while offset < self.size:
+            match = pattern.search(self._map, offset)
+            if match is None:
+                break
+            count += 1
+            offset = self._map.find(b'\n', match.start())
+            if offset < 0:
+                break
+            offset += 1
+        return count
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+"""
+Top-level await for the entry widget.
+
+On Python 3.8 and later, source using await, async for or async with outside
+a function is compiled with PyCF_ALLOW_TOP_LEVEL_AWAIT.  Running code compiled
+that way doesn't run it, it returns a coroutine, which the entry widget wraps
+in a task on its console's event loop.  The loop is stepped from the Qt event
+loop, so any number of tasks make progress between repaints.
+
+Tasks are numbered per console and can be managed with two commands:
+
+    %tasks          lists the console's tasks that haven't finished
+    %cancel n ...   cancels the given tasks, or every pending one for "all"
+
+Everything here works without asyncio, nothing is available without it.
+"""
+
+import ast
+import re
+import time
+from collections import OrderedDict
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+# Compile flag allowing await at the top level, 0 where there isn't one.
+TOP_LEVEL_AWAIT = getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0) if asyncio is not None else 0
+
+# inspect.CO_COROUTINE, set on code that returns a coroutine when run.
+CO_COROUTINE = 0x80
+
+_COMMAND_RE = re.compile(r'\s*%(tasks|cancel)\b(.*)$', re.DOTALL)
+
+
+class CommandError(ValueError):
+    pass
+
+
+def is_async(code):
+    """Returns True if running code only creates a coroutine."""
+    return bool(code.co_flags & CO_COROUTINE)
+
+
+def parse_command(source):
+    """Returns (name, task numbers) for a %tasks or %cancel command, otherwise None.
+
+    Task numbers are None for "%cancel all".  Raises CommandError for a
+    command it recognises but can't parse.
+    """
+    match = _COMMAND_RE.match(source)
+    if match is None:
+        return None
+    name, rest = match.group(1), match.group(2).split()
+    if name == 'tasks':
+        if rest:
+            raise CommandError("%tasks takes no arguments")
+        return name, []
+    if rest == ['all']:
+        return name, None
+    try:
+        numbers = [int(word) for word in rest]
+    except ValueError:
+        numbers = []
+    if not numbers:
+        raise CommandError("%cancel expects task numbers or all")
+    return name, numbers
+
+
+class TaskTable(object):
+    """The tasks started from one console, by number."""
+
+    def __init__(self):
+        self._tasks = OrderedDict()
+        self._nextNumber = 1
+
+    def __len__(self):
+        """Counts tasks until they are discarded, finished or not."""
+        return len(self._tasks)
+
+    def add(self, task, label):
+        number = self._nextNumber
+        self._nextNumber += 1
+        self._tasks[number] = (task, label, time.time())
+        return number
+
+    def discard(self, number):
+        self._tasks.pop(number, None)
+
+    def pending(self):
+        """Returns the numbers of the tasks that haven't finished, oldest first."""
+        return [number for number, (task, label, started) in self._tasks.items() if not task.done()]
+
+    def cancel(self, numbers=None):
+        """Cancels the given tasks, or all of them.  Returns the numbers not found."""
+        if numbers is None:
+            numbers = self.pending()
+        missing = []
+        for number in numbers:
+            entry = self._tasks.get(number)
+            if entry is None or entry[0].done():
+                missing.append(number)
+            else:
+                entry[0].cancel()
+        return missing
+
+    def describe(self):
+        """Returns a line per pending task, for %tasks."""
+        now = time.time()
+        lines = []
+        for number in self.pending():
+            task, label, started = self._tasks[number]
+            lines.append("[{number}] {label} ({seconds:.1f}s)".format(
+                number=number, label=label, seconds=now - started))
+        return lines
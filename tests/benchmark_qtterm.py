@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Headless performance benchmarks for the qtterm widgets.
+
+Run from this directory with an offscreen Qt platform:
+
+    QT_QPA_PLATFORM=offscreen python benchmark_qtterm.py --output results.json
+
+and compare a later run against it with
+
+    QT_QPA_PLATFORM=offscreen python benchmark_qtterm.py --baseline results.json
+
+Results are written as JSON.  Metrics ending in _per_sec are better when
+higher, all others (times and bytes) when lower.  With --baseline the exit
+status is 1 if any metric regressed by more than --tolerance.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+sys.path.append('../')
+
+# relative imports won't work because top level isn't a python package.
+import qtterm
+from qtterm.kernel import usage
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def wait(app, term, timeout=600):
+    """Processes events until the entry widget's executor is idle and output has arrived."""
+    executor = term.entryWidget().executor
+    end = time.time() + timeout
+    while executor.isBusy() and time.time() < end:
+        app.processEvents()
+    term.entryWidget().stdoutRedirect.flush()
+    app.processEvents()
+
+
+def sample_source(lines):
+    """Returns lines of python source exercising every kind of token."""
+    block = [
+        '@decorator',
+        'def function(argument, other=None):',
+        '    """Docstring for function."""',
+        '    value = len(argument) + 0x1F * 3.5e2  # comment',
+        "    text = r'raw\\'s' + \"double\" + '''triple'''",
+        '    if value is not None and isinstance(other, dict):',
+        '        return [item for item in range(value)]',
+        '    return {}',
+    ]
+    return '\n'.join((block * (lines // len(block) + 1))[:lines])
+
+
+# Terminals are kept alive until exit so no widget is destroyed while its
+# worker threads are still winding down.
+_terminals = []
+
+
+def new_terminal():
+    # History would write to the user's store.
+    term = qtterm.QtTermWidget(historyPath=None)
+    term.entryWidget().stdoutRedirect.setTee(False)
+    _terminals.append(term)
+    return term
+
+
+def highlight(app, lines, repeats):
+    source = sample_source(lines)
+    term = new_terminal()
+    # The highlighter is only created once the console is shown.
+    term.show()
+    entry = term.entryWidget()
+    # Measure the full highlighting pass, not the deferred large document mode.
+    entry.setLargeDocumentThreshold(lines + 1)
+    best = None
+    for i in range(repeats):
+        entry.clear()
+        app.processEvents()
+        start = time.time()
+        entry.setPlainText(source)
+        app.processEvents()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'lines_per_sec': lines / best, 'load_ms': best * 1000.0}
+
+
+@benchmark
+def highlighter_small(app, options):
+    return highlight(app, 200, 20)
+
+
+@benchmark
+def highlighter_large(app, options):
+    return highlight(app, 20000, 3)
+
+
+@benchmark
+def console_startup(app, options):
+    times = {'construct': [], 'show': []}
+    qtterm.set_startup_hook(lambda widget, phase, seconds: times[phase].append(seconds))
+    try:
+        terms = [new_terminal() for i in range(options.consoles)]
+        for term in terms:
+            term.show()
+        app.processEvents()
+    finally:
+        qtterm.set_startup_hook(None)
+    # The first console pays for one-off setup, the rest show what each
+    # extra console costs.
+    return {
+        'first_construct_ms': times['construct'][0] * 1000.0,
+        'extra_construct_ms': sum(times['construct'][1:]) * 1000.0 / max(len(terms) - 1, 1),
+        'last_show_ms': times['show'][-1] * 1000.0,
+    }
+
+
+@benchmark
+def tokenizer(app, options):
+    lines = sample_source(20000).split('\n')
+    start = time.time()
+    state = qtterm.STATE_NORMAL
+    for line in lines:
+        tokens, state = qtterm.tokenize_block(line, state)
+    return {'lines_per_sec': len(lines) / (time.time() - start)}
+
+
+@benchmark
+def output_ingest(app, options):
+    lines = options.print_lines
+    term = new_terminal()
+    term.resultsWidget().setScrollbackLines(0)
+    entry = term.entryWidget()
+    entry.setPlainText('for i in range({lines}):\n    print(i)'.format(lines=lines))
+    start = time.time()
+    entry.execute()
+    wait(app, term)
+    elapsed = time.time() - start
+    return {'lines_per_sec': lines / elapsed, 'total_ms': elapsed * 1000.0}
+
+
+@benchmark
+def execute_latency(app, options):
+    term = new_terminal()
+    entry = term.entryWidget()
+    entry.setPlainText('x = 1')
+    times = []
+    for i in range(options.latency_runs):
+        start = time.time()
+        entry.execute()
+        wait(app, term)
+        times.append(time.time() - start)
+    times.sort()
+    return {
+        'median_ms': times[len(times) // 2] * 1000.0,
+        'p95_ms': times[int(len(times) * 0.95)] * 1000.0,
+    }
+
+
+@benchmark
+def memory_growth(app, options):
+    term = new_terminal()
+    entry = term.entryWidget()
+
+    def run(count):
+        for i in range(count):
+            entry.setPlainText('value = [{i}] * 100\nraise ValueError(value)'.format(i=i))
+            entry.execute()
+            if i % 100 == 0:
+                wait(app, term)
+        wait(app, term)
+        gc.collect()
+
+    # Warm up caches and the traceback store before measuring.
+    run(200)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    before = usage()['memory']
+    traced = tracemalloc.get_traced_memory()[0] if tracemalloc is not None else 0
+
+    run(options.memory_runs)
+
+    result = {'rss_growth_bytes': usage()['memory'] - before}
+    if tracemalloc is not None:
+        result['traced_growth_bytes'] = tracemalloc.get_traced_memory()[0] - traced
+        tracemalloc.stop()
+    return result
+
+
+@benchmark
+def session_release(app, options):
+    term = new_terminal()
+    results = term.resultsWidget()
+    for start in range(0, options.print_lines, 1000):
+        results.handleOutput(''.join('\x1b[32mline\x1b[0m {i}\n'.format(i=i) for i in range(start, start + 1000)))
+    held = results.memoryUsage()['bytes']
+
+    start = time.time()
+    results.releaseDocument()
+    released = time.time() - start
+    releasedBytes = results.memoryUsage()['releasedBytes']
+    start = time.time()
+    with results.writeLock:
+        results.restoreDocument()
+    return {
+        'release_ms': released * 1000.0,
+        'restore_ms': (time.time() - start) * 1000.0,
+        'released_bytes': releasedBytes,
+        'held_bytes': held,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of (benchmark, metric, baseline, current) that regressed."""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            if metric.endswith('_per_sec'):
+                worse = value < old * (1 - tolerance)
+            else:
+                worse = value > old * (1 + tolerance)
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help="write results to this file as well as stdout")
+    parser.add_argument('--baseline', help="compare against results written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="fraction a metric may regress by before failing (default 0.2)")
+    parser.add_argument('--only', action='append', help="run only the named benchmark")
+    parser.add_argument('--print-lines', type=int, default=200000)
+    parser.add_argument('--latency-runs', type=int, default=200)
+    parser.add_argument('--memory-runs', type=int, default=10000)
+    parser.add_argument('--consoles', type=int, default=12)
+    options = parser.parse_args()
+
+    app = qtterm.QtGui.QApplication.instance() or qtterm.QtGui.QApplication(sys.argv)
+
+    results = {}
+    for func in BENCHMARKS:
+        if options.only and func.__name__ not in options.only:
+            continue
+        results[func.__name__] = func(app, options)
+
+    report = {
+        'python': platform.python_version(),
+        'qt': qtterm.QtCore.qVersion(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(text + '\n')
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], options.tolerance)
+        for name, metric, old, value in regressions:
+            sys.stderr.write("REGRESSION {name}.{metric}: {old:.3f} -> {value:.3f}\n".format(
+                name=name, metric=metric, old=old, value=value))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Tests for the escape sequence handling of output.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# relative imports won't work because top level isn't a python package.
+from qtterm import ansi
+
+RED = ansi.DEFAULT_STYLE._replace(foreground=ansi.BASIC_COLOURS[1])
+
+
+def texts(runs):
+    return [text for text, style in runs]
+
+
+class SgrTest(unittest.TestCase):
+
+    def test_basic_codes(self):
+        style = ansi.apply_sgr(ansi.DEFAULT_STYLE, '1;4;31;42')
+        self.assertTrue(style.bold)
+        self.assertTrue(style.underline)
+        self.assertEqual(style.foreground, ansi.BASIC_COLOURS[1])
+        self.assertEqual(style.background, ansi.BASIC_COLOURS[2])
+        style = ansi.apply_sgr(style, '22;24;39')
+        self.assertEqual(style, ansi.DEFAULT_STYLE._replace(background=ansi.BASIC_COLOURS[2]))
+        self.assertEqual(ansi.apply_sgr(style, '0'), ansi.DEFAULT_STYLE)
+        # An empty SGR is a reset too.
+        self.assertEqual(ansi.apply_sgr(style, ''), ansi.DEFAULT_STYLE)
+
+    def test_bright_and_extended_colours(self):
+        self.assertEqual(ansi.apply_sgr(ansi.DEFAULT_STYLE, '91').foreground, ansi.BASIC_COLOURS[9])
+        self.assertEqual(ansi.apply_sgr(ansi.DEFAULT_STYLE, '104').background, ansi.BASIC_COLOURS[12])
+        style = ansi.apply_sgr(ansi.DEFAULT_STYLE, '38;5;196;48;2;1;2;300')
+        self.assertEqual(style.foreground, (255, 0, 0))
+        self.assertEqual(style.background, (1, 2, 255))
+        # A cut off extended colour is ignored.
+        self.assertEqual(ansi.apply_sgr(ansi.DEFAULT_STYLE, '38;5'), ansi.DEFAULT_STYLE)
+
+    def test_palette(self):
+        self.assertEqual(ansi.colour_rgb(1), ansi.BASIC_COLOURS[1])
+        self.assertEqual(ansi.colour_rgb(16), (0, 0, 0))
+        self.assertEqual(ansi.colour_rgb(21), (0, 0, 255))
+        self.assertEqual(ansi.colour_rgb(231), (255, 255, 255))
+        self.assertEqual(ansi.colour_rgb(232), (8, 8, 8))
+
+    def test_strip(self):
+        self.assertEqual(ansi.strip('\x1b[1;31mhi\x1b]0;title\x07 there\x1b(B\x1b'), 'hi there')
+
+
+class ParserTest(unittest.TestCase):
+
+    def test_style_carries_across_chunks(self):
+        parser = ansi.AnsiParser()
+        self.assertEqual(parser.feed('a\x1b[31mred'), [('a', ansi.DEFAULT_STYLE), ('red', RED)])
+        self.assertEqual(parser.feed('more\x1b[0m\n'), [('more', RED), ('\n', ansi.DEFAULT_STYLE)])
+
+    def test_split_escape_sequence(self):
+        parser = ansi.AnsiParser()
+        self.assertEqual(parser.feed('x\x1b[3'), [('x', ansi.DEFAULT_STYLE)])
+        self.assertEqual(parser.feed('1my\n'), [('y\n', RED)])
+
+    def test_carriage_return_redraws_are_collapsed(self):
+        parser = ansi.AnsiParser()
+        runs = parser.feed('10%\r20%\r30%\n')
+        self.assertEqual([text for text in texts(runs) if text is not None], ['30%\n'])
+
+    def test_redraw_of_line_from_earlier_chunk(self):
+        parser = ansi.AnsiParser()
+        self.assertEqual(texts(parser.feed('50%')), ['50%'])
+        # The line was written by the last chunk, so it has to be erased.
+        self.assertEqual(texts(parser.feed('\r60%')), [None, '60%'])
+
+    def test_crlf_is_a_line_ending(self):
+        parser = ansi.AnsiParser()
+        runs = parser.feed('line\r\nnext\r\n')
+        self.assertNotIn(None, texts(runs))
+        self.assertEqual(''.join(texts(runs)), 'line\nnext\n')
+
+    def test_erase_line(self):
+        parser = ansi.AnsiParser()
+        runs = parser.feed('abc\x1b[2Kdef\n')
+        self.assertEqual([text for text in texts(runs) if text is not None], ['def\n'])
+
+    def test_other_sequences_are_dropped(self):
+        parser = ansi.AnsiParser()
+        # What is left is one run, as if it had been written in one go.
+        self.assertEqual(parser.feed('\x1b[2Ja\x1b]0;title\x07b\n'), [('ab\n', ansi.DEFAULT_STYLE)])
+
+
+if __name__ == '__main__':
+    unittest.main()
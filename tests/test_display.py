@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Tests for the bounded display of expression results.
+"""
+
+import __future__
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# relative imports won't work because top level isn't a python package.
+from qtterm import cells, display
+
+
+class Endless(object):
+
+    def __repr__(self):
+        while True:
+            pass
+
+
+class SummarizeTest(unittest.TestCase):
+
+    def test_small_values_are_whole(self):
+        for value in ([1, 2], {'a': (1, 2)}, 'text', 10 ** 10, 1.5):
+            self.assertEqual(display.summarize(value), (repr(value), False))
+
+    def test_truncated_is_explicit(self):
+        self.assertTrue(display.summarize(list(range(1000)))[1])
+        self.assertTrue(display.summarize(dict.fromkeys(range(1000)))[1])
+        self.assertTrue(display.summarize('x' * (display.DISPLAY_CHARS + 1))[1])
+        self.assertTrue(display.summarize([[[[[[1]]]]]])[1])
+        # An ellipsis in the repr itself isn't truncation.
+        self.assertEqual(display.summarize('...'), (repr('...'), False))
+        self.assertEqual(display.summarize([Ellipsis]), (repr([Ellipsis]), False))
+
+    def test_long_containers_get_their_length(self):
+        text, truncated = display.summarize(list(range(100)))
+        self.assertTrue(text.startswith("list of 100 items: [0, 1, 2"))
+        self.assertLessEqual(len(text), display.DISPLAY_CHARS + 3)
+
+
+class DisplayHookTest(unittest.TestCase):
+
+    def test_stores_value_and_result(self):
+        namespace = {}
+        hook = display.DisplayHook(namespace)
+        hook([1, 2])
+        self.assertEqual(namespace['_'], [1, 2])
+        self.assertEqual(hook.result.text, '[1, 2]')
+        self.assertFalse(hook.result.truncated)
+
+    def test_slow_repr_is_abandoned_and_stopped(self):
+        hook = display.DisplayHook({}, timeout=0.1)
+        hook(Endless())
+        self.assertIn("repr took longer", hook.result.text)
+        self.assertTrue(hook.result.truncated)
+        worker = display._abandoned[-1]
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+
+    def test_runner_uses_hook(self):
+        code, expression = cells.CodeCache().compileDisplay("x = 2\nx * 3", '<test>')
+        hook = display.DisplayHook({})
+        result = display.runner(expression, hook)(code, {}, {})
+        self.assertEqual(result.text, '6')
+
+    def test_other_threads_use_original_hook(self):
+        shown = []
+        original = sys.displayhook
+        sys.displayhook = shown.append
+        try:
+            display.install_hook()
+            hook = display.DisplayHook({})
+            code, expression = cells.CodeCache().compileDisplay("1 + 1", '<test>')
+            display.runner(expression, hook)(code, {}, {})
+            sys.displayhook(3)
+        finally:
+            sys.displayhook = original
+        self.assertEqual(hook.result.text, '2')
+        self.assertEqual(shown, [3])
+
+    def test_expression_gets_future_flags(self):
+        feature = __future__.division if sys.version_info[0] < 3 else __future__.annotations \
+            if hasattr(__future__, 'annotations') else None
+        if feature is None:
+            self.skipTest("no __future__ feature changes code flags")
+        source = "from __future__ import {name}\n(lambda: 0).__code__.co_flags".format(
+            name=[name for name in __future__.all_feature_names if getattr(__future__, name) is feature][0])
+        code, expression = cells.CodeCache().compileDisplay(source, '<test>')
+        self.assertTrue(code.co_flags & feature.compiler_flag)
+        self.assertTrue(expression.co_flags & feature.compiler_flag)
+
+
+if __name__ == '__main__':
+    unittest.main()
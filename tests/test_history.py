@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Tests for qtterm.history.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(_ROOT)
+
+from qtterm import history
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def store(self):
+        return history.HistoryStore(self.path)
+
+    def test_entries_survive_reopening(self):
+        store = self.store()
+        store.append(u'x = 1')
+        store.append(u'print(\xe9)')
+        store.close()
+        store = self.store()
+        self.assertEqual([store.entry(i) for i in range(len(store))], [u'x = 1', u'print(\xe9)'])
+        self.assertEqual(store.entry(-1), u'print(\xe9)')
+
+    def test_two_stores_appending(self):
+        first, second = self.store(), self.store()
+        first.append(u'alpha = 1')
+        second.append(u'beta = 2')
+        first.append(u'gamma = 3')
+        expected = [u'alpha = 1', u'beta = 2', u'gamma = 3']
+        for store in (first, second, self.store()):
+            self.assertEqual([store.entry(i) for i in range(len(store))], expected)
+
+    def test_another_process_appending(self):
+        store = self.store()
+        store.append(u'mine = 1')
+        script = "import sys; sys.path.insert(0, {root!r}); from qtterm import history; " \
+                 "history.HistoryStore({path!r}).append(u'theirs = 2')".format(root=_ROOT, path=self.path)
+        subprocess.check_call([sys.executable, '-c', script])
+        store.append(u'mine = 3')
+        self.assertEqual([store.entry(i) for i in range(len(store))], [u'mine = 1', u'theirs = 2', u'mine = 3'])
+
+    def test_partial_index_entry_is_dropped(self):
+        store = self.store()
+        store.append(u'whole')
+        store.close()
+        with open(os.path.join(self.path, 'history.idx'), 'ab') as handle:
+            handle.write(b'\x01\x02\x03')
+        store = self.store()
+        self.assertEqual(len(store), 1)
+        store.append(u'after')
+        self.assertEqual([store.entry(i) for i in range(len(store))], [u'whole', u'after'])
+
+    def test_prefix_matches_and_search(self):
+        store = self.store()
+        for source in [u'import os', u'x = 1', u'import sys', u'print(x)']:
+            store.append(source)
+        store.compact()
+        store.append(u'import re')
+        self.assertEqual(store.prefixMatches(u'import'), [0, 2, 4])
+        self.assertEqual(store.prefixMatches(u'x'), [1])
+        self.assertEqual(store.prefixMatches(u'zzz'), [])
+        self.assertEqual(store.search(u'x'), 3)
+        self.assertEqual(store.search(u'x', 3), 1)
+        self.assertEqual(store.search(u'nothing'), -1)
+
+    def test_search_in_chunks(self):
+        store = self.store()
+        for i in range(50):
+            store.append(u'entry {i}'.format(i=i))
+        chunk = history.SEARCH_CHUNK
+        history.SEARCH_CHUNK = 5
+        try:
+            # Matches crossing a chunk boundary are found.
+            self.assertEqual(store.search(u'entry 12'), 12)
+            self.assertEqual(store.search(u'entry 1', 12), 11)
+            self.assertEqual(store.search(u'9e'), -1)
+            self.assertEqual(store.search(u'entry', cancelled=lambda: True), None)
+        finally:
+            history.SEARCH_CHUNK = chunk
+
+    def test_compaction_keeps_other_stores_entries(self):
+        first, second = self.store(), self.store()
+        for i in range(5):
+            first.append(u'same')
+            second.append(u'other {i}'.format(i=i))
+        generation = first.generation()
+        first.compact()
+        self.assertNotEqual(first.generation(), generation)
+        second.append(u'last')
+        # The newest copy of a duplicate is the one kept.
+        expected = [u'other {i}'.format(i=i) for i in range(4)] + [u'same', u'other 4', u'last']
+        for store in (first, second):
+            self.assertEqual([store.entry(i) for i in range(len(store))], expected)
+        self.assertEqual(first.prefixMatches(u'other'), [0, 1, 2, 3, 5])
+
+
+class MemoryHistoryTest(unittest.TestCase):
+
+    def test_interface(self):
+        store = history.MemoryHistory()
+        for source in [u'import os', u'x = 1', u'import sys']:
+            store.append(source)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.prefixMatches(u'import'), [0, 2])
+        self.assertEqual(store.search(u'import'), 2)
+        self.assertEqual(store.search(u'import', 2), 0)
+        self.assertEqual(store.entry(1), u'x = 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
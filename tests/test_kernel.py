@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Tests for the out-of-process kernel's child side.
+"""
+
+import marshal
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# relative imports won't work because top level isn't a python package.
+from qtterm import kernel
+
+SCRIPT = os.path.splitext(kernel.__file__)[0] + '.py'
+
+
+def start(magic):
+    return subprocess.Popen([sys.executable, '-u', SCRIPT, magic], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+class KernelTest(unittest.TestCase):
+
+    def test_runs_code(self):
+        child = start(kernel.magic_hex())
+        code = compile("print(6 * 7)", '<test>', 'exec')
+        kernel.send_message(child.stdin, {'op': 'execute', 'id': 1, 'code': marshal.dumps(code)})
+        output = []
+        while True:
+            message = kernel.recv_message(child.stdout)
+            if message['op'] == 'done':
+                break
+            output.append(message['data'])
+        kernel.send_message(child.stdin, {'op': 'shutdown'})
+        self.assertEqual(child.wait(), 0)
+        self.assertEqual(''.join(output), "42\n")
+        self.assertEqual(message['id'], 1)
+        self.assertIsNone(message['traceback'])
+        self.assertEqual(message['outputChars'], 3)
+
+    def test_other_python_version_exits(self):
+        child = start('00000000')
+        message = kernel.recv_message(child.stdout)
+        self.assertEqual(message['op'], 'stderr')
+        self.assertIn("can't load code", message['data'])
+        self.assertIsNone(kernel.recv_message(child.stdout))
+        self.assertEqual(child.wait(), kernel.VERSION_MISMATCH)
+        child.stdin.close()
+        child.stdout.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
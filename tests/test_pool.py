@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Tests for qtterm.pool.
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qtterm.pool import FairPool
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+class FairPoolTest(unittest.TestCase):
+
+    def test_owners_take_turns(self):
+        pool = FairPool(1)
+        release = threading.Event()
+        order = []
+        pool.submit('busy', release.wait)
+        for i in range(5):
+            pool.submit('busy', lambda i=i: order.append(('busy', i)))
+        pool.submit('quick', lambda: order.append(('quick', 0)))
+        release.set()
+        self.assertTrue(wait_for(lambda: len(order) == 6))
+        self.assertEqual(order[0], ('quick', 0))
+        self.assertEqual(order[1:], [('busy', i) for i in range(5)])
+
+    def test_an_owners_jobs_never_overlap(self):
+        pool = FairPool(4)
+        running = {}
+        overlaps = []
+        done = []
+
+        def job(owner):
+            if running.get(owner):
+                overlaps.append(owner)
+            running[owner] = True
+            time.sleep(0.002)
+            running[owner] = False
+            done.append(owner)
+
+        for i in range(10):
+            for owner in 'abc':
+                pool.submit(owner, lambda owner=owner: job(owner))
+        self.assertTrue(wait_for(lambda: len(done) == 30))
+        self.assertEqual(overlaps, [])
+        self.assertTrue(len(pool._workers) <= 4)
+
+    def test_cancel(self):
+        pool = FairPool(1)
+        release = threading.Event()
+        ran = []
+        pool.submit('a', release.wait)
+        self.assertTrue(wait_for(lambda: pool.running() == 1))
+        pool.submit('a', lambda: ran.append(1))
+        pool.submit('a', lambda: ran.append(2))
+        self.assertEqual(pool.pending('a'), 2)
+        self.assertEqual(pool.cancel('a'), 2)
+        release.set()
+        self.assertTrue(wait_for(lambda: pool.running() == 0))
+        self.assertEqual(ran, [])
+
+    def test_stop(self):
+        pool = FairPool(2)
+        release = threading.Event()
+        done = []
+        pool.submit('busy', release.wait)
+        pool.submit('busy', lambda: done.append('queued'))
+        pool.submit('idle', lambda: done.append('idle'))
+        self.assertTrue(wait_for(lambda: done == ['idle']))
+        pool.stop()
+        # The idle worker ends, the busy one once its job returns.
+        self.assertTrue(wait_for(lambda: pool.workers() == 1))
+        release.set()
+        self.assertTrue(wait_for(lambda: pool.workers() == 0))
+        self.assertEqual(done, ['idle'])
+        self.assertRaises(RuntimeError, pool.submit, 'late', lambda: None)
+
+    def test_exceptions_dont_stop_workers(self):
+        pool = FairPool(1)
+        ran = []
+
+        def fail():
+            raise KeyboardInterrupt
+        pool.submit('a', fail)
+        pool.submit('a', lambda: ran.append(1))
+        self.assertTrue(wait_for(lambda: ran == [1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,492 @@
 #!/usr/bin/env python
 """
-TESTS GO HERE
+Tests for the qtterm widgets.
+
+Run from this directory with an offscreen Qt platform:
+
+    QT_QPA_PLATFORM=offscreen python -m unittest discover -p 'test_*.py'
+
+The pure python modules have test files of their own.
 """
 
+import os
 import sys
+import tempfile
+import threading
+import time
+import unittest
 
-sys.path.append('../')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 # relative imports won't work because top level isn't a python package.
 import qtterm
+from qtterm import history, pool, tasks
+
+_app = qtterm.QtGui.QApplication.instance() or qtterm.QtGui.QApplication(sys.argv)
+
+# Terminals are kept alive until exit so no widget is destroyed while its
+# worker threads are still winding down.
+_terminals = []
+
+
+def new_terminal():
+    # History would write to the user's store.
+    term = qtterm.QtTermWidget(historyPath=None)
+    term.entryWidget().stdoutRedirect.setTee(False)
+    _terminals.append(term)
+    return term
+
+
+def process_until(condition, timeout=10):
+    """Processes events until condition() is true.  Returns its last value."""
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        _app.processEvents()
+        time.sleep(0.001)
+    return condition()
+
+
+def output(term):
+    term.entryWidget().stdoutRedirect.flush()
+    _app.processEvents()
+    return term.resultsWidget().toPlainText()
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_history_in_memory_by_default(self):
+        term = new_terminal()
+        entry = term.entryWidget()
+        self.assertIsInstance(entry.history(), history.MemoryHistory)
+        entry.setPlainText('x = 1')
+        entry.execute()
+        self.assertEqual(entry.history().entry(-1), 'x = 1')
+
+    def test_unusable_history_path(self):
+        with tempfile.NamedTemporaryFile() as handle:
+            # A directory can't be created inside a file.
+            term = qtterm.QtTermWidget(historyPath=os.path.join(handle.name, 'history'))
+            _terminals.append(term)
+        self.assertIsInstance(term.entryWidget().history(), history.MemoryHistory)
+
+    def test_search_answers_through_the_worker(self):
+        term = new_terminal()
+        term.show()
+        entry = term.entryWidget()
+        for source in ['import os', 'x = 1', 'import sys']:
+            entry.history().append(source)
+        entry.searchHistory()
+        bar = entry.findChild(qtterm.QtTermHistorySearch)
+        bar.setText('import')
+        bar.textEdited.emit('import')
+        self.assertTrue(process_until(lambda: entry.toPlainText() == 'import sys'))
+        bar.older.emit()
+        self.assertTrue(process_until(lambda: entry.toPlainText() == 'import os'))
+        # Nothing older matches, so the match stays.
+        bar.older.emit()
+        bar.setText('nothing')
+        bar.textEdited.emit('nothing')
+        process_until(lambda: False, 0.1)
+        self.assertEqual(entry.toPlainText(), 'import os')
+        bar.cancelled.emit()
+        term.shutdown()
+
+
+class InterruptTest(unittest.TestCase):
+
+    def test_capture_restored_when_flush_fails(self):
+        redirect = qtterm.OutputRedirect(tee=False)
+
+        def fail():
+            raise RuntimeError("deleted")
+        redirect.flush = fail
+        with self.assertRaises(RuntimeError):
+            with redirect:
+                pass
+        self.assertNotIn(threading.current_thread().ident, qtterm._captures)
+
+    def test_late_interrupts_leave_no_capture_behind(self):
+        redirect = qtterm.OutputRedirect(tee=False)
+        executor = qtterm.QtTermExecutor(redirect, pool=pool.FairPool(1))
+        code = compile("pass", '<test>', 'exec')
+        for i in range(2000):
+            executor.submit(code, {}, {})
+        stop = []
+
+        def interrupt():
+            while not stop:
+                executor.interrupt()
+
+        # Interrupts sent as runs finish must not escape into the
+        # redirect's or the pool's code.
+        interrupter = threading.Thread(target=interrupt)
+        interrupter.start()
+        try:
+            self.assertTrue(process_until(lambda: not executor.isBusy()))
+        finally:
+            stop.append(True)
+            interrupter.join()
+        self.assertFalse([ident for ident, capture in list(qtterm._captures.items()) if capture is redirect])
+        finished = []
+        executor.finished.connect(finished.append)
+        executor.submit(compile("print('still works')", '<test>', 'exec'), {}, {})
+        self.assertTrue(process_until(lambda: finished))
+        self.assertIsNone(finished[0])
+
+
+class SlowRepr(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __repr__(self):
+        self.calls += 1
+        time.sleep(0.2)
+        return 'slow'
+
+
+class DisplayTest(unittest.TestCase):
+
+    def test_repeated_expansions_share_one_worker(self):
+        term = new_terminal()
+        value = SlowRepr()
+        index = term.storeDisplay(qtterm._display.DisplayResult(value, 'slow', True))
+        before = threading.active_count()
+        for i in range(5):
+            self.assertTrue(term.expandDisplay(index))
+        self.assertEqual(threading.active_count(), before + 1)
+        self.assertTrue(process_until(lambda: 'slow' in output(term)))
+        self.assertEqual(value.calls, 1)
+        # Once it's written the result can be expanded again.
+        term.expandDisplay(index)
+        self.assertTrue(process_until(lambda: output(term).count('slow') == 2))
+        self.assertFalse(term.expandDisplay(index + 1))
+        term.shutdown()
+
+
+class ExecutionHistoryTest(unittest.TestCase):
+
+    def test_threaded_run_counts_its_flushes(self):
+        term = new_terminal()
+        entry = term.entryWidget()
+        entry.runSource("print('hello')")
+        self.assertTrue(process_until(lambda: entry.executionHistory()))
+        record = entry.executionHistory()[-1]
+        self.assertEqual(record['outputChars'], len("hello\n"))
+        self.assertGreaterEqual(record['flushes'], 1)
+        self.assertFalse(record['failed'])
+
+    @unittest.skipUnless(tasks.TOP_LEVEL_AWAIT, "needs python 3.8 or later")
+    def test_task_run_is_recorded(self):
+        term = new_terminal()
+        entry = term.entryWidget()
+        entry.runSource("import asyncio\nprint('a')\nawait asyncio.sleep(0)\nprint('b')", label="cell 1")
+        self.assertTrue(process_until(lambda: entry.executionHistory()))
+        record = entry.executionHistory()[-1]
+        self.assertEqual(record['label'], "cell 1")
+        self.assertEqual(record['outputChars'], len("a\nb\n"))
+        self.assertGreaterEqual(record['flushes'], 1)
+        self.assertFalse(record['failed'])
+
+
+TICKER_SOURCE = """
+async def ticker(name, count):
+    for i in range(count):
+        print(name, i)
+        await asyncio.sleep(0)
+    return name
+"""
+
+
+class TaskLoopTest(unittest.TestCase):
+
+    @unittest.skipUnless(tasks.TOP_LEVEL_AWAIT, "needs python 3.8 or later")
+    def test_tasks_step_and_report(self):
+        import asyncio
+        term = new_terminal()
+        redirect = term.entryWidget().stdoutRedirect
+        loop = qtterm.QtTermTaskLoop(redirect)
+        finished = []
+        pending = []
+        loop.taskDone.connect(lambda number, task, measurement: finished.append((number, task, measurement)))
+        loop.changed.connect(pending.append)
+
+        # Compiled here so this file still compiles on python 2.
+        namespace = {'asyncio': asyncio}
+        exec(TICKER_SOURCE, namespace)
+        ticker = namespace['ticker']
+
+        self.assertEqual(loop.start(ticker('a', 3), "a"), 1)
+        self.assertEqual(loop.start(ticker('b', 1), "b"), 2)
+        self.assertEqual(pending, [1, 2])
+        self.assertTrue(process_until(lambda: len(finished) == 2))
+        self.assertEqual([number for number, task, measurement in finished], [2, 1])
+        self.assertEqual(finished[1][1].result(), 'a')
+        self.assertEqual(finished[1][2]['outputChars'], len("a 0\n") * 3)
+        self.assertEqual(pending[-1], 0)
+        self.assertEqual(len(loop.tasks), 0)
+        self.assertTrue(process_until(lambda: not loop._timer.isActive()))
+        self.assertIn("b 0\n", output(term))
+
+
+class TopLevelAwaitTest(unittest.TestCase):
+
+    @unittest.skipUnless(tasks.TOP_LEVEL_AWAIT, "needs python 3.8 or later")
+    def test_await_runs_as_task(self):
+        term = new_terminal()
+        entry = term.entryWidget()
+        self.assertTrue(entry.runSource("import asyncio\nawait asyncio.sleep(0)\nprint('slept')"))
+        self.assertTrue(process_until(lambda: "done" in output(term)))
+        text = output(term)
+        self.assertIn("[1] started", text)
+        self.assertIn("slept", text)
+
+    @unittest.skipUnless(tasks.TOP_LEVEL_AWAIT, "needs python 3.8 or later")
+    def test_cancel_task(self):
+        term = new_terminal()
+        entry = term.entryWidget()
+        entry.runSource("import asyncio\nawait asyncio.sleep(60)")
+        entry.runSource("%cancel 1")
+        self.assertTrue(process_until(lambda: "cancelled" in output(term)))
+
+
+class TokenizerTest(unittest.TestCase):
+
+    def kinds(self, text, state=qtterm.STATE_NORMAL):
+        tokens, state = qtterm.tokenize_block(text, state)
+        return [(text[start:start + length], kind) for start, length, kind in tokens], state
+
+    def test_tokens(self):
+        self.assertEqual(self.kinds("@property"), ([("@property", 'decorator')], qtterm.STATE_NORMAL))
+        self.assertEqual(self.kinds("if x is None: return len(y)  # len"), ([
+            ("if", 'keyword'), ("is", 'keyword'), ("None", 'keyword'), ("return", 'keyword'),
+            ("len", 'builtin'), ("# len", 'comment')], qtterm.STATE_NORMAL))
+        # Attributes named like builtins aren't builtins.
+        self.assertEqual(self.kinds("obj.len"), ([], qtterm.STATE_NORMAL))
+        self.assertEqual(self.kinds("x = 0x1F + 1.5e3j + y2"), ([
+            ("0x1F", 'number'), ("1.5e3j", 'number')], qtterm.STATE_NORMAL))
+        # Quotes and comment characters inside strings are skipped.
+        self.assertEqual(self.kinds("s = 'it\\'s # not' + r\"raw\""), ([
+            ("'it\\'s # not'", 'string'), ("r\"raw\"", 'string')], qtterm.STATE_NORMAL))
+
+    def test_triple_quoted_strings_span_lines(self):
+        self.assertEqual(self.kinds('x = """start'), ([('"""start', 'string')], qtterm.STATE_TRIPLE_DOUBLE))
+        self.assertEqual(self.kinds("middle 'quoted'", qtterm.STATE_TRIPLE_DOUBLE),
+                         ([("middle 'quoted'", 'string')], qtterm.STATE_TRIPLE_DOUBLE))
+        self.assertEqual(self.kinds('end""" + 1', qtterm.STATE_TRIPLE_DOUBLE),
+                         ([('end"""', 'string'), ("1", 'number')], qtterm.STATE_NORMAL))
+        self.assertEqual(self.kinds("'''")[1], qtterm.STATE_TRIPLE_SINGLE)
+
+    def test_backslash_continues_single_quoted_strings(self):
+        self.assertEqual(self.kinds("s = 'a\\")[1], qtterm.STATE_SINGLE)
+        self.assertEqual(self.kinds("b' + 1", qtterm.STATE_SINGLE), ([("b'", 'string'), ("1", 'number')], qtterm.STATE_NORMAL))
+        # An escaped backslash doesn't continue the string.
+        self.assertEqual(self.kinds("s = 'a\\\\")[1], qtterm.STATE_NORMAL)
+        self.assertEqual(self.kinds('print("open')[1], qtterm.STATE_NORMAL)
+
+    def test_scan_state_matches_tokenizer(self):
+        lines = ['x = """a', "b", "c\"\"\" + 'd\\", "e'", "f = 1"]
+        state = qtterm.STATE_NORMAL
+        for line in lines:
+            expected = qtterm.tokenize_block(line, state)[1]
+            self.assertEqual(qtterm._scan_state(line, state), expected)
+            state = expected
+        self.assertEqual(state, qtterm.STATE_NORMAL)
+
+
+class ScrollbackTest(unittest.TestCase):
+
+    def test_lines_are_evicted_in_bulk(self):
+        term = new_terminal()
+        results = term.resultsWidget()
+        results.setScrollbackLines(100)
+        results.handleOutput("".join("line {i}\n".format(i=i) for i in range(250)))
+        document = results.document()
+        self.assertLessEqual(document.blockCount(), 100)
+        # Trimmed to below the limit, so the next lines don't evict again.
+        self.assertLess(document.blockCount(), 100 * (1 - qtterm.SCROLLBACK_SLACK) + 2)
+        evicted = results.memoryUsage()['evictedLines']
+        self.assertEqual(evicted + document.blockCount(), 251)
+        self.assertTrue(results.toPlainText().startswith("line {i}\n".format(i=evicted)))
+        self.assertTrue(results.toPlainText().endswith("line 249\n"))
+
+    def test_evicted_tracebacks_are_released(self):
+        term = new_terminal()
+        results = term.resultsWidget()
+        results.setScrollbackLines(50)
+        try:
+            raise ValueError("old")
+        except ValueError:
+            old = term.storeTraceback(sys.exc_info()[2])
+        results.handleTraceback(old)
+        self.assertEqual(results.memoryUsage()['tracebacks'], 1)
+        results.handleOutput("x\n" * 10)
+        self.assertIsNotNone(term.traceback(old))
+        results.handleOutput("x\n" * 100)
+        self.assertEqual(results.memoryUsage()['tracebacks'], 0)
+        self.assertIsNone(term.traceback(old))
+
+    def test_byte_limit(self):
+        term = new_terminal()
+        results = term.resultsWidget()
+        results.setScrollbackLines(0)
+        results.setScrollbackBytes(10000)
+        results.handleOutput(("y" * 99 + "\n") * 200)
+        self.assertLessEqual(results.memoryUsage()['bytes'], 10000)
+        self.assertGreater(results.memoryUsage()['evictedLines'], 100)
+
+
+class HighlighterTest(unittest.TestCase):
+
+    def test_large_document_finishes_in_idle_time(self):
+        term = new_terminal()
+        term.show()
+        entry = term.entryWidget()
+        entry.setLargeDocumentThreshold(100)
+        entry.setPlainText("\n".join("x = 'line {i}'  # comment".format(i=i) for i in range(5000)))
+        highlighter = entry.highlighter()
+        self.assertTrue(highlighter.isLazy())
+        self.assertGreater(highlighter._idleTimer.interval(), 0)
+
+        def pending():
+            block = entry.document().firstBlock()
+            while block.isValid():
+                if block.userState() > 0 and block.userState() & qtterm.STATE_PENDING:
+                    return True
+                block = block.next()
+            return False
+        self.assertTrue(pending())
+        self.assertTrue(process_until(lambda: not pending()))
+        last = entry.document().lastBlock()
+        self.assertTrue(last.layout().formats())
+
+
+class SpillTest(unittest.TestCase):
+
+    def test_many_small_writes_do_not_spill(self):
+        term = new_terminal()
+        results = term.resultsWidget()
+        results.setSpillThreshold(qtterm.OUTPUT_BUFFER_SIZE * 2)
+        redirect = term.entryWidget().stdoutRedirect
+        lines = ["line {i}\n".format(i=i) for i in range(50000)]
+
+        def write():
+            for line in lines:
+                redirect.write(line)
+
+        # Written from another thread without processing events, as if the
+        # GUI were busy.
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join()
+        self.assertEqual(output(term), "".join(lines))
+
+    def test_huge_write_spills_and_pages_back(self):
+        term = new_terminal()
+        results = term.resultsWidget()
+        results.setSpillThreshold(1000)
+        text = "".join("line {i}\n".format(i=i) for i in range(20000))
+        results.handleOutput(text)
+        results.handleOutput("after\n")
+        self.assertIn("[show more,", results.toPlainText())
+        while results.showMore(0):
+            pass
+        self.assertEqual(results.toPlainText(), text + "after\n")
+
+
+class KernelTest(unittest.TestCase):
+
+    def test_submit_to_dead_kernel(self):
+        term = new_terminal()
+        redirect = term.entryWidget().stdoutRedirect
+        kernel = qtterm.QtTermKernel(redirect)
+        kernel.start()
+        process = kernel._process
+        process.kill()
+        process.wait()
+        # As if the child died just after isRunning() looked.
+        kernel.isRunning = lambda: True
+        code = compile("pass", '<test>', 'exec')
+        self.assertFalse(kernel.submit(code, {}, {}))
+        self.assertFalse(kernel.isBusy())
+        self.assertTrue(process_until(lambda: "kernel died" in output(term)))
+        del kernel.isRunning
+        kernel.shutdown()
+
+    def test_shutdown_kills_a_busy_kernel(self):
+        term = new_terminal()
+        kernel = qtterm.QtTermKernel(term.entryWidget().stdoutRedirect)
+        self.assertTrue(kernel.submit(compile("while True: pass", '<test>', 'exec'), {}, {}))
+        process = kernel._process
+        start = time.time()
+        kernel.shutdown(timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertIsNotNone(process.poll())
+        self.assertFalse(kernel.isRunning())
+        self.assertFalse(kernel.isBusy())
+
+
+class SessionsTest(unittest.TestCase):
+
+    def test_namespaces_are_separate(self):
+        sessions = qtterm.QtTermSessions()
+        _terminals.append(sessions)
+        first, second = sessions.session(0), sessions.newSession()
+        first.entryWidget().runSource("x = 1\ndef f():\n    return x\nprint(f())")
+        second.entryWidget().runSource("print('x' in dir())")
+        self.assertTrue(process_until(lambda: output(first) and output(second)))
+        self.assertEqual(output(first), "1\n")
+        self.assertEqual(output(second), "False\n")
+
+    def test_closing_stops_threads(self):
+        initial = threading.active_count()
+        sessions = qtterm.QtTermSessions()
+        _terminals.append(sessions)
+        # Starts the pool's worker, which the sessions share.
+        sessions.session(0).entryWidget().runSource("pass")
+        process_until(lambda: not sessions.session(0).isBusy())
+        before = threading.active_count()
+        for round in range(3):
+            for i in range(3):
+                console = sessions.newSession()
+                entry = console.entryWidget()
+                entry.runSource("y = 2")
+                entry.checkSyntax()
+                console.resultsWidget().search("y")
+            process_until(lambda: not any(console.isBusy() for console in sessions.sessions()))
+            while sessions.count() > 1:
+                sessions.closeSession(sessions.count() - 1)
+        self.assertTrue(process_until(lambda: threading.active_count() <= before, 5))
+        # Closing the window stops the last console and the pool.
+        sessions.show()
+        sessions.close()
+        self.assertTrue(process_until(lambda: sessions.pool().workers() == 0, 5))
+        self.assertTrue(process_until(lambda: threading.active_count() <= initial, 5))
+
+    def test_release_and_restore(self):
+        term = new_terminal()
+        results = term.resultsWidget()
+        results.handleOutput("".join("\x1b[3{colour}mline {i}\x1b[0m\n".format(colour=i % 8, i=i) for i in range(500)))
+        document = results.document()
+        html = document.toHtml()
+        lines = document.blockCount()
+        results.releaseDocument()
+        self.assertTrue(results.isReleased())
+        self.assertEqual(document.blockCount(), 1)
+        self.assertEqual(results.memoryUsage()['lines'], lines)
+        with results.writeLock:
+            results.restoreDocument()
+        self.assertEqual(document.toHtml(), html)
+
+        results.releaseDocument()
+        # Output restores the document first.
+        results.handleOutput("more\n")
+        self.assertFalse(results.isReleased())
+        self.assertEqual(document.blockCount(), lines + 1)
+        self.assertTrue(results.toPlainText().endswith("line 499\nmore\n"))
 
-# TESTS!
 
-# When some tests are done, follow travis-ci.org's instructions on setting up CI
-# But, hmm. they might not have PySide support yet.
\ No newline at end of file
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Tests for qtterm.search.
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qtterm.search import ScrollbackIndex
+
+_TOKENS = [u'alpha', u'Beta', u'x86_64', u'12abc', u'abc', u'3rd', u'value=123', u'err42',
+           u'_priv', u'\xe9t\xe9', u'0x1f', u' ', u'  ', u'-', u'.']
+
+_QUERIES = [u'alpha', u'lph', u'ha x', u'12abc', u'2ab', u'abc', u'c1', u'3rd', u'123', u'=1',
+            u'value', u'err4', u'_pri', u'\xc9T\xc9', u'0x1', u'x1f', u'ta x86', u'a 1', u'-.', u' ', u'BETA']
+
+
+def random_lines(count, seed=1):
+    generator = random.Random(seed)
+    return [u''.join(generator.choice(_TOKENS) for i in range(generator.randint(0, 8)))
+            for j in range(count)]
+
+
+def expected(lines, query, caseSensitive, start=0):
+    if not caseSensitive:
+        query = query.lower()
+    return [number for number, line in enumerate(lines)
+            if number >= start and query in (line if caseSensitive else line.lower())]
+
+
+class ScrollbackIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ScrollbackIndex()
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_literal_queries_match_brute_force(self):
+        lines = random_lines(2000)
+        self.index.append(lines[:700])
+        self.index.append(lines[700:])
+        for query in _QUERIES:
+            for caseSensitive in (False, True):
+                for start in (0, 900):
+                    self.assertEqual(self.index.find(query, caseSensitive=caseSensitive, start=start),
+                                     expected(lines, query, caseSensitive, start), (query, caseSensitive, start))
+
+    def test_regex(self):
+        self.index.append([u'error 1', u'ok', u'ERROR 22'])
+        self.assertEqual(self.index.find(r'error \d+$', regex=True), [0, 2])
+        self.assertEqual(self.index.find(r'error \d+$', regex=True, caseSensitive=True), [0])
+
+    def test_truncate_and_line(self):
+        self.index.append([u'one', u'two', u'three'])
+        self.index.truncate(1)
+        self.assertEqual(len(self.index), 1)
+        self.index.append([u'two again'])
+        self.assertEqual(self.index.find(u'two'), [1])
+        self.assertEqual(self.index.line(1), u'two again')
+
+    def test_oldest_lines_are_forgotten(self):
+        index = ScrollbackIndex(limit=100)
+        try:
+            lines = [u'line {number} word{number}'.format(number=number) for number in range(500)]
+            for start in range(0, 500, 50):
+                index.append(lines[start:start+50])
+            self.assertEqual(len(index), 500)
+            self.assertTrue(400 - 10 <= index.first() <= 400)
+            self.assertEqual(index.find(u'word3'), [number for number in range(index.first(), 500)
+                                                    if u'word3' in lines[number]])
+            self.assertEqual(index.find(u'word5'), [])
+            self.assertIsNone(index.line(0))
+            self.assertEqual(index.line(499), lines[499])
+            # Forgotten words leave the postings.
+            self.assertNotIn(u'word5', index._postings)
+        finally:
+            index.close()
+
+    def test_close_stops_worker(self):
+        self.index.append([u'some text'])
+        self.assertEqual(self.index.find(u'text'), [0])
+        worker = self.index._worker
+        self.index.close()
+        self.assertFalse(worker.is_alive())
+        self.index.append([u'ignored'])
+        self.assertEqual(self.index.find(u'text'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
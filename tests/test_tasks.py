@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Tests for the task commands and table behind top-level await.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# relative imports won't work because top level isn't a python package.
+from qtterm import tasks
+
+
+class FakeTask(object):
+
+    def __init__(self):
+        self.finished = False
+        self.cancelled = False
+
+    def done(self):
+        return self.finished or self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class CommandTest(unittest.TestCase):
+
+    def test_commands(self):
+        self.assertEqual(tasks.parse_command("%tasks"), ('tasks', []))
+        self.assertEqual(tasks.parse_command("  %tasks\n"), ('tasks', []))
+        self.assertEqual(tasks.parse_command("%cancel 1 3"), ('cancel', [1, 3]))
+        self.assertEqual(tasks.parse_command("%cancel all"), ('cancel', None))
+
+    def test_other_source(self):
+        self.assertIsNone(tasks.parse_command("print('%tasks')"))
+        self.assertIsNone(tasks.parse_command("%tasksx"))
+        self.assertIsNone(tasks.parse_command("x = 1"))
+
+    def test_bad_arguments(self):
+        for source in ("%tasks 1", "%cancel", "%cancel one"):
+            self.assertRaises(tasks.CommandError, tasks.parse_command, source)
+
+    @unittest.skipUnless(tasks.TOP_LEVEL_AWAIT, "needs python 3.8 or later")
+    def test_is_async(self):
+        self.assertTrue(tasks.is_async(compile("await f()", '<test>', 'exec', tasks.TOP_LEVEL_AWAIT)))
+        self.assertFalse(tasks.is_async(compile("f()", '<test>', 'exec', tasks.TOP_LEVEL_AWAIT)))
+
+
+class TaskTableTest(unittest.TestCase):
+
+    def test_numbers_and_pending(self):
+        table = tasks.TaskTable()
+        first, second = FakeTask(), FakeTask()
+        self.assertEqual(table.add(first, "first"), 1)
+        self.assertEqual(table.add(second, "second"), 2)
+        first.finished = True
+        self.assertEqual(table.pending(), [2])
+        # Finished tasks count until they are discarded.
+        self.assertEqual(len(table), 2)
+        table.discard(1)
+        self.assertEqual(len(table), 1)
+        # Numbers aren't reused.
+        self.assertEqual(table.add(FakeTask(), "third"), 3)
+
+    def test_cancel(self):
+        table = tasks.TaskTable()
+        running = [FakeTask() for i in range(3)]
+        for task in running:
+            table.add(task, "task")
+        running[0].finished = True
+        self.assertEqual(table.cancel([1, 2, 9]), [1, 9])
+        self.assertTrue(running[1].cancelled)
+        self.assertFalse(running[2].cancelled)
+        self.assertEqual(table.cancel(), [])
+        self.assertTrue(running[2].cancelled)
+        self.assertEqual(table.pending(), [])
+
+    def test_describe(self):
+        table = tasks.TaskTable()
+        table.add(FakeTask(), "await asyncio.sleep(1)")
+        lines = table.describe()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("[1] await asyncio.sleep(1) ("))
+
+
+if __name__ == '__main__':
+    unittest.main()